@@ -0,0 +1,108 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC Descripcion : Backfill de deteccion de fraudes iFood o Yuno sobre un rango historico, en tramos reanudables
+
+# COMMAND ----------
+
+# MAGIC %run "./TR_DETECCION_FRAUDES_INCLUDE"
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 1. Define widgets
+# MAGIC
+
+# COMMAND ----------
+
+dbutils.widgets.dropdown('pipeline', 'IFOOD', ['IFOOD', 'YUNO'], 'Pipeline')
+dbutils.widgets.text('fecha_desde', '', 'First day of the range (YYYY-MM-DD)')
+dbutils.widgets.text('fecha_hasta', '', 'Last day of the range (YYYY-MM-DD)')
+dbutils.widgets.text('mercados', '', 'Country IDs (tuple), Yuno only')
+dbutils.widgets.text('target_table', '', 'Fraud detection table written by the pipeline')
+dbutils.widgets.text('backfill_id', '', 'Backfill id; reuse it to resume a backfill')
+dbutils.widgets.text('dias_por_tramo', '7', 'Days per chunk')
+dbutils.widgets.text('max_paralelo', '', 'Chunks run at the same time (empty: from cluster cores)')
+dbutils.widgets.text('max_intentos', '2', 'Runs per chunk before it is reported as failed')
+dbutils.widgets.text('timeout_segundos', '7200', 'Timeout of each chunk run')
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 2. Initialize variables
+# MAGIC
+
+# COMMAND ----------
+
+from datetime import datetime
+
+BACKFILL_NOTEBOOKS = {
+    # Notebook run per chunk and the arguments that put it in range mode
+    "IFOOD": ("./TR_DETECCION_FRAUDES_IFOOD", {"execution_mode": "RANGE", "load_mode": "FULL"}),
+    "YUNO": ("./TR_DETECCION_FRAUDES_YUNO", {}),
+}
+
+pipeline = dbutils.widgets.get('pipeline')
+fecha_desde = datetime.strptime(dbutils.widgets.get('fecha_desde').strip(), '%Y-%m-%d').date()
+fecha_hasta = datetime.strptime(dbutils.widgets.get('fecha_hasta').strip(), '%Y-%m-%d').date()
+target_table = dbutils.widgets.get('target_table').strip()
+backfill_id = dbutils.widgets.get('backfill_id').strip() or f"backfill-{pipeline.lower()}-{fecha_desde}-{fecha_hasta}"
+dias_por_tramo = int(dbutils.widgets.get('dias_por_tramo').strip() or 7)
+max_paralelo = int(dbutils.widgets.get('max_paralelo').strip() or backfill_parallelism())
+max_intentos = int(dbutils.widgets.get('max_intentos').strip() or 2)
+timeout_segundos = int(dbutils.widgets.get('timeout_segundos').strip() or 7200)
+
+notebook_path, argumentos = BACKFILL_NOTEBOOKS[pipeline]
+if pipeline == "YUNO":
+    lista_mercados = parse_mercados(dbutils.widgets.get('mercados'))
+    if not lista_mercados:
+        raise ValueError("The 'mercados' widget is empty. Pass a tuple of country ids, e.g. (\"080\", \"131\").")
+    argumentos = {**argumentos, "mercados": mercados_sql(lista_mercados)}
+
+if not target_table:
+    raise ValueError("The 'target_table' widget is required.")
+
+checkpoint_table_name = f"{target_table}_backfill_chunks"
+create_backfill_checkpoint_table(checkpoint_table_name)
+
+tramos = backfill_chunks(fecha_desde, fecha_hasta, dias_por_tramo)
+print(f"Backfill {backfill_id}: {pipeline} from {fecha_desde} to {fecha_hasta} in {len(tramos)} chunks of {dias_por_tramo} days, up to {max_paralelo} in parallel.")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 3. Run the chunks
+# MAGIC
+
+# COMMAND ----------
+
+dict_resultados = run_backfill(
+    notebook_path,
+    pipeline,
+    tramos,
+    argumentos,
+    checkpoint_table_name,
+    backfill_id,
+    max_parallel=max_paralelo,
+    max_attempts=max_intentos,
+    timeout_seconds=timeout_segundos,
+)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 4. Report failed chunks
+# MAGIC
+
+# COMMAND ----------
+
+tramos_fallidos = {f"{desde}..{hasta}": error for (desde, hasta), error in dict_resultados.items() if error is not None}
+
+if tramos_fallidos:
+    # Re-run this notebook with the same backfill_id to run only the chunks that did not finish.
+    raise RuntimeError(f"Backfill {backfill_id}: {len(tramos_fallidos)} chunks failed: {tramos_fallidos}")
+
+# The chunk runs skip OPTIMIZE and VACUUM; the table is compacted and vacuumed once at the end of the backfill
+optimize_table(target_table)
+vacuum_table(target_table)
+
+print(f"Backfill {backfill_id}: all {len(tramos)} chunks processed.")
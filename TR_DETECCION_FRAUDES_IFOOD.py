@@ -12,6 +12,10 @@
 
 # COMMAND ----------
 
+# MAGIC %run "./TR_DETECCION_FRAUDES_INCLUDE"
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC # 1. Define and load input widgets
 # MAGIC
@@ -19,8 +23,12 @@
 # COMMAND ----------
 
 dbutils.widgets.text("fecha_ayer", "", "Fecha ayer (YYYY-MM-DD)")
+dbutils.widgets.text("fecha_desde", "", "Fecha desde (YYYY-MM-DD, RANGE mode only)")
 dbutils.widgets.text("pipeline_run_id", "", "Pipeline Run ID")
-dbutils.widgets.dropdown("execution_mode", "DEFAULT", ["CURRENT_MONTH", "PREVIOUS_MONTH", "DEFAULT"], "Execution Mode")
+dbutils.widgets.dropdown("execution_mode", "DEFAULT", ["CURRENT_MONTH", "PREVIOUS_MONTH", "DEFAULT", "RANGE"], "Execution Mode")
+dbutils.widgets.dropdown("load_mode", "FULL", ["FULL", "INCREMENTAL"], "Load Mode")
+dbutils.widgets.dropdown("metrics_force_count", "false", ["false", "true"], "Count every view (metrics)")
+dbutils.widgets.dropdown("sql_backend", "SPARK", ["SPARK", "AUTO", "DUCKDB"], "SQL backend of the views")
 
 pipeline_run_id = dbutils.widgets.get('pipeline_run_id').strip() if dbutils.widgets.get('pipeline_run_id').strip() != '' else 'Ejecución Manual'
 
@@ -41,6 +49,8 @@ import calendar
 
 fecha_ayer_str = dbutils.widgets.get("fecha_ayer").strip()
 execution_mode = dbutils.widgets.get("execution_mode")
+load_mode = dbutils.widgets.get("load_mode")
+RUN_METRICS_FORCE_COUNT = dbutils.widgets.get("metrics_force_count") == "true"
 
 base_date = None
 if fecha_ayer_str:
@@ -62,14 +72,28 @@ if execution_mode == "DEFAULT":
         execution_mode = "CURRENT_MONTH"
         print("Today is Thursday. Setting mode to CURRENT_MONTH.")
     else:
-        day_name = base_date.strftime("%A")
+        day_name = (base_date + timedelta(days=1)).strftime("%A")
         print(f"Today is {day_name}. No load scheduled for this day.")
         dbutils.notebook.exit(f"No data processing scheduled for {day_name}.")
 
 fecha_desde = None
 fecha_ayer = None
 
-if execution_mode == "PREVIOUS_MONTH":
+if execution_mode == "RANGE":
+    # Exact range [fecha_desde, fecha_ayer], used by the backfill: no weekday schedule and no 60-day re-read
+    try:
+        fecha_desde = datetime.strptime(dbutils.widgets.get("fecha_desde").strip(), '%Y-%m-%d').date()
+    except ValueError:
+        dbutils.notebook.exit("RANGE mode needs fecha_desde in the format YYYY-MM-DD.")
+    fecha_ayer = base_date
+
+    if fecha_ayer < fecha_desde:
+        dbutils.notebook.exit(f"fecha_desde {fecha_desde} is after fecha_ayer {fecha_ayer}.")
+
+    # A range run only sees its own dates, so it neither reads nor moves the incremental watermarks
+    load_mode = "FULL"
+
+elif execution_mode == "PREVIOUS_MONTH":
     fecha_ayer = base_date.replace(day=1) - timedelta(days=1)
     fecha_desde = fecha_ayer.replace(day=1)
 
@@ -82,7 +106,8 @@ elif execution_mode == "CURRENT_MONTH":
 
 
 if fecha_desde and fecha_ayer:
-    fecha_desde = fecha_ayer - timedelta(days=60)
+    if execution_mode != "RANGE":
+        fecha_desde = fecha_ayer - timedelta(days=60)
     fecha_desde_str = fecha_desde.strftime('%Y-%m-%d')
 
     fecha_hasta_str = fecha_ayer.strftime('%Y-%m-%d')
@@ -91,6 +116,10 @@ if fecha_desde and fecha_ayer:
     print("Final Calculated Date Range:")
     print(f"  Fecha Desde (Start Date): {fecha_desde_str}")
     print(f"  Fecha Hasta  (End Date):   {fecha_hasta_str}")
+
+    # TLD rows of the day before the window are read so sales settled by iFood on the first day still match;
+    # in RANGE mode consecutive chunks must not overlap, so the window starts at fecha_desde.
+    fecha_inicio_tld = fecha_desde if execution_mode == "RANGE" else fecha_desde - timedelta(days=1)
     
     
 else:
@@ -202,12 +231,15 @@ dict_table_metadata = {
         {"name": "external_order_manual_cancelamiento_total", "type": "DECIMAL(26, 5)", "comment": "Cancelación total manual."},
         {"name": "external_order_manual_cancelamiento_total_sem_impacto", "type": "DECIMAL(26, 5)", "comment": "Cancelación total manual sin impacto."},
         {"name": "external_order_manual_cancelamiento_parcial", "type": "DECIMAL(26, 5)", "comment": "Cancelación parcial manual."},
-        {"name": "external_order_manual_cancelamiento_parcial_sem_impacto", "type": "DECIMAL(26, 5)", "comment": "Cancelación parcial manual sin impacto."}
+        {"name": "external_order_manual_cancelamiento_parcial_sem_impacto", "type": "DECIMAL(26, 5)", "comment": "Cancelación parcial manual sin impacto."},
+        {"name": "row_hash", "type": "STRING", "comment": "Hash del contenido de la fila, usado por la carga MERGE para detectar cambios."}
     ],
 
     "primary_key": [
         "special_sale_order"
-    ]
+    ],
+    # Every load deletes by sales_business_dt and the dashboards filter by country
+    "cluster_by": ["sales_business_dt", "country_name_desc"]
 }
 
 
@@ -216,6 +248,40 @@ create_or_alter_table(
     dict_table_metadata=dict_table_metadata
  )
 
+apply_table_layout(table_full_name, dict_table_metadata)
+# Market units MERGE into the same target, each scoped to its own countries
+enable_row_level_concurrency(table_full_name)
+
+# COMMAND ----------
+
+# DBTITLE 1,Watermarks para carga incremental
+# Each source keeps its own high-water mark on adls_audit_date. In INCREMENTAL mode only the
+# special_sale_order keys (and the manual-matching groups) touched since the last run are rebuilt.
+
+watermark_table_name = f"{table_full_name}_watermark"
+
+dict_incremental_sources = {
+    "sales_transaction": f"{l1_raw_catalog_name}.adw.sales_transaction",
+    "payment_line_brasil": f"{l1_raw_catalog_name}.adw.payment_line_brasil",
+    "tr_ifood_reconciliation": f"{l2_foundation_catalog_name}.cancelaciones.tr_ifood_reconciliation",
+}
+
+create_watermark_table(watermark_table_name)
+
+run_metrics_table_name = f"{table_full_name}_run_metrics"
+create_run_metrics_table(run_metrics_table_name)
+
+previous_watermarks = get_watermarks(watermark_table_name, dict_incremental_sources.keys())
+current_watermarks = get_source_high_water_marks(dict_incremental_sources)
+
+if load_mode == "INCREMENTAL" and any(value is None for value in previous_watermarks.values()):
+    print("No previous watermark found for every source. Falling back to FULL load.")
+    load_mode = "FULL"
+
+print(f"Load mode: {load_mode}")
+for source_name in dict_incremental_sources:
+    print(f"  {source_name}: {previous_watermarks[source_name]} -> {current_watermarks[source_name]}")
+
 
 # COMMAND ----------
 
@@ -225,12 +291,152 @@ create_or_alter_table(
 
 # COMMAND ----------
 
-# DBTITLE 1,Creacion de tablas temporales
-spark.sql(f"""
+# DBTITLE 1,Motor SQL de la corrida (Spark o DuckDB)
+# Spark unless the widget asks otherwise; with AUTO, small windows run the view chain on DuckDB in the driver.
+# The estimate is the TLD rows of the window.
+choose_sql_backend(
+    dbutils.widgets.get("sql_backend"),
+    estimate_sql=f"""
+    SELECT COUNT(*)
+    FROM {l1_raw_catalog_name}.adw.sales_transaction
+    WHERE sales_business_dt BETWEEN '{fecha_inicio_tld}T00:00:00.000' AND '{fecha_ayer}T23:59:59.999'
+      AND country_id = '086'
+      AND sale_subchannel_id IN (2001)
+      AND sales_type_id IN (1, 2)
+    """,
+)
 
-CREATE OR REPLACE TEMP VIEW tld_br AS
+# COMMAND ----------
+
+# DBTITLE 1,Snapshots de dimensiones
+create_dimension_snapshots()
+
+# COMMAND ----------
+
+# DBTITLE 1,Pedidos tardios desde el indice de pedidos pendientes
+# Credit notes and 3PO records inside the window whose sale is older than the window. Only those
+# orders are read outside the window, by their literal sale dates and key.
+pending_orders_table_name = f"{table_full_name}_pending_orders"
+create_pending_order_index(pending_orders_table_name)
+
+eventos_tardios_sql = f"""
+  SELECT SUBSTRING_INDEX(st.specialsaleorderld, ' ', 1) AS special_sale_order
+  FROM {l1_raw_catalog_name}.adw.sales_transaction AS st
+  WHERE
+    st.sales_business_dt BETWEEN '{fecha_inicio_tld}T00:00:00.000' AND '{fecha_ayer}T23:59:59.999'
+    AND st.country_id = '086'
+    AND st.sales_type_id = 2
+    AND st.sale_subchannel_id = 2001
+
+  UNION
+
+  SELECT p.pedido_associado_ifood AS special_sale_order
+  FROM {l2_foundation_catalog_name}.cancelaciones.tr_ifood_reconciliation AS p
+  WHERE
+    p.data_fato_gerador BETWEEN '{fecha_desde}T00:00:00.000' AND '{fecha_ayer}T23:59:59.999'
+"""
+
+fechas_tardias = find_late_orders(pending_orders_table_name, eventos_tardios_sql, fecha_inicio_tld, ["086"])
+
+filtro_tardios_tld = late_orders_filter_sql(fechas_tardias, "st.sales_business_dt", "SUBSTRING_INDEX(st.specialsaleorderld, ' ', 1)")
+
+# The 3PO records of a late order are dated by their fiscal event, not by the sale
+filtro_tardios_3po = (
+    f"(p.data_fato_gerador BETWEEN '{fechas_tardias[0]}T00:00:00.000' AND '{fecha_desde}T00:00:00.000'"
+    " AND p.pedido_associado_ifood IN (SELECT special_sale_order FROM ordenes_tardias))"
+    if fechas_tardias else "FALSE"
+)
+
+# COMMAND ----------
+
+# DBTITLE 1,Prefiltro de ventas y lineas de pago
+# Only iFood payments: a sale needs a payment line of subtype 28_086
+regla_pago_ifood = "ifood_28_086"
+eligible_payment_lines_table_name = f"{table_full_name}_eligible_payment_lines"
+create_eligible_payment_lines_table(eligible_payment_lines_table_name)
+refresh_eligible_payment_lines(
+    eligible_payment_lines_table_name,
+    f"{l1_raw_catalog_name}.adw.payment_line_brasil",
+    regla_pago_ifood,
+    "payment_subtype_id = '28_086'",
+    ["086"],
+    pipeline_run_id,
+)
+
+# Sale columns read by tld_br_ventana. Every fact predicate is applied here on sales_transaction itself, the
+# subchannel as a literal on the sale, so data skipping drops files before any join. The payment lines come from the
+# eligible keys, one row per sale with the newest audit date of its eligible lines (pl_adls_audit_date), so a sale
+# gives one row however many payment lines it has.
+columnas_hechos_tld = [
+    "sales_transaction_id",
+    "specialsaleorderld",
+    "specialsaletype",
+    "salekey",
+    "integrated",
+    "sales_type_id",
+    "pos_register_id",
+    "country_id",
+    "loyalty_mcid",
+    "sales_date",
+    "sales_business_dt",
+    "sales_start_dttm",
+    "sales_end_dttm",
+    "sale_subchannel_id",
+    "sales_gross_amt",
+    "manager_associate_id",
+    "sales_associate_id",
+    "location_id",
+    "special_sale_storearea",
+    "adls_audit_date",
+]
+
+run_view_sql(f"""
+
+CREATE OR REPLACE TEMP VIEW tld_br_hechos AS
 
 SELECT
+  {", ".join(f"st.{columna}" for columna in columnas_hechos_tld)},
+  pl.adls_audit_date AS pl_adls_audit_date
+FROM
+  {l1_raw_catalog_name}.adw.sales_transaction AS st
+  INNER JOIN
+    (
+      SELECT sales_transaction_id, country_id, MAX(adls_audit_date) AS adls_audit_date
+      FROM {eligible_payment_lines_table_name}
+      WHERE
+        rule_id = '{regla_pago_ifood}'
+        AND country_id = '086'
+      GROUP BY sales_transaction_id, country_id
+    ) AS pl
+    ON
+      st.sales_transaction_id = pl.sales_transaction_id AND st.country_id = pl.country_id
+WHERE
+  (
+    st.sales_business_dt BETWEEN '{fecha_inicio_tld}T00:00:00.000' AND '{fecha_ayer}T23:59:59.999'
+    OR {filtro_tardios_tld}
+  )
+  AND st.sale_subchannel_id IN (2001)
+  AND st.country_id = '086'
+  AND st.sales_type_id IN (1, 2)
+
+"""
+)
+
+# COMMAND ----------
+
+# DBTITLE 1,Creacion de tablas temporales
+hint_dimensiones_tld = dimension_broadcast_hint({
+    "lss": "lk_sale_subchannel_actual",
+    "cm": "lk_sale_channel_actual",
+    "loc": "dim_location_actual",
+    "cou": "dim_country_actual",
+})
+
+run_view_sql(f"""
+
+CREATE OR REPLACE TEMP VIEW tld_br_ventana AS
+
+SELECT {hint_dimensiones_tld}
   st.sales_transaction_id,
   st.specialsaleorderld AS special_sale_order_ori,
   CASE
@@ -262,78 +468,29 @@ SELECT
   loc.location_base_id,
   loc.location_name,
   loc.loc_store_oak_id,
-  st.special_sale_storearea
+  st.special_sale_storearea,
+  st.adls_audit_date AS st_adls_audit_date,
+  st.pl_adls_audit_date
 FROM
-  {l1_raw_catalog_name}.adw.sales_transaction AS st
+  tld_br_hechos AS st
   INNER JOIN
-    {l2_foundation_catalog_name}.common.lk_sale_subchannel AS lss
+    lk_sale_subchannel_actual AS lss
     ON
       st.sale_subchannel_id = lss.sale_subchannel_id
   INNER JOIN
-    {l2_foundation_catalog_name}.common.lk_sale_channel AS cm
+    lk_sale_channel_actual AS cm
     ON
       lss.sale_channel_id = cm.sale_channel_id
   INNER JOIN
-    {l3_foundation_catalog_name}.common.dim_location AS loc
-    ON
-      st.location_id = loc.location_id AND loc.location_end_dt = '9999-12-31T00:00:00.000Z'
-  INNER JOIN
-    {l3_foundation_catalog_name}.common.dim_country AS cou
+    dim_location_actual AS loc
     ON
-      st.country_id = cou.country_id AND cou.country_end_dt = '9999-12-31T00:00:00.000Z'
+      st.location_id = loc.location_id
   INNER JOIN
-    {l1_raw_catalog_name}.adw.payment_line_brasil AS pl
+    dim_country_actual AS cou
     ON
-      st.sales_transaction_id = pl.sales_transaction_id AND cou.country_id = pl.country_id
-WHERE
-  st.sales_business_dt BETWEEN '{fecha_desde - timedelta(days=1)}T00:00:00.000' AND '{fecha_ayer}T23:59:59.999'
-  AND lss.sale_subchannel_id IN (2001)
-  AND pl.payment_subtype_id = '28_086'
-  AND st.country_id = '086'
-  AND st.sales_type_id IN (1, 2)
-  AND loc.ownerships_desc_reporting LIKE '%ArcopCo%'
-
-"""
-)
-
-# COMMAND ----------
-
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_nc AS
-SELECT DISTINCT
-  sales_start_dttm,
-  sales_end_dttm,
-  sales_date,
-  location_name,
-  sales_transaction_id,
-  special_sale_order_new AS special_sale_order,
-  venta_bruta AS venta_bruta_nc,
-  ROW_NUMBER() OVER (
-    PARTITION BY special_sale_order_new
-    ORDER BY
-      sales_transaction_id DESC
-  ) AS aux_orden_nc
-FROM
-  tld_br
+      st.country_id = cou.country_id
 WHERE
-  sales_type_id = 2
-  AND special_sale_order_new IS NOT NULL
-
-"""
-)
-
-# COMMAND ----------
-
-# DBTITLE 1,Duplicados
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_nc_duplicadas AS
-SELECT DISTINCT special_sale_order
-FROM
-  cte_nc
-WHERE
-  aux_orden_nc > 1
+  loc.ownerships_desc_reporting LIKE '%ArcopCo%'
 
 """
 )
@@ -341,808 +498,263 @@ WHERE
 # COMMAND ----------
 
 # DBTITLE 1,tabla ifood 3po
-spark.sql(f"""
+# Every 3PO record is Brazilian. The country attributes are read once from the snapshot and inlined as literals,
+# instead of a join on the constant c.country_short_abbreviation_cd = 'BR', which Spark can only plan as a
+# nested loop join over the whole 3PO side.
+paises_3po = collect_sql("""
+SELECT country_id, country_name_desc, country_timezone
+FROM dim_country_actual
+WHERE country_short_abbreviation_cd = 'BR'
+""")
+
+if len(paises_3po) > 1:
+    raise ValueError(f"dim_country_actual has {len(paises_3po)} current rows for BR; the 3PO records need exactly one.")
+
+pais_3po = {
+    columna: "CAST(NULL AS STRING)" if not paises_3po or paises_3po[0][columna] is None else f"'{paises_3po[0][columna]}'"
+    for columna in ("country_id", "country_name_desc", "country_timezone")
+}
 
-CREATE OR REPLACE TEMP VIEW cte_3po AS
+# Only the 3PO columns read by the incremental filters and the reconciliation adapter. The view feeds DISTINCTs and
+# window functions that cannot prune columns, so a p.* here would be shuffled in full.
+columnas_3po = [
+    "pedido_associado_ifood",
+    "pedido_associado_ifood_curto",
+    "data_criacao_pedido_associado",
+    "data_faturamento",
+    "fato_gerador",
+    "tipo_lancamento",
+    "monto_cobrado",
+    "valor_cancelado",
+    "valor_compensado",
+    "ressarcimento",
+    "outros_agg",
+    "cancelamento_total",
+    "cancelamento_parcial",
+    "cancelamento_total_sem_impacto",
+    "cancelamento_parcial_sem_impacto",
+    "venda_bruta",
+    "venda_bruta_sem_impacto",
+    "motivo_cancelamento",
+    "responsavel_transacao",
+    "adls_audit_date",
+]
+
+run_view_sql(f"""
+
+CREATE OR REPLACE TEMP VIEW cte_3po_ventana AS
 SELECT
   p.loja_id AS merchant_id,
   l.ownerships,
   m.name AS merchant_name,
-  m.corporatename,
-  c.country_name_desc,
+  {pais_3po["country_name_desc"]} AS country_name_desc,
   m.`LOCAL` AS location_acronym_cd,
-  FROM_UTC_TIMESTAMP(p.data_criacao_pedido_associado, c.country_timezone) AS data_criacao_pedido_associado_gmt,
-  FROM_UTC_TIMESTAMP(p.data_faturamento, c.country_timezone) AS data_faturamento_gmt,
-  p.*
+  FROM_UTC_TIMESTAMP(p.data_criacao_pedido_associado, {pais_3po["country_timezone"]}) AS data_criacao_pedido_associado_gmt,
+  FROM_UTC_TIMESTAMP(p.data_faturamento, {pais_3po["country_timezone"]}) AS data_faturamento_gmt,
+  {", ".join(f"p.{columna}" for columna in columnas_3po)}
 FROM
   {l2_foundation_catalog_name}.cancelaciones.tr_ifood_reconciliation AS p
   LEFT JOIN
     {l1_raw_catalog_name}.landing.ifood_merchants AS m
     ON
       p.loja_id = m.id
-  LEFT JOIN
-    {l3_foundation_catalog_name}.common.dim_country AS c
-    ON
-      c.country_short_abbreviation_cd = 'BR'
-      AND c.country_end_dt = '9999-12-31'
   LEFT JOIN
     {l1_raw_catalog_name}.adw.dim_lk_location_base AS l
     ON
-      c.country_id = l.country_id AND m.`LOCAL` = l.location_acronym_cd
+      l.country_id = {pais_3po["country_id"]} AND m.`LOCAL` = l.location_acronym_cd
 
 WHERE
   p.data_fato_gerador BETWEEN '{fecha_desde}T00:00:00.000' AND '{fecha_ayer}T23:59:59.999'
+  OR {filtro_tardios_3po}
 
 """
 )
 
 # COMMAND ----------
 
-# DBTITLE 1,3po integradas
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_3po_integradas AS
-SELECT DISTINCT i.*
-FROM
-  cte_3po AS i
-  INNER JOIN
-    tld_br AS t
-    ON
-      i.pedido_associado_ifood = t.special_sale_order_new
-
-"""
-)
-
-# COMMAND ----------
-
-# DBTITLE 1,3po manuales
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_3po_manuales AS
-SELECT DISTINCT
-  p.*,
-  CONCAT(CAST(p.data_criacao_pedido_associado_gmt AS DATE), p.location_acronym_cd, CAST(p.monto_cobrado AS DECIMAL(10, 2))) AS 3po_concat,
-
-
-  ROW_NUMBER() OVER (
-    PARTITION BY CONCAT(CAST(p.data_criacao_pedido_associado_gmt AS DATE), p.location_acronym_cd, CAST(p.monto_cobrado AS DECIMAL(10, 2)))
-    ORDER BY
-      1 DESC
-  ) AS aux_3po_concat_orden
-
-FROM
-  cte_3po AS p
-WHERE
-  NOT EXISTS (
-    SELECT 1
+# DBTITLE 1,Claves y grupos afectados desde el ultimo watermark
+if load_mode == "INCREMENTAL":
+
+    # Rows of either side that changed since the previous run, read from the sources with their
+    # watermark predicate next to the window predicates, so data skipping on adls_audit_date keeps
+    # the scans small. A sale also changes when one of its payment lines does. A manual-matching
+    # group is the (date, location) prefix of the concat key, so every row that may share a concat
+    # with a changed row is rebuilt together with it. The sale side is not yet restricted to
+    # eligible ArcopCo sales; the extra keys are rebuilt to the same rows.
+    cache_table_as("ifood_cambios", f"""
+    SELECT {dimension_broadcast_hint({"loc": "dim_location_actual"})}
+      CASE WHEN LENGTH(st.specialsaleorderld) > 4 THEN SUBSTRING_INDEX(st.specialsaleorderld, ' ', 1) END AS special_sale_order,
+      CAST(st.sales_end_dttm AS DATE) AS fecha_grupo,
+      LEFT(loc.location_name, 3) AS local_grupo
     FROM
-      cte_3po_integradas AS i
+      {l1_raw_catalog_name}.adw.sales_transaction AS st
+      INNER JOIN
+        dim_location_actual AS loc
+        ON
+          st.location_id = loc.location_id
     WHERE
-      i.pedido_associado_ifood = p.pedido_associado_ifood
-  )
-
-"""
-)
-
-
-# COMMAND ----------
-
-# DBTITLE 1,duplicados
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_concatenados_duplicados AS
-SELECT DISTINCT m.3po_concat
-FROM
-  cte_3po_manuales AS m
-WHERE
-  m.aux_3po_concat_orden > 1
-
-"""
-)
-
-# COMMAND ----------
-
-# DBTITLE 1,3po manuales asociables
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_3po_manuales_asociables AS
-SELECT m.*
-FROM
-  cte_3po_manuales AS m
-WHERE
-  NOT EXISTS (
-    SELECT 1
+      (
+        st.sales_business_dt BETWEEN '{fecha_inicio_tld}T00:00:00.000' AND '{fecha_ayer}T23:59:59.999'
+        OR {filtro_tardios_tld}
+      )
+      AND st.sale_subchannel_id IN (2001)
+      AND st.country_id = '086'
+      AND st.sales_type_id IN (1, 2)
+      AND (
+        st.adls_audit_date > '{previous_watermarks["sales_transaction"]}'
+        OR st.sales_transaction_id IN (
+          SELECT sales_transaction_id
+          FROM {l1_raw_catalog_name}.adw.payment_line_brasil
+          WHERE
+            adls_audit_date > '{previous_watermarks["payment_line_brasil"]}'
+            AND country_id = '086'
+        )
+      )
+
+    UNION
+
+    SELECT
+      p.pedido_associado_ifood AS special_sale_order,
+      CAST(FROM_UTC_TIMESTAMP(p.data_criacao_pedido_associado, {pais_3po["country_timezone"]}) AS DATE) AS fecha_grupo,
+      m.`LOCAL` AS local_grupo
     FROM
-      cte_concatenados_duplicados AS md
+      {l2_foundation_catalog_name}.cancelaciones.tr_ifood_reconciliation AS p
+      LEFT JOIN
+        {l1_raw_catalog_name}.landing.ifood_merchants AS m
+        ON
+          p.loja_id = m.id
     WHERE
-      m.3po_concat = md.3po_concat
-  )
+      (
+        p.data_fato_gerador BETWEEN '{fecha_desde}T00:00:00.000' AND '{fecha_ayer}T23:59:59.999'
+        OR {filtro_tardios_3po}
+      )
+      AND p.adls_audit_date > '{previous_watermarks["tr_ifood_reconciliation"]}'
+    """)
+
+    # Key and group of every row of the window, the only full read of the window before the rebuild.
+    # The closure below runs on this narrow copy instead of re-reading tld_br_ventana and cte_3po_ventana.
+    cache_table_as("ifood_indice_ventana", """
+    SELECT DISTINCT
+      special_sale_order_new AS special_sale_order,
+      CAST(sales_end_dttm AS DATE) AS fecha_grupo,
+      LEFT(location_name, 3) AS local_grupo
+    FROM
+      tld_br_ventana
 
-"""
-)
+    UNION
 
-# COMMAND ----------
+    SELECT DISTINCT
+      pedido_associado_ifood AS special_sale_order,
+      CAST(data_criacao_pedido_associado_gmt AS DATE) AS fecha_grupo,
+      location_acronym_cd AS local_grupo
+    FROM
+      cte_3po_ventana
+    """)
 
-# DBTITLE 1,3po manuales no asociables
-spark.sql(f"""
+    # Late credit notes and late 3PO records reach the original sale through their key, which is
+    # looked up over the whole window.
+    run_view_sql(f"""
 
-CREATE OR REPLACE TEMP VIEW cte_3po_manuales_no_asociadas AS
-SELECT m.*
-FROM
-  cte_3po_manuales AS m
-WHERE
-  EXISTS (
-    SELECT 1
+    CREATE OR REPLACE TEMP VIEW ifood_grupos_afectados AS
+    SELECT
+      i.fecha_grupo,
+      i.local_grupo
     FROM
-      cte_concatenados_duplicados AS md
+      ifood_indice_ventana AS i
     WHERE
-      m.3po_concat = md.3po_concat
-  )
-
-"""
-)
+      i.special_sale_order IN (SELECT special_sale_order FROM ifood_cambios)
 
-# COMMAND ----------
-
-spark.sql(f"""
+    UNION
 
-CREATE OR REPLACE TEMP VIEW cte_tld_integradas AS
-SELECT
-  CONCAT(t.country_name_desc, '-', LEFT(t.location_name, 3)) AS key,
-  t.*
-FROM
-  tld_br AS t
-  INNER JOIN
-    cte_3po_integradas AS i
-    ON
-      t.special_sale_order_new = i.pedido_associado_ifood
-WHERE
-  sales_type_id = 1
-  AND t.special_sale_order_new IS NOT null
-
-"""
-)
+    SELECT
+      fecha_grupo,
+      local_grupo
+    FROM
+      ifood_cambios
 
-# COMMAND ----------
+    """
+    )
 
-spark.sql(f"""
+    # One hop of closure: the keys of every row in an affected group are rebuilt as well, so rows
+    # pulled in by a group are still classified against their integrated counterpart.
+    run_view_sql(f"""
 
-CREATE OR REPLACE TEMP VIEW cte_tld_manuales AS
-SELECT
-  a.*,
-  CONCAT(a.country_name_desc, '-', LEFT(a.location_name, 3)) AS key,
-  CONCAT(CAST(a.sales_end_dttm AS DATE), LEFT(a.location_name, 3), CAST(a.venta_bruta AS DECIMAL(10, 2))) AS concat,
-  ROW_NUMBER() OVER (
-    PARTITION BY CONCAT(LEFT(a.location_name, 3), CAST(a.sales_end_dttm AS DATE), CAST(a.venta_bruta AS DECIMAL(10, 2)))
-    ORDER BY
-      1 DESC
-  ) AS aux_concat_orden
-FROM
-  tld_br AS a
-WHERE
-  a.sales_type_id = 1
-  AND NOT EXISTS (
-    SELECT 1
+    CREATE OR REPLACE TEMP VIEW ifood_claves_afectadas AS
+    SELECT special_sale_order
     FROM
-      cte_tld_integradas AS i
+      ifood_cambios
     WHERE
-      i.sales_transaction_id = a.sales_transaction_id
-  )
+      special_sale_order IS NOT NULL
 
-"""
-)
+    UNION
 
-# COMMAND ----------
+    SELECT i.special_sale_order
+    FROM
+      ifood_indice_ventana AS i
+    WHERE
+      i.special_sale_order IS NOT NULL
+      AND (i.fecha_grupo, i.local_grupo) IN (SELECT fecha_grupo, local_grupo FROM ifood_grupos_afectados)
 
-spark.sql(f"""
+    """
+    )
 
-CREATE OR REPLACE TEMP VIEW cte_tld_manuales_mismo_concat AS
-SELECT DISTINCT m.concat
-FROM
-  cte_tld_manuales AS m
+    filtro_tld_incremental = """
 WHERE
-  m.aux_concat_orden > 1
-
+  t.special_sale_order_new IN (SELECT special_sale_order FROM ifood_claves_afectadas)
+  OR (CAST(t.sales_end_dttm AS DATE), LEFT(t.location_name, 3)) IN (SELECT fecha_grupo, local_grupo FROM ifood_grupos_afectados)
 """
-)
 
-# COMMAND ----------
-
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_tld_manuales_asociables AS
-SELECT DISTINCT t.*
-FROM
-  cte_tld_manuales AS t
+    filtro_3po_incremental = """
 WHERE
-  NOT EXISTS (
-    SELECT 1
-    FROM
-      cte_tld_manuales_mismo_concat AS m
-    WHERE
-      m.concat = t.concat
-  )
-
+  p.pedido_associado_ifood IN (SELECT special_sale_order FROM ifood_claves_afectadas)
+  OR (CAST(p.data_criacao_pedido_associado_gmt AS DATE), p.location_acronym_cd) IN (SELECT fecha_grupo, local_grupo FROM ifood_grupos_afectados)
 """
-)
-
-# COMMAND ----------
-
-spark.sql(f"""
 
-CREATE OR REPLACE TEMP VIEW cte_tld_manuales_no_asociables AS
-SELECT t.*
-FROM
-  cte_tld_manuales AS t
-WHERE
-  EXISTS (
-    SELECT 1
-    FROM
-      cte_tld_manuales_mismo_concat AS m
-    WHERE
-      m.concat = t.concat
-  )
-
-"""
-)
+else:
+    filtro_tld_incremental = ""
+    filtro_3po_incremental = ""
 
 # COMMAND ----------
 
-# DBTITLE 1,Vistas temporales para generar la tabla cte_temp integradas
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_temp_integradas AS
-
-SELECT DISTINCT --transacciones tld integradas
-  '3PO' AS selector,
-  'Integradas' AS tipo_integracion,
-  NULL AS clave_concatenada,
-  a.special_sale_storearea,
-  a.ownerships,
-  a.country_name_desc,
-  LEFT(a.location_name, 3) AS location_acronym_cd,
-  a.key,
-  a.sales_date,
-  fecha,
-  a.sales_start_dttm,
-  a.sales_end_dttm,
-  a.sales_transaction_id,
-  a.special_sale_order_new,
-  salekey,
-  pos_register_id,
-  SUBSTRING(pos_register_id, 0, CHARINDEX('_', pos_register_id) - 1) AS pos_register_number,
-  channel_name_desc,
-  subchannel_name_desc,
-  integrated,
-  sales_type_id,
-  a.venta_bruta,
-  nc.sales_transaction_id AS sales_transaction_id_nc,
-  CASE WHEN nc_d.special_sale_order IS NULL THEN 0 ELSE 1 END AS nc_duplicada,
-  nc.sales_date AS sales_date_nc,
-  nc.sales_start_dttm AS sales_start_dttm_nc,
-  nc.sales_end_dttm AS sales_end_dttm_nc,
-  nc.venta_bruta_nc,
-  DATEDIFF(SECOND, a.sales_end_dttm, nc.sales_end_dttm) AS tiempo_reintegro_nc_seg,
-  DATEDIFF(MINUTE, a.sales_end_dttm, nc.sales_end_dttm) AS tiempo_reintegro_nc_min,
-  y.data_criacao_pedido_associado_gmt AS 3po_created_at,
-  y.data_faturamento_gmt AS 3po_updated_at,
-  DATEDIFF(SECOND, y.data_criacao_pedido_associado, y.data_faturamento) AS tiempo_proceso_3po_seg,
-  DATEDIFF(SECOND, y.data_criacao_pedido_associado_gmt, a.sales_start_dttm) AS tiempo_recepcion_tld_seg,
-  DATEDIFF(SECOND, a.sales_start_dttm, a.sales_end_dttm) AS tiempo_transaccion_tld_seg,
-  y.merchant_id,
-  y.merchant_name,
-  y.pedido_associado_ifood_curto AS payment_id,
-  y.fato_gerador AS 3po_status,
-  y.tipo_lancamento AS 3po_sub_status,
-  y.monto_cobrado AS 3po_amount_value,
-  y.valor_cancelado AS 3po_captured,
-  y.valor_compensado AS 3po_refunded,
-
-  CASE WHEN y.ressarcimento > 0
-      THEN y.cancelamento_total + y.cancelamento_parcial + y.cancelamento_parcial_sem_impacto + y.cancelamento_total_sem_impacto
-        + venda_bruta + venda_bruta_sem_impacto
-    ELSE venda_bruta + venda_bruta_sem_impacto
-  END
-  AS 3po_cobro_integrado,
-
-
-  CASE WHEN fato_gerador IN ('Venda', 'Ocorrencia Venda') THEN a.venta_bruta - monto_cobrado
-    WHEN fato_gerador = 'Cancelamento Parcial' THEN a.venta_bruta - monto_cobrado
-    WHEN fato_gerador = 'Ressarcimento/Indenização' AND valor_cancelado < monto_cobrado THEN a.venta_bruta - monto_cobrado
-    ELSE 0
-  END AS 3po_diferencia_cobro_integrada,
-
-
-  CASE WHEN (y.cancelamento_total < 0 OR y.cancelamento_parcial < 0 OR y.cancelamento_total_sem_impacto < 0 OR y.cancelamento_parcial_sem_impacto < 0) AND y.ressarcimento = 0
-      THEN (y.cancelamento_total + y.cancelamento_parcial + y.cancelamento_total_sem_impacto + y.cancelamento_parcial_sem_impacto)
-    ELSE 0
-  END AS 3po_cancelacion_integrada,
-
-
-  CASE WHEN fato_gerador = 'Cancelamento Total' THEN a.venta_bruta - valor_cancelado
-    ELSE 0
-  END AS 3po_diferencia_cancelacion_integrada,
-
-  0 AS 3po_cancelacion_parcial_integrada,
-
-  CASE WHEN fato_gerador = 'Cancelamento Parcial' THEN a.venta_bruta - valor_cancelado
-    ELSE 0
-  END AS 3po_diferencia_cancelacion_parcial_integrada,
-
-
-
-  CASE
-    WHEN ressarcimento > 0 AND outros_agg > 0 THEN ressarcimento + outros_agg
-    WHEN ressarcimento > 0 THEN ressarcimento
-    WHEN outros_agg > 0 THEN outros_agg
-    ELSE 0
-  END AS 3po_compensacion_integrada,
-
-
-  0 AS 3po_diferencia_compensacion_integrada,
-
-  0 AS 3po_compensacion_parcial_integrada,
-
-  CASE WHEN fato_gerador = 'Ressarcimento/Indenização' AND valor_cancelado < monto_cobrado THEN a.venta_bruta - valor_compensado
-    ELSE 0
-  END AS 3po_diferencia_compensacion_parcial_integrada,
-
-
-  0 AS 3po_cobro_manual,
-  0 AS 3po_diferencia_cobro_manual,
-  0 AS 3po_cancelacion_manual,
-  0 AS 3po_diferencia_cancelacion_manual,
-  0 AS 3po_cancelacion_parcial_manual,
-  0 AS 3po_diferencia_cancelacion_parcial_manual,
-  0 AS 3po_compensacion_manual,
-  0 AS 3po_diferencia_compensacion_manual,
-  0 AS 3po_compensacion_parcial_manual,
-  0 AS 3po_diferencia_compensacion_parcial_manual,
-
-  y.motivo_cancelamento AS 3po_motivo_cancelacion,
-  CASE WHEN fato_gerador = 'Ressarcimento/Indenização' THEN 'IFOOD'
-    WHEN fato_gerador IN ('Cancelamento Total', 'Cancelamento Parcial') THEN 'AD'
-  END AS 3po_responsable_cancelacion,
-
-  y.responsavel_transacao AS 3po_responsable_transaccion,
-
-  venda_bruta AS external_order_integrated_venta_bruta,
-  venda_bruta_sem_impacto AS external_order_integrated_venta_bruta_sem_impacto,
-  cancelamento_total AS external_order_integrated_cancelamiento_total,
-  cancelamento_total_sem_impacto AS external_order_integrated_cancelamiento_total_sem_impacto,
-  cancelamento_parcial AS external_order_integrated_cancelamiento_parcial,
-  cancelamento_parcial_sem_impacto AS external_order_integrated_cancelamiento_parcial_sem_impacto,
-
-  0 AS external_order_manual_venta_bruta,
-  0 AS external_order_manual_venta_bruta_sem_impacto,
-  0 AS external_order_manual_cancelamiento_total,
-  0 AS external_order_manual_cancelamiento_total_sem_impacto,
-  0 AS external_order_manual_cancelamiento_parcial,
-  0 AS external_order_manual_cancelamiento_parcial_sem_impacto
+# DBTITLE 1,Vistas base tld_br y cte_3po
+run_view_sql(f"""
 
+CREATE OR REPLACE TEMP VIEW tld_br AS
+SELECT t.*
 FROM
-  cte_tld_integradas AS a
-  INNER JOIN
-    cte_3po_integradas AS y
-    ON
-      a.special_sale_order_new = y.pedido_associado_ifood
-  LEFT JOIN
-    cte_nc AS nc
-    ON
-      a.special_sale_order_new = nc.special_sale_order
-  LEFT JOIN
-    cte_nc_duplicadas AS nc_d
-    ON
-      nc.special_sale_order = nc_d.special_sale_order
-
+  tld_br_ventana AS t
+{filtro_tld_incremental}
 """
 )
 
-# COMMAND ----------
-
-# DBTITLE 1,Vistas temporales para generar la tabla cte_temp manuales asociadas
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_temp_manuales_asociadas AS
-
-SELECT DISTINCT --transacciones tld manuales asociables con 3po
-  '3PO' AS selector,
-  'Manuales asociadas' AS tipo_integracion,
-  a.concat AS clave_concatenada,
-  a.special_sale_storearea,
-  a.ownerships,
-  a.country_name_desc,
-  LEFT(a.location_name, 3) AS location_acronym_cd,
-  a.key,
-  a.sales_date,
-  fecha,
-  a.sales_start_dttm,
-  a.sales_end_dttm,
-  a.sales_transaction_id,
-  COALESCE(y.pedido_associado_ifood, a.special_sale_order_new),
-  salekey,
-  pos_register_id,
-  SUBSTRING(pos_register_id, 0, CHARINDEX('_', pos_register_id) - 1) AS pos_register_number,
-  channel_name_desc,
-  subchannel_name_desc,
-  integrated,
-  sales_type_id,
-  a.venta_bruta,
-  null AS sales_transaction_id_nc,
-  null AS nc_duplicada,
-  null AS sales_date_nc,
-  null AS sales_start_dttm_nc,
-  null AS sales_end_dttm_nc,
-  null AS venta_bruta_nc,
-  null AS tiempo_reintegro_nc_seg,
-  null AS tiempo_reintegro_nc_min,
-  y.data_criacao_pedido_associado_gmt AS 3po_created_at,
-  y.data_faturamento_gmt AS 3po_updated_at,
-  DATEDIFF(SECOND, y.data_criacao_pedido_associado, y.data_faturamento) AS tiempo_proceso_3po_seg,
-  DATEDIFF(SECOND, y.data_criacao_pedido_associado_gmt, a.sales_start_dttm) AS tiempo_recepcion_tld_seg,
-  DATEDIFF(SECOND, a.sales_start_dttm, a.sales_end_dttm) AS tiempo_transaccion_tld_seg,
-  y.merchant_id,
-  y.merchant_name,
-  y.pedido_associado_ifood_curto AS payment_id,
-  y.fato_gerador AS 3po_status,
-  y.tipo_lancamento AS 3po_sub_status,
-  y.monto_cobrado AS 3po_amount_value,
-  y.valor_cancelado AS 3po_captured,
-  y.valor_compensado AS 3po_refunded,
-  0 AS 3po_cobro_integrado,
-  0 AS 3po_diferencia_cobro_integrada,
-  0 AS 3po_cancelacion_integrada,
-  0 AS 3po_diferencia_cancelacion_integrada,
-  0 AS 3po_cancelacion_parcial_integrada,
-  0 AS 3po_diferencia_cancelacion_parcial_integrada,
-  0 AS 3po_compensacion_integrada,
-  0 AS 3po_diferencia_compensacion_integrada,
-  0 AS 3po_compensacion_parcial_integrada,
-  0 AS 3po_diferencia_compensacion_parcial_integrada,
-  CASE
-    WHEN y.ressarcimento > 0
-      THEN
-        CAST(y.cancelamento_total AS DECIMAL)
-        + CAST(y.cancelamento_parcial AS DECIMAL)
-        + CAST(y.cancelamento_total_sem_impacto AS DECIMAL)
-        + CAST(y.cancelamento_parcial_sem_impacto AS DECIMAL)
-        + CAST(venda_bruta AS DECIMAL)
-        + CAST(venda_bruta_sem_impacto AS DECIMAL)
-    ELSE
-      CAST(venda_bruta AS DECIMAL)
-      + CAST(venda_bruta_sem_impacto AS DECIMAL)
-  END AS 3po_cobro_manual,
-
-
-  CASE WHEN fato_gerador IN ('Venda', 'Ocorrencia Venda') THEN a.venta_bruta - monto_cobrado
-    WHEN fato_gerador = 'Cancelamento Parcial' THEN a.venta_bruta - monto_cobrado
-    WHEN fato_gerador = 'Ressarcimento/Indenização' AND valor_cancelado < monto_cobrado THEN a.venta_bruta - monto_cobrado
-    ELSE 0
-  END AS 3po_diferencia_cobro_manual,
-
-
-  CASE WHEN (
-      y.cancelamento_total < 0 OR y.cancelamento_parcial < 0 OR y.cancelamento_parcial_sem_impacto
-      < 0 OR y.cancelamento_total_sem_impacto < 0
-    ) AND y.ressarcimento = 0
-      THEN (y.cancelamento_total + y.cancelamento_parcial + y.cancelamento_parcial_sem_impacto + y.cancelamento_total_sem_impacto)
-    ELSE 0
-  END AS 3po_cancelacion_manual,
-
-
-  CASE WHEN fato_gerador = 'Cancelamento Total' THEN a.venta_bruta - valor_cancelado
-    ELSE 0
-  END AS 3po_diferencia_cancelacion_manual,
-
-  0 AS 3po_cancelacion_parcial_manual,
-
-
-  CASE WHEN fato_gerador = 'Cancelamento Parcial' THEN a.venta_bruta - valor_cancelado
-    ELSE 0
-  END AS 3po_diferencia_cancelacion_parcial_manual,
-
-
-  CASE
-    WHEN ressarcimento > 0 AND outros_agg > 0 THEN ressarcimento + outros_agg
-    WHEN ressarcimento > 0 THEN ressarcimento
-    WHEN outros_agg > 0 THEN outros_agg
-    ELSE 0
-  END AS 3po_compensacion_manual,
-
-
-  0 AS 3po_diferencia_compensacion_manual,
-  0 AS 3po_compensacion_parcial_manual,
-  CASE WHEN fato_gerador = 'Ressarcimento/Indenização' AND valor_cancelado < monto_cobrado THEN a.venta_bruta - valor_compensado
-    ELSE 0
-  END AS 3po_diferencia_compensacion_parcial_manual,
-
-  y.motivo_cancelamento AS 3po_motivo_cancelacion,
-  CASE WHEN fato_gerador = 'Ressarcimento/Indenização' THEN 'IFOOD'
-    WHEN fato_gerador IN ('Cancelamento Total', 'Cancelamento Parcial') THEN 'AD'
-  END AS 3po_responsable_cancelacion,
-
-  y.responsavel_transacao AS 3po_responsable_transaccion,
-
-  0 AS external_order_integrated_venta_bruta,
-  0 AS external_order_integrated_venta_bruta_sem_impacto,
-  0 AS external_order_integrated_cancelamiento_total,
-  0 AS external_order_integrated_cancelamiento_total_sem_impacto,
-  0 AS external_order_integrated_cancelamiento_parcial,
-  0 AS external_order_integrated_cancelamiento_parcial_sem_impacto,
-
-  venda_bruta AS external_order_manual_venta_bruta,
-  venda_bruta_sem_impacto AS external_order_manual_venta_bruta_sem_impacto,
-  cancelamento_total AS external_order_manual_cancelamiento_total,
-  cancelamento_total_sem_impacto AS external_order_manual_cancelamiento_total_sem_impacto,
-  cancelamento_parcial AS external_order_manual_cancelamiento_parcial,
-  cancelamento_parcial_sem_impacto AS external_order_manual_cancelamiento_parcial_sem_impacto
-
-
+run_view_sql(f"""
 
+CREATE OR REPLACE TEMP VIEW cte_3po AS
+SELECT p.*
 FROM
-  cte_tld_manuales_asociables AS a
-  INNER JOIN
-    cte_3po_manuales_asociables AS y
-    ON
-      a.concat = y.3po_concat
-
+  cte_3po_ventana AS p
+{filtro_3po_incremental}
 """
 )
 
 # COMMAND ----------
 
-# DBTITLE 1,Vistas temporales para generar la tabla cte_temp
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_temp_manuales_no_asociadas AS
-SELECT DISTINCT --transacciones tld manuales que no pudieron encontrarse por concatenado
-  '3PO' AS selector,
-  'Manuales no asociadas' AS tipo_integracion,
-  a.concat AS clave_concatenada,
-  a.special_sale_storearea,
-  a.ownerships,
-  a.country_name_desc,
-  LEFT(a.location_name, 3) AS location_acronym_cd,
-  a.key,
-  a.sales_date,
-  fecha,
-  a.sales_start_dttm,
-  a.sales_end_dttm,
-  a.sales_transaction_id,
-  a.special_sale_order_new,
-  salekey,
-  pos_register_id,
-  SUBSTRING(pos_register_id, 0, CHARINDEX('_', pos_register_id) - 1) AS pos_register_number,
-  channel_name_desc,
-  subchannel_name_desc,
-  integrated,
-  sales_type_id,
-  a.venta_bruta,
-  null AS sales_transaction_id_nc,
-  null AS nc_duplicada,
-  null AS sales_date_nc,
-  null AS sales_start_dttm_nc,
-  null AS sales_end_dttm_nc,
-  null AS venta_bruta_nc,
-  null AS tiempo_reintegro_nc_seg,
-  null AS tiempo_reintegro_nc_min,
-  null AS 3po_created_at,
-  null AS 3po_updated_at,
-  null AS tiempo_proceso_3po_seg,
-  null AS tiempo_recepcion_tld_seg,
-  DATEDIFF(SECOND, a.sales_start_dttm, a.sales_end_dttm) AS tiempo_transaccion_tld_seg,
-  null AS merchant_id,
-  null AS merchant_name,
-  null AS payment_id,
-  null AS 3po_status,
-  null AS 3po_sub_status,
-  null AS 3po_amount_value,
-  null AS 3po_captured,
-  null AS 3po_refunded,
-  0 AS 3po_cobro_integrado,
-  0 AS 3po_diferencia_cobro_integrada,
-  0 AS 3po_cancelacion_integrada,
-  0 AS 3po_diferencia_cancelacion_integrada,
-  0 AS 3po_cancelacion_parcial_integrada,
-  0 AS 3po_diferencia_cancelacion_parcial_integrada,
-  0 AS 3po_compensacion_integrada,
-  0 AS 3po_diferencia_compensacion_integrada,
-  0 AS 3po_compensacion_parcial_integrada,
-  0 AS 3po_diferencia_compensacion_parcial_integrada,
-  0 AS 3po_cobro_manual,
-  0 AS 3po_diferencia_cobro_manual,
-  0 AS 3po_cancelacion_manual,
-  0 AS 3po_diferencia_cancelacion_manual,
-  0 AS 3po_cancelacion_parcial_manual,
-  0 AS 3po_diferencia_cancelacion_parcial_manual,
-  0 AS 3po_compensacion_manual,
-  0 AS 3po_diferencia_compensacion_manual,
-  0 AS 3po_compensacion_parcial_manual,
-  0 AS 3po_diferencia_compensacion_parcial_manual,
-
-  0 AS external_order_integrated_venta_bruta,
-  0 AS external_order_integrated_venta_bruta_sem_impacto,
-  0 AS external_order_integrated_cancelamiento_total,
-  0 AS external_order_integrated_cancelamiento_total_sem_impacto,
-  0 AS external_order_integrated_cancelamiento_parcial,
-  0 AS external_order_integrated_cancelamiento_parcial_sem_impacto,
-
-  0 AS external_order_manual_venta_bruta,
-  0 AS external_order_manual_venta_bruta_sem_impacto,
-  0 AS external_order_manual_cancelamiento_total,
-  0 AS external_order_manual_cancelamiento_total_sem_impacto,
-  0 AS external_order_manual_cancelamiento_parcial,
-  0 AS external_order_manual_cancelamiento_parcial_sem_impacto,
-
-  null AS 3po_motivo_cancelacion,
-  null AS 3po_responsable_cancelacion,
-  null AS 3po_responsable_transaccion
-
-FROM
-  cte_tld_manuales_asociables AS a
-WHERE
-  NOT EXISTS (
-    SELECT 1
-    FROM
-      cte_3po_manuales_asociables AS y
-    WHERE
-      y.3po_concat = a.concat
-  )
-
-UNION DISTINCT
-
-SELECT DISTINCT --transaciones tld manuales no asociadas
-  '3PO' AS selector,
-  'Manuales no asociadas' AS tipo_integracion,
-  a.concat AS clave_concatenada,
-  a.special_sale_storearea,
-  a.ownerships,
-  country_name_desc,
-  LEFT(a.location_name, 3) AS location_acronym_cd,
-  a.key,
-  a.sales_date,
-  fecha,
-  a.sales_start_dttm,
-  a.sales_end_dttm,
-  a.sales_transaction_id,
-  a.special_sale_order_new,
-  salekey,
-  pos_register_id,
-  SUBSTRING(pos_register_id, 0, CHARINDEX('_', pos_register_id) - 1) AS pos_register_number,
-  channel_name_desc,
-  subchannel_name_desc,
-  integrated,
-  sales_type_id,
-  a.venta_bruta,
-  null AS sales_transaction_id_nc,
-  null,
-  null AS sales_date_nc,
-  null AS sales_start_dttm_nc,
-  null AS sales_end_dttm_nc,
-  null AS venta_bruta_nc,
-  null AS tiempo_reintegro_nc_seg,
-  null AS tiempo_reintegro_nc_min,
-  null AS 3po_created_at,
-  null AS 3po_updated_at,
-  null AS tiempo_proceso_3po_seg,
-  null AS tiempo_recepcion_tld_seg,
-  DATEDIFF(SECOND, a.sales_start_dttm, a.sales_end_dttm) AS tiempo_transaccion_tld_seg,
-  null AS merchant_id,
-  null AS merchant_name,
-  null AS payment_id,
-  null AS 3po_status,
-  null AS 3po_sub_status,
-  null AS 3po_amount_value,
-  null AS 3po_captured,
-  null AS 3po_refunded,
-  0 AS 3po_cobro_integrado,
-  0 AS 3po_diferencia_cobro_integrada,
-  0 AS 3po_cancelacion_integrada,
-  0 AS 3po_diferencia_cancelacion_integrada,
-  0 AS 3po_cancelacion_parcial_integrada,
-  0 AS 3po_diferencia_cancelacion_parcial_integrada,
-  0 AS 3po_compensacion_integrada,
-  0 AS 3po_diferencia_compensacion_integrada,
-  0 AS 3po_compensacion_parcial_integrada,
-  0 AS 3po_diferencia_compensacion_parcial_integrada,
-  0 AS 3po_cobro_manual,
-  0 AS 3po_diferencia_cobro_manual,
-  0 AS 3po_cancelacion_manual,
-  0 AS 3po_diferencia_cancelacion_manual,
-  0 AS 3po_cancelacion_parcial_manual,
-  0 AS 3po_diferencia_cancelacion_parcial_manual,
-  0 AS 3po_compensacion_manual,
-  0 AS 3po_diferencia_compensacion_manual,
-  0 AS 3po_compensacion_parcial_manual,
-  0 AS 3po_diferencia_compensacion_parcial_manual,
-
-
-  null AS 3po_motivo_cancelacion,
-  null AS 3po_responsable_cancelacion,
-  null AS 3po_responsable_transaccion,
-
-  0 AS external_order_integrated_venta_bruta,
-  0 AS external_order_integrated_venta_bruta_sem_impacto,
-  0 AS external_order_integrated_cancelamiento_total,
-  0 AS external_order_integrated_cancelamiento_total_sem_impacto,
-  0 AS external_order_integrated_cancelamiento_parcial,
-  0 AS external_order_integrated_cancelamiento_parcial_sem_impacto,
-
-  0 AS external_order_manual_venta_bruta,
-  0 AS external_order_manual_venta_bruta_sem_impacto,
-  0 AS external_order_manual_cancelamiento_total,
-  0 AS external_order_manual_cancelamiento_total_sem_impacto,
-  0 AS external_order_manual_cancelamiento_parcial,
-  0 AS external_order_manual_cancelamiento_parcial_sem_impacto
-
-FROM
-  cte_tld_manuales_no_asociables AS a
-
-"""
-)
+# DBTITLE 1,Materializacion de tld_br
+# tld_br is read by cte_nc, cte_proveedor_integradas, cte_tld_integradas, cte_tld_manuales and the pending-order
+# index, so the sales_transaction scan and its dimension joins are computed once per run. In INCREMENTAL mode this is
+# the only read of the whole TLD window besides ifood_indice_ventana.
+materialize_view("tld_br", storage_level="MEMORY_AND_DISK")
 
 # COMMAND ----------
 
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_temp_sin_integracion AS
-SELECT DISTINCT
-  '3PO' AS selector,
-  '3po sin integración' AS tipo_integracion,
-  null AS clave_concatenada,
-  null AS special_sale_storearea,
-  y.ownerships,
-  y.country_name_desc,
-  y.location_acronym_cd,
-  CONCAT(y.country_name_desc, '-', LEFT(y.location_acronym_cd, 3)) AS key,
-  null AS sales_date,
-  null AS fecha,
-  null AS sales_start_dttm,
-  null AS sales_end_dttm,
-  null AS sales_transaction_id,
-  y.pedido_associado_ifood AS special_sales_order,
-  null AS salekey,
-  null AS pos_register_id,
-  null AS pos_register_number,
-  null AS channel_name_desc,
-  null AS subchannel_name_desc,
-  null AS integrated,
-  null AS sales_type_id,
-  null AS venta_bruta,
-  null AS sales_transaction_id_nc,
-  null AS nc_duplicada,
-  null AS sales_date_nc,
-  null AS sales_start_dttm_nc,
-  null AS sales_end_dttm_nc,
-  null AS venta_bruta_nc,
-  null AS tiempo_reintegro_nc_seg,
-  null AS tiempo_reintegro_nc_min,
-  y.data_criacao_pedido_associado_gmt AS 3po_created_at,
-  y.data_faturamento_gmt AS 3po_updated_at,
-  DATEDIFF(SECOND, y.data_criacao_pedido_associado, y.data_faturamento) AS tiempo_proceso_3po_seg,
-  0 AS tiempo_recepcion_tld_seg,
-  0 AS tiempo_transaccion_tld_seg,
-  y.merchant_id,
-  y.merchant_name,
-  y.pedido_associado_ifood_curto AS payment_id,
-  y.fato_gerador AS 3po_status,
-  y.tipo_lancamento AS 3po_sub_status,
-  y.monto_cobrado AS 3po_amount_value,
-  y.valor_cancelado AS 3po_captured,
-  y.valor_compensado AS 3po_refunded,
-  0 AS 3po_cobro_integrado,
-  0 AS 3po_diferencia_cobro_integrada,
-  0 AS 3po_cancelacion_integrada,
-  0 AS 3po_diferencia_cancelacion_integrada,
-  0 AS 3po_cancelacion_parcial_integrada,
-  0 AS 3po_diferencia_cancelacion_parcial_integrada,
-  0 AS 3po_compensacion_integrada,
-  0 AS 3po_diferencia_compensacion_integrada,
-  0 AS 3po_compensacion_parcial_integrada,
-  0 AS 3po_diferencia_compensacion_parcial_integrada,
-
+# DBTITLE 1,Adaptador iFood para el motor de conciliacion
+cobro_3po = """CASE WHEN y.ressarcimento > 0
+      THEN y.cancelamento_total + y.cancelamento_parcial + y.cancelamento_parcial_sem_impacto + y.cancelamento_total_sem_impacto
+        + y.venda_bruta + y.venda_bruta_sem_impacto
+    ELSE y.venda_bruta + y.venda_bruta_sem_impacto
+  END"""
 
-  CASE
+cobro_3po_decimal = """CASE
     WHEN y.ressarcimento > 0
       THEN
         CAST(y.cancelamento_total AS DECIMAL)
@@ -1154,263 +766,218 @@ SELECT DISTINCT
     ELSE
       CAST(y.venda_bruta AS DECIMAL)
       + CAST(y.venda_bruta_sem_impacto AS DECIMAL)
-  END AS 3po_cobro_manual,
-
+  END"""
 
-  0 AS 3po_diferencia_cobro_manual,
+diferencia_cobro_3po = """CASE WHEN y.fato_gerador IN ('Venda', 'Ocorrencia Venda') THEN a.venta_bruta - y.monto_cobrado
+    WHEN y.fato_gerador = 'Cancelamento Parcial' THEN a.venta_bruta - y.monto_cobrado
+    WHEN y.fato_gerador = 'Ressarcimento/Indenização' AND y.valor_cancelado < y.monto_cobrado THEN a.venta_bruta - y.monto_cobrado
+    ELSE 0
+  END"""
 
-  CASE WHEN (
+cancelacion_3po = """CASE WHEN (
       y.cancelamento_total < 0 OR y.cancelamento_parcial < 0 OR y.cancelamento_total_sem_impacto
       < 0 OR y.cancelamento_parcial_sem_impacto < 0
     ) AND y.ressarcimento = 0
       THEN (y.cancelamento_total + y.cancelamento_parcial + y.cancelamento_parcial_sem_impacto + y.cancelamento_total_sem_impacto)
     ELSE 0
-  END AS 3po_cancelacion_manual,
-
-  0 AS 3po_diferencia_cancelacion_manual,
-
-  0 AS 3po_cancelacion_parcial_manual,
-
+  END"""
 
-  0 AS 3po_diferencia_cancelacion_parcial_manual,
-
-  CASE
-    WHEN y.ressarcimento > 0 AND y.outros_agg > 0 THEN y.ressarcimento + y.outros_agg
-    WHEN y.ressarcimento > 0 THEN y.ressarcimento
-    WHEN y.outros_agg > 0 THEN y.outros_agg
+diferencia_cancelacion_3po = """CASE WHEN y.fato_gerador = 'Cancelamento Total' THEN a.venta_bruta - y.valor_cancelado
     ELSE 0
-  END AS 3po_compensacion_manual,
-
-  0 AS 3po_diferencia_compensacion_manual,
-
-  0 AS 3po_compensacion_parcial_manual,
-
-  0 AS 3po_diferencia_compensacion_parcial_manual,
-  y.motivo_cancelamento AS 3po_motivo_cancelacion,
-  CASE WHEN y.fato_gerador = 'Ressarcimento/Indenização' THEN 'IFOOD'
-    WHEN y.fato_gerador IN ('Cancelamento Total', 'Cancelamento Parcial') THEN 'AD'
-  END AS 3po_responsable_cancelacion,
-
-  y.responsavel_transacao AS 3po_responsable_transaccion,
-
-  0 AS external_order_integrated_venta_bruta,
-  0 AS external_order_integrated_venta_bruta_sem_impacto,
-  0 AS external_order_integrated_cancelamiento_total,
-  0 AS external_order_integrated_cancelamiento_total_sem_impacto,
-  0 AS external_order_integrated_cancelamiento_parcial,
-  0 AS external_order_integrated_cancelamiento_parcial_sem_impacto,
-
-  y.venda_bruta AS external_order_manual_venta_bruta,
-  y.venda_bruta_sem_impacto AS external_order_manual_venta_bruta_sem_impacto,
-  y.cancelamento_total AS external_order_manual_cancelamiento_total,
-  y.cancelamento_total_sem_impacto AS external_order_manual_cancelamiento_total_sem_impacto,
-  y.cancelamento_parcial AS external_order_manual_cancelamiento_parcial,
-  y.cancelamento_parcial_sem_impacto AS external_order_manual_cancelamiento_parcial_sem_impacto
-
-
-FROM
-  cte_3po_manuales_no_asociadas AS y
-
-"""
-)
-
-# COMMAND ----------
-
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_temp_sin_integracion_1 AS
-SELECT DISTINCT
-  '3PO' AS selector,
-  '3po sin integración' AS tipo_integracion,
-  null AS clave_concatenada,
-  null AS special_sale_storearea,
-  y.ownerships,
-  y.country_name_desc,
-  y.location_acronym_cd,
-  CONCAT(y.country_name_desc, '-', LEFT(y.location_acronym_cd, 3)) AS key,
-  null AS sales_date,
-  null AS fecha,
-  null AS sales_start_dttm,
-  null AS sales_end_dttm,
-  null AS sales_transaction_id,
-  y.pedido_associado_ifood AS special_sales_order,
-  null AS salekey,
-  null AS pos_register_id,
-  null AS pos_register_number,
-  null AS channel_name_desc,
-  null AS subchannel_name_desc,
-  null AS integrated,
-  null AS sales_type_id,
-  null AS venta_bruta,
-  null AS sales_transaction_id_nc,
-  null AS nc_duplicada,
-  null AS sales_date_nc,
-  null AS sales_start_dttm_nc,
-  null AS sales_end_dttm_nc,
-  null AS venta_bruta_nc,
-  null AS tiempo_reintegro_nc_seg,
-  null AS tiempo_reintegro_nc_min,
-  y.data_criacao_pedido_associado_gmt AS 3po_created_at,
-  y.data_faturamento_gmt AS 3po_updated_at,
-  DATEDIFF(SECOND, y.data_criacao_pedido_associado, y.data_faturamento) AS tiempo_proceso_3po_seg,
-  0 AS tiempo_recepcion_tld_seg,
-  0 AS tiempo_transaccion_tld_seg,
-  y.merchant_id,
-  y.merchant_name,
-  y.pedido_associado_ifood_curto AS payment_id,
-  y.fato_gerador AS 3po_status,
-  y.tipo_lancamento AS 3po_sub_status,
-  y.monto_cobrado AS 3po_amount_value,
-  y.valor_cancelado AS 3po_captured,
-  y.valor_compensado AS 3po_refunded,
-  0 AS 3po_cobro_integrado,
-  0 AS 3po_diferencia_cobro_integrada,
-  0 AS 3po_cancelacion_integrada,
-  0 AS 3po_diferencia_cancelacion_integrada,
-  0 AS 3po_cancelacion_parcial_integrada,
-  0 AS 3po_diferencia_cancelacion_parcial_integrada,
-  0 AS 3po_compensacion_integrada,
-  0 AS 3po_diferencia_compensacion_integrada,
-  0 AS 3po_compensacion_parcial_integrada,
-  0 AS 3po_diferencia_compensacion_parcial_integrada,
-
-  CASE WHEN y.ressarcimento > 0
-      THEN y.cancelamento_total + y.cancelamento_parcial + y.cancelamento_parcial_sem_impacto + y.cancelamento_total_sem_impacto
-        + y.venda_bruta + y.venda_bruta_sem_impacto
-    ELSE y.venda_bruta + y.venda_bruta_sem_impacto
-  END
-  AS 3po_cobro_manual,
-
-  0 AS 3po_diferencia_cobro_manual,
-
+  END"""
 
-  CASE WHEN (
-      y.cancelamento_total < 0 OR y.cancelamento_parcial < 0 OR y.cancelamento_total_sem_impacto
-      < 0 OR y.cancelamento_parcial_sem_impacto < 0
-    ) AND y.ressarcimento = 0
-      THEN (y.cancelamento_total + y.cancelamento_parcial + y.cancelamento_parcial_sem_impacto + y.cancelamento_total_sem_impacto)
+diferencia_cancelacion_parcial_3po = """CASE WHEN y.fato_gerador = 'Cancelamento Parcial' THEN a.venta_bruta - y.valor_cancelado
     ELSE 0
-  END AS 3po_cancelacion_manual,
-
-  0 AS 3po_diferencia_cancelacion_manual,
-
-  0 AS 3po_cancelacion_parcial_manual,
-
+  END"""
 
-  0 AS 3po_diferencia_cancelacion_parcial_manual,
-
-  CASE
+compensacion_3po = """CASE
     WHEN y.ressarcimento > 0 AND y.outros_agg > 0 THEN y.ressarcimento + y.outros_agg
     WHEN y.ressarcimento > 0 THEN y.ressarcimento
     WHEN y.outros_agg > 0 THEN y.outros_agg
     ELSE 0
-  END AS 3po_compensacion_manual,
-
-  0 AS 3po_diferencia_compensacion_manual,
+  END"""
 
+diferencia_compensacion_parcial_3po = """CASE WHEN y.fato_gerador = 'Ressarcimento/Indenização' AND y.valor_cancelado < y.monto_cobrado THEN a.venta_bruta - y.valor_compensado
+    ELSE 0
+  END"""
 
-  0 AS 3po_compensacion_parcial_manual,
-
-  0 AS 3po_diferencia_compensacion_parcial_manual,
-
-  y.motivo_cancelamento AS 3po_motivo_cancelacion,
-  CASE WHEN y.fato_gerador = 'Ressarcimento/Indenização' THEN 'IFOOD'
+responsable_cancelacion_3po = """CASE WHEN y.fato_gerador = 'Ressarcimento/Indenização' THEN 'IFOOD'
     WHEN y.fato_gerador IN ('Cancelamento Total', 'Cancelamento Parcial') THEN 'AD'
-  END AS 3po_responsable_cancelacion,
-
-  y.responsavel_transacao AS 3po_responsable_transaccion,
-
-  0 AS external_order_integrated_venta_bruta,
-  0 AS external_order_integrated_venta_bruta_sem_impacto,
-  0 AS external_order_integrated_cancelamiento_total,
-  0 AS external_order_integrated_cancelamiento_total_sem_impacto,
-  0 AS external_order_integrated_cancelamiento_parcial,
-  0 AS external_order_integrated_cancelamiento_parcial_sem_impacto,
-
-  y.venda_bruta AS external_order_manual_venta_bruta,
-  y.venda_bruta_sem_impacto AS external_order_manual_venta_bruta_sem_impacto,
-  y.cancelamento_total AS external_order_manual_cancelamiento_total,
-  y.cancelamento_total_sem_impacto AS external_order_manual_cancelamiento_total_sem_impacto,
-  y.cancelamento_parcial AS external_order_manual_cancelamiento_parcial,
-  y.cancelamento_parcial_sem_impacto AS external_order_manual_cancelamiento_parcial_sem_impacto
-
-
-FROM
-  cte_3po_manuales_asociables AS y
-WHERE
-  NOT EXISTS (
-    SELECT 1
-    FROM
-      cte_tld_manuales_asociables AS a
-    WHERE
-      y.3po_concat = a.concat
-  )
-
-"""
-)
+  END"""
+
+# Amount rule table: (integrated column, manual column, integrated expression, manual expressions by branch)
+reglas_montos_3po = [
+    (
+        "3po_cobro_integrado",
+        "3po_cobro_manual",
+        cobro_3po,
+        {"manuales_asociadas": cobro_3po_decimal, "proveedor_duplicadas": cobro_3po_decimal, "proveedor_sin_match": cobro_3po},
+    ),
+    ("3po_diferencia_cobro_integrada", "3po_diferencia_cobro_manual", diferencia_cobro_3po, {"manuales_asociadas": diferencia_cobro_3po}),
+    ("3po_cancelacion_integrada", "3po_cancelacion_manual", cancelacion_3po, {"manuales_asociadas": cancelacion_3po, "solo_proveedor": cancelacion_3po}),
+    ("3po_diferencia_cancelacion_integrada", "3po_diferencia_cancelacion_manual", diferencia_cancelacion_3po, {"manuales_asociadas": diferencia_cancelacion_3po}),
+    ("3po_cancelacion_parcial_integrada", "3po_cancelacion_parcial_manual", None, {}),
+    (
+        "3po_diferencia_cancelacion_parcial_integrada",
+        "3po_diferencia_cancelacion_parcial_manual",
+        diferencia_cancelacion_parcial_3po,
+        {"manuales_asociadas": diferencia_cancelacion_parcial_3po},
+    ),
+    ("3po_compensacion_integrada", "3po_compensacion_manual", compensacion_3po, {"manuales_asociadas": compensacion_3po, "solo_proveedor": compensacion_3po}),
+    ("3po_diferencia_compensacion_integrada", "3po_diferencia_compensacion_manual", None, {}),
+    ("3po_compensacion_parcial_integrada", "3po_compensacion_parcial_manual", None, {}),
+    (
+        "3po_diferencia_compensacion_parcial_integrada",
+        "3po_diferencia_compensacion_parcial_manual",
+        diferencia_compensacion_parcial_3po,
+        {"manuales_asociadas": diferencia_compensacion_parcial_3po},
+    ),
+]
+
+columnas_external_order = [
+    ("venta_bruta", "venda_bruta"),
+    ("venta_bruta_sem_impacto", "venda_bruta_sem_impacto"),
+    ("cancelamiento_total", "cancelamento_total"),
+    ("cancelamiento_total_sem_impacto", "cancelamento_total_sem_impacto"),
+    ("cancelamiento_parcial", "cancelamento_parcial"),
+    ("cancelamiento_parcial_sem_impacto", "cancelamento_parcial_sem_impacto"),
+]
+
+dict_proveedor_ifood = {
+    "vista_tld": "tld_br",
+    "vista_proveedor": "cte_3po",
+    "tld_clave": "special_sale_order_new",
+    "tld_monto": "venta_bruta",
+    "proveedor_monto": "monto_cobrado",
+    "proveedor_clave": "pedido_associado_ifood",
+    "proveedor_id": "pedido_associado_ifood",
+    "llave_tld": {
+        "fecha": "CAST(a.sales_end_dttm AS DATE)",
+        "local": "LEFT(a.location_name, 3)",
+        "monto": "CAST(CAST(a.venta_bruta AS DECIMAL(10, 2)) * 100 AS BIGINT)",
+    },
+    "llave_proveedor": {
+        "fecha": "CAST(y.data_criacao_pedido_associado_gmt AS DATE)",
+        "local": "y.location_acronym_cd",
+        "monto": "CAST(CAST(y.monto_cobrado AS DECIMAL(10, 2)) * 100 AS BIGINT)",
+    },
+    "concat_tld": "CONCAT(CAST(a.sales_end_dttm AS DATE), LEFT(a.location_name, 3), CAST(a.venta_bruta AS DECIMAL(10, 2)))",
+    "concat_proveedor": "CONCAT(CAST(y.data_criacao_pedido_associado_gmt AS DATE), y.location_acronym_cd, CAST(y.monto_cobrado AS DECIMAL(10, 2)))",
+    "tld_manuales": "NO_INTEGRADAS",
+    "columnas": [
+        reconciliation_column("selector", "'3PO'"),
+        reconciliation_column(
+            "tipo_integracion",
+            integradas="'Integradas'",
+            manuales_asociadas="'Manuales asociadas'",
+            solo_tld="'Manuales no asociadas'",
+            solo_proveedor="'3po sin integración'",
+        ),
+        reconciliation_column(
+            "clave_concatenada",
+            manuales_asociadas="a.concat_tld",
+            tld_manuales_sin_match="a.concat_tld",
+            tld_manuales_duplicadas="a.concat_tld",
+        ),
+        reconciliation_column("special_sale_storearea", tld="a.special_sale_storearea"),
+        reconciliation_column("ownerships", tld="a.ownerships", proveedor="y.ownerships"),
+        reconciliation_column("country_name_desc", tld="a.country_name_desc", proveedor="y.country_name_desc"),
+        reconciliation_column("location_acronym_cd", tld="LEFT(a.location_name, 3)", proveedor="y.location_acronym_cd"),
+        reconciliation_column(
+            "key",
+            tld="CONCAT(a.country_name_desc, '-', LEFT(a.location_name, 3))",
+            proveedor="CONCAT(y.country_name_desc, '-', LEFT(y.location_acronym_cd, 3))",
+        ),
+        reconciliation_column("sales_date", tld="a.sales_date"),
+        reconciliation_column("fecha", tld="a.fecha"),
+        reconciliation_column("sales_start_dttm", tld="a.sales_start_dttm"),
+        reconciliation_column("sales_end_dttm", tld="a.sales_end_dttm"),
+        reconciliation_column("sales_transaction_id", tld="a.sales_transaction_id"),
+        reconciliation_column(
+            "special_sale_order_new",
+            tld="a.special_sale_order_new",
+            proveedor="y.pedido_associado_ifood",
+            manuales_asociadas="COALESCE(y.pedido_associado_ifood, a.special_sale_order_new)",
+        ),
+        reconciliation_column("salekey", tld="a.salekey"),
+        reconciliation_column("pos_register_id", tld="a.pos_register_id"),
+        reconciliation_column("pos_register_number", tld="SUBSTRING(a.pos_register_id, 0, CHARINDEX('_', a.pos_register_id) - 1)"),
+        reconciliation_column("channel_name_desc", tld="a.channel_name_desc"),
+        reconciliation_column("subchannel_name_desc", tld="a.subchannel_name_desc"),
+        reconciliation_column("integrated", tld="a.integrated"),
+        reconciliation_column("sales_type_id", tld="a.sales_type_id"),
+        reconciliation_column("venta_bruta", tld="a.venta_bruta"),
+        reconciliation_column("sales_transaction_id_nc", integradas="nc.sales_transaction_id"),
+        reconciliation_column("nc_duplicada", integradas="CASE WHEN nc.nc_repeticiones > 1 THEN 1 ELSE 0 END"),
+        reconciliation_column("sales_date_nc", integradas="nc.sales_date"),
+        reconciliation_column("sales_start_dttm_nc", integradas="nc.sales_start_dttm"),
+        reconciliation_column("sales_end_dttm_nc", integradas="nc.sales_end_dttm"),
+        reconciliation_column("venta_bruta_nc", integradas="nc.venta_bruta_nc"),
+        reconciliation_column("tiempo_reintegro_nc_seg", integradas="DATEDIFF(SECOND, a.sales_end_dttm, nc.sales_end_dttm)"),
+        reconciliation_column("tiempo_reintegro_nc_min", integradas="DATEDIFF(MINUTE, a.sales_end_dttm, nc.sales_end_dttm)"),
+        reconciliation_column("3po_created_at", proveedor="y.data_criacao_pedido_associado_gmt"),
+        reconciliation_column("3po_updated_at", proveedor="y.data_faturamento_gmt"),
+        reconciliation_column("tiempo_proceso_3po_seg", proveedor="DATEDIFF(SECOND, y.data_criacao_pedido_associado, y.data_faturamento)"),
+        reconciliation_column(
+            "tiempo_recepcion_tld_seg",
+            conciliadas="DATEDIFF(SECOND, y.data_criacao_pedido_associado_gmt, a.sales_start_dttm)",
+            solo_proveedor="0",
+        ),
+        reconciliation_column(
+            "tiempo_transaccion_tld_seg",
+            tld="DATEDIFF(SECOND, a.sales_start_dttm, a.sales_end_dttm)",
+            solo_proveedor="0",
+        ),
+        reconciliation_column("merchant_id", proveedor="y.merchant_id"),
+        reconciliation_column("merchant_name", proveedor="y.merchant_name"),
+        reconciliation_column("payment_id", proveedor="y.pedido_associado_ifood_curto"),
+        reconciliation_column("3po_status", proveedor="y.fato_gerador"),
+        reconciliation_column("3po_sub_status", proveedor="y.tipo_lancamento"),
+        reconciliation_column("3po_amount_value", proveedor="y.monto_cobrado"),
+        reconciliation_column("3po_captured", proveedor="y.valor_cancelado"),
+        reconciliation_column("3po_refunded", proveedor="y.valor_compensado"),
+    ]
+    + reconciliation_amount_columns(reglas_montos_3po)
+    + [
+        reconciliation_column("3po_motivo_cancelacion", proveedor="y.motivo_cancelamento"),
+        reconciliation_column("3po_responsable_cancelacion", proveedor=responsable_cancelacion_3po),
+        reconciliation_column("3po_responsable_transaccion", proveedor="y.responsavel_transacao"),
+    ]
+    + reconciliation_amount_columns([
+        (f"external_order_integrated_{nombre}", f"external_order_manual_{nombre}", f"y.{columna}", {"manuales_asociadas": f"y.{columna}", "solo_proveedor": f"y.{columna}"})
+        for nombre, columna in columnas_external_order
+    ]),
+}
 
 # COMMAND ----------
 
-# DBTITLE 1,Creacion de la tabla cte_temp con union de las demas tablas
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_temp AS
-
-SELECT *
-FROM
-  cte_temp_integradas
-
-UNION DISTINCT
-
-SELECT *
-FROM
-  cte_temp_manuales_asociadas
-
-UNION DISTINCT
-
-SELECT *
-FROM
-  cte_temp_manuales_no_asociadas
-
-UNION DISTINCT
-
-SELECT *
-FROM
-  cte_temp_sin_integracion
-
-UNION DISTINCT
-
-SELECT *
-FROM
-  cte_temp_sin_integracion_1
-
-"""
-)
+# DBTITLE 1,Creacion de la tabla cte_temp con el motor de conciliacion
+build_reconciliation(dict_proveedor_ifood)
+assert_reconciliation_checkpoints(run_metrics_table_name, "TR_DETECCION_FRAUDES_IFOOD", pipeline_run_id, ["086"])
 
 # COMMAND ----------
 
+# Ordered rule table: the first matching rule sets the status
+reglas_estado_transaccion_3po = [
+    ("3po_status = 'Ressarcimento/Indenização' AND `3po_captured` < `3po_amount_value` AND sales_transaction_id IS NOT NULL", "'Compensada parcialmente'"),
+    ("3po_status = 'Ressarcimento/Indenização' AND `3po_captured` >= `3po_amount_value` AND sales_transaction_id IS NOT NULL", "'Compensada'"),
+    ("3po_status = 'Cancelamento Parcial' AND sales_transaction_id IS NOT NULL", "'Cancelada parcialmente'"),
+    ("3po_status = 'Cancelamento Total' AND sales_transaction_id IS NOT NULL", "'Cancelada'"),
+    ("3po_status = 'Venda' AND sales_transaction_id IS NOT NULL", "'Cobrada'"),
+    ("3po_status = 'Ocorrencia Venda' AND sales_transaction_id IS NOT NULL", "'Cobrada por tercero'"),
+    ("sales_transaction_id IS NULL OR 3po_status IS NULL", "'No encontrada'"),
+]
 
-spark.sql(f"""
+run_view_sql(f"""
 
 CREATE OR REPLACE TEMP VIEW cte_temp2 AS
 SELECT
   CASE WHEN fecha IS null THEN CAST(`3po_created_at` AS DATE) ELSE CAST(fecha AS DATE) END AS sales_business_dt,
   *,
 
-  CASE
-    WHEN 3po_status = 'Ressarcimento/Indenização' AND `3po_captured` < `3po_amount_value` AND sales_transaction_id IS NOT null THEN 'Compensada parcialmente'
-    WHEN 3po_status = 'Ressarcimento/Indenização' AND `3po_captured` >= `3po_amount_value` AND sales_transaction_id IS NOT null THEN 'Compensada'
-    WHEN 3po_status = 'Cancelamento Parcial' AND sales_transaction_id IS NOT null THEN 'Cancelada parcialmente'
-    WHEN 3po_status = 'Cancelamento Total' AND sales_transaction_id IS NOT null THEN 'Cancelada'
-    WHEN 3po_status = 'Venda' AND sales_transaction_id IS NOT null THEN 'Cobrada'
-    WHEN 3po_status = 'Ocorrencia Venda' AND sales_transaction_id IS NOT null THEN 'Cobrada por tercero'
-    WHEN sales_transaction_id IS null OR 3po_status IS null THEN 'No encontrada'
-  END AS estado_transacccion,
-
-  CASE WHEN nc_duplicada = 1 THEN 'Nota de crédito duplicada'
-    WHEN sales_transaction_id_nc IS null THEN 'No aplica NC'
-    WHEN sales_transaction_id_nc IS NOT null THEN 'Nota de crédito aplicada'
-  END AS estado_nc,
+  {status_case_sql(reglas_estado_transaccion_3po)} AS estado_transacccion,
+
+  {status_case_sql(ESTADO_NC_REGLAS)} AS estado_nc,
 
   ROW_NUMBER() OVER (
     PARTITION BY sales_transaction_id
@@ -1427,31 +994,17 @@ FROM
 # COMMAND ----------
 
 # DBTITLE 1,Cruce con currency_rate
-
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW cte_currency_rate AS
-
-SELECT
-  cr.source_currency_cd,
-  DATE_FORMAT(cr.curr_trans_calendar_dt, 'yMM') AS calendar_month_id,
-  cr.source_to_target_currency_rate
-FROM
-  {l2_foundation_catalog_name}.common.hist_currency_translation_rate AS cr
-WHERE
-  cr.currency_type_id = 4
-  AND CURRENT_DATE BETWEEN cr.curr_translation_rate_start_dt AND cr.curr_translation_rate_end_dt
-
-"""
-)
+# Shared (currency, yyyyMM) lookup, rebuilt only when the rate table changes
+currency_rate_lookup_name = f"{table_full_name.rsplit('.', 1)[0]}.deteccion_fraudes_currency_rate"
+create_currency_rate_view(currency_rate_lookup_name, f"{l2_foundation_catalog_name}.common.hist_currency_translation_rate")
 
 # COMMAND ----------
 
-spark.sql(f"""
+run_view_sql(f"""
 
 CREATE OR REPLACE TEMP VIEW ifood_vista AS
-SELECT
-  DATE_FORMAT(sales_business_dt, 'yMM') AS calendar_month_id,
+SELECT /*+ BROADCAST(cr) */
+  CAST({month_key_sql("sales_business_dt")} AS STRING) AS calendar_month_id,
   cr.source_to_target_currency_rate,
   sales_business_dt,
   selector,
@@ -1553,7 +1106,7 @@ FROM
     cte_currency_rate AS cr
     ON
       c.currency_cd = cr.source_currency_cd
-      AND DATE_FORMAT(sales_business_dt, 'yMM') = cr.calendar_month_id
+      AND {month_key_sql("sales_business_dt")} = cr.calendar_month_id
 
 """
 )
@@ -1561,7 +1114,7 @@ FROM
 # COMMAND ----------
 
 # DBTITLE 1,Creacion de tabla temporal final
-spark.sql(f"""
+run_view_sql(f"""
 
 CREATE OR REPLACE TEMP VIEW deteccion_fraudes_ifood_temp AS
 SELECT *
@@ -1571,6 +1124,13 @@ FROM
 """
 )
 
+check_shuffle_column_pruning("deteccion_fraudes_ifood_temp", [f"{l2_foundation_catalog_name}.cancelaciones.tr_ifood_reconciliation"])
+
+# The MERGE, its scope and the pending-order index read these views; on DuckDB they are replaced by their rows
+export_single_node_views(
+    ["deteccion_fraudes_ifood_temp", "tld_br"] + (["ifood_claves_afectadas"] if load_mode == "INCREMENTAL" else [])
+)
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -1578,14 +1138,48 @@ FROM
 
 # COMMAND ----------
 
-sql_clause = f""" sales_business_dt BETWEEN '{fecha_desde - timedelta(days=1)}T00:00:00.000' AND '{fecha_ayer}T23:59:59.999'"""
+sql_clause = f""" sales_business_dt BETWEEN '{fecha_inicio_tld}T00:00:00.000' AND '{fecha_ayer}T23:59:59.999'"""
+
+if load_mode == "INCREMENTAL":
+    # Only the rows rebuilt in this run are replaced: every affected key, plus the previous rows of
+    # the TLD transactions that were reclassified through their manual-matching group. The key lists
+    # are inlined in the MERGE condition, so the temp view is kept for them and for the MERGE.
+    materialize_view("deteccion_fraudes_ifood_temp")
+    sql_clause += f"""
+    AND (
+      {values_in_sql("special_sale_order", "ifood_claves_afectadas")}
+      OR {values_in_sql("special_sale_order", "deteccion_fraudes_ifood_temp")}
+      OR {values_in_sql("sales_transaction_id", "deteccion_fraudes_ifood_temp")}
+    )"""
+
+if fechas_tardias:
+    # Late orders are rebuilt whole, whatever the date of their previous rows
+    sql_clause = f""" ({sql_clause})
+    OR {values_in_sql("special_sale_order", "ordenes_tardias")}"""
+
+# COMMAND ----------
+
+load_table_merge(f"{table_full_name}",
+                 'DETECCION_FRAUDES_IFOOD_TEMP',
+                 dict_table_metadata["primary_key"],
+                 sql_clause,
+                 run_id=pipeline_run_id,
+                 optimize_flg=execution_mode != "RANGE",
+                 vacuum_flg=execution_mode != "RANGE" and vacuum_due(fecha_hasta_str)
+                 )
+
+# COMMAND ----------
+
+if execution_mode != "RANGE":
+    save_watermarks(watermark_table_name, dict_incremental_sources, current_watermarks, pipeline_run_id)
+
+# In INCREMENTAL mode tld_br holds the rebuilt sales only; the others were registered by the run that loaded them.
+register_pending_orders(pending_orders_table_name, "tld_br", "special_sale_order_new", "venta_bruta", "fecha", ["086"], fecha_hasta_str, pipeline_run_id)
+
+# COMMAND ----------
+
+save_run_metrics(run_metrics_table_name, "TR_DETECCION_FRAUDES_IFOOD", pipeline_run_id, ["086"])
 
 # COMMAND ----------
 
-load_table_replace(f"{table_full_name}", 
-                      'DETECCION_FRAUDES_IFOOD_TEMP',
-                      sql_clause,
-                      vacuum_retain_days=1,
-                      run_id=pipeline_run_id,
-                      optimize_flg=True
-                      )
\ No newline at end of file
+release_materialized_views()
@@ -0,0 +1,2639 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC Descripcion : Funciones compartidas por las notebooks de deteccion de fraudes (iFood y Yuno)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 1. Watermarks for incremental loads
+# MAGIC
+
+# COMMAND ----------
+
+import re
+
+
+def create_watermark_table(watermark_table_name):
+    """Create the control table that keeps one high-water mark per source table."""
+    spark.sql(f"""
+
+    CREATE TABLE IF NOT EXISTS {watermark_table_name} (
+      source_name STRING COMMENT 'Nombre logico de la tabla origen.',
+      source_table_name STRING COMMENT 'Nombre completo de la tabla origen.',
+      watermark_value TIMESTAMP COMMENT 'Ultimo adls_audit_date procesado de la tabla origen.',
+      pipeline_run_id STRING COMMENT 'Ejecucion que registro el watermark.',
+      updated_at TIMESTAMP COMMENT 'Fecha de actualizacion del watermark.'
+    )
+    COMMENT 'Watermarks por tabla origen para la carga incremental de deteccion de fraudes.'
+
+    """
+    )
+
+    enable_row_level_concurrency(watermark_table_name)
+
+
+def get_watermarks(watermark_table_name, source_names):
+    """Return {source_name: watermark_value} for the given sources, None when never loaded."""
+    rows = spark.sql(f"""
+
+    SELECT source_name, watermark_value
+    FROM
+      {watermark_table_name}
+
+    """
+    ).collect()
+
+    stored = {row["source_name"]: row["watermark_value"] for row in rows}
+    return {source_name: stored.get(source_name) for source_name in source_names}
+
+
+def get_source_high_water_marks(dict_sources, audit_column="adls_audit_date"):
+    """Read the current max audit timestamp of every source table.
+
+    The values are captured before the sources are read, so rows committed while the
+    run is in progress are picked up again by the next run instead of being skipped.
+    """
+    high_water_marks = {}
+    for source_name, source_table_name in dict_sources.items():
+        high_water_marks[source_name] = spark.sql(f"""
+
+        SELECT MAX({audit_column}) AS watermark_value
+        FROM
+          {source_table_name}
+
+        """
+        ).collect()[0]["watermark_value"]
+
+    return high_water_marks
+
+
+def save_watermarks(watermark_table_name, dict_sources, dict_watermarks, run_id):
+    """Upsert the high-water marks reached by a successful run, touching only the rows of its own sources."""
+    values = ",\n      ".join(
+        f"('{source_name}', '{dict_sources[source_name]}', "
+        f"{'NULL' if watermark_value is None else repr(str(watermark_value))})"
+        for source_name, watermark_value in dict_watermarks.items()
+    )
+
+    run_delta_write(watermark_table_name, lambda: spark.sql(f"""
+
+    MERGE INTO {watermark_table_name} AS t
+    USING (
+      SELECT
+        source_name,
+        source_table_name,
+        CAST(watermark_value AS TIMESTAMP) AS watermark_value
+      FROM
+        VALUES
+          {values} AS v(source_name, source_table_name, watermark_value)
+    ) AS s
+    ON
+      t.source_name IN ({", ".join(sql_literal(source_name) for source_name in dict_watermarks)})
+      AND t.source_name = s.source_name
+    WHEN MATCHED THEN UPDATE SET
+      t.source_table_name = s.source_table_name,
+      t.watermark_value = s.watermark_value,
+      t.pipeline_run_id = '{run_id}',
+      t.updated_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (source_name, source_table_name, watermark_value, pipeline_run_id, updated_at)
+      VALUES (s.source_name, s.source_table_name, s.watermark_value, '{run_id}', CURRENT_TIMESTAMP())
+
+    """
+    ))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 2. Keyed MERGE writer
+# MAGIC
+# MAGIC Table maintenance: every MERGE rewrites files and adds deletion vectors. Scheduled runs OPTIMIZE the target after
+# MAGIC the MERGE (`optimize_flg`), which on a liquid-clustered table only compacts and clusters the new files. Once a
+# MAGIC week, on `VACUUM_WEEKDAY` of the window end, they also VACUUM it (`vacuum_flg`) with `VACUUM_RETAIN_DAYS`, the
+# MAGIC retention of the former delete-and-rewrite load. Backfill chunks skip both; the backfill runs them once at the end.
+
+# COMMAND ----------
+
+AUDIT_COLUMNS = ["adls_audit_run_id", "adls_audit_date"]
+
+SQL_STRING_LITERAL_PATTERN = re.compile(r"('(?:[^']|'')*')")
+
+
+def sql_literal(value):
+    """Render a Python value as a SQL literal."""
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def values_in_sql(column, view_name, value_column=None):
+    """Render `column IN (...)` with the distinct non-null values of a view, or FALSE when it has none.
+
+    sql_clause of load_table_merge is part of the MERGE condition, where Delta does not accept
+    subqueries, so key lists taken from views are inlined with this instead.
+    """
+    value_column = value_column or column
+    values = [row[0] for row in collect_sql(f"SELECT DISTINCT {value_column} FROM {view_name} WHERE {value_column} IS NOT NULL")]
+    return literal_in_sql(column, values)
+
+
+def literal_in_sql(column, values):
+    """Render `column IN (...)` with the non-null values given, or FALSE when there are none."""
+    values = sorted({value for value in values if value is not None})
+    if not values:
+        return "FALSE"
+    return f"{column} IN (" + ", ".join(sql_literal(value) for value in values) + ")"
+
+
+def qualify_columns_sql(sql_text, columns, alias):
+    """Prefix every unqualified reference to `columns` in sql_text with `alias`, leaving string literals untouched."""
+    names = "|".join(re.escape(column) for column in sorted(columns, key=len, reverse=True))
+    pattern = re.compile(rf"(?<![\w.`])`?({names})`?(?![\w`(])", re.IGNORECASE)
+    parts = SQL_STRING_LITERAL_PATTERN.split(sql_text)
+    return "".join(
+        part if index % 2 else pattern.sub(lambda match: f"{alias}.`{match.group(1)}`", part)
+        for index, part in enumerate(parts)
+    )
+
+
+def load_table_merge(table_name, temp_view_name, key_columns, sql_clause, run_id, hash_column="row_hash", optimize_flg=False, vacuum_flg=False):
+    """Write a temp view into the target table touching only the rows that changed.
+
+    Every source row gets a content hash (all columns except the audit columns). Rows are grouped on
+    key_columns plus that hash and each group is compared by its number of copies on both sides: a
+    group present with the same count in the source and inside sql_clause of the target is neither
+    rewritten nor inserted again. Otherwise its target copies are deleted and its source copies
+    inserted, which leaves the table exactly as a delete-and-rewrite of sql_clause would, duplicated
+    rows included, in a single MERGE. Matching on the hash as well as the key keeps the writer valid
+    for keys that are not unique, such as null special_sale_order. Rows loaded before the hash
+    column existed have a NULL hash and are replaced on the first run.
+
+    sql_clause is also added to the MERGE condition against the target alias, so Delta only reads
+    the files of that scope and checks concurrent writes against it. It must not hold subqueries;
+    inline key lists with values_in_sql.
+
+    optimize_flg and vacuum_flg run optimize_table and vacuum_table on the target after the MERGE.
+    """
+    if re.search(r"\bSELECT\b", SQL_STRING_LITERAL_PATTERN.sub("''", sql_clause), re.IGNORECASE):
+        raise ValueError(f"sql_clause of {table_name} is part of the MERGE condition and cannot hold subqueries: {sql_clause}")
+
+    target_columns = spark.table(table_name).columns
+    source_columns = spark.table(temp_view_name).columns
+
+    excluded_columns = {column.lower() for column in AUDIT_COLUMNS + [hash_column]}
+    hashed_columns = [column for column in source_columns if column.lower() not in excluded_columns]
+    written_columns = [column for column in target_columns if column.lower() in {c.lower() for c in source_columns + [hash_column]}]
+
+    missing_columns = [column for column in source_columns if column.lower() not in {c.lower() for c in target_columns}]
+    if missing_columns:
+        raise ValueError(f"Columns {missing_columns} of {temp_view_name} do not exist in {table_name}.")
+
+    match_condition = " AND ".join([f"t.`{column}` <=> s.`{column}`" for column in key_columns] + [f"t.`{hash_column}` <=> s.`{hash_column}`"])
+    target_scope = qualify_columns_sql(sql_clause, target_columns, "t")
+    hashed_struct = ", ".join(f"`{column}`" for column in hashed_columns)
+    key_list = ", ".join(f"`{column}`" for column in key_columns)
+
+    spark.sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW {temp_view_name}_merge_source AS
+    SELECT
+      *,
+      COUNT(*) OVER (PARTITION BY {key_list}, `{hash_column}`) AS merge_copies
+    FROM
+      (SELECT *, SHA2(TO_JSON(STRUCT({hashed_struct})), 256) AS `{hash_column}` FROM {temp_view_name})
+
+    """
+    )
+
+    # The source is read by both sides of the diff, so it is computed once and kept for the MERGE.
+    with track_stage(f"{temp_view_name}_merge_source", "CACHE"):
+        spark.sql(f"CACHE TABLE {temp_view_name}_merge_source")
+
+    spark.sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW {temp_view_name}_merge_target AS
+    SELECT {key_list}, `{hash_column}`, COUNT(*) AS merge_copies
+    FROM
+      {table_name}
+    WHERE
+      {sql_clause}
+    GROUP BY {key_list}, `{hash_column}`
+
+    """
+    )
+
+    # Only the difference between source and target reaches the MERGE: the source copies of every
+    # changed group to insert and one row per stale target group, whose copies are all deleted.
+    spark.sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW {temp_view_name}_merge_diff AS
+    SELECT
+      s.*,
+      'INSERT' AS merge_action
+    FROM
+      {temp_view_name}_merge_source AS s
+    WHERE
+      NOT EXISTS (SELECT 1 FROM {temp_view_name}_merge_target AS t WHERE {match_condition} AND t.merge_copies = s.merge_copies)
+
+    UNION ALL
+
+    SELECT
+      {", ".join(f"t.`{column}`" if column.lower() in {c.lower() for c in key_columns + [hash_column]} else f"NULL AS `{column}`" for column in source_columns + [hash_column])},
+      t.merge_copies,
+      'DELETE' AS merge_action
+    FROM
+      {temp_view_name}_merge_target AS t
+    WHERE
+      NOT EXISTS (SELECT 1 FROM {temp_view_name}_merge_source AS s WHERE {match_condition} AND s.merge_copies = t.merge_copies)
+
+    """
+    )
+
+    with track_stage(table_name, "MERGE"):
+        merge_metrics = run_delta_write(table_name, lambda: spark.sql(f"""
+
+        MERGE INTO {table_name} AS t
+        USING {temp_view_name}_merge_diff AS s
+        ON
+          {match_condition}
+          AND s.merge_action = 'DELETE'
+          AND ({target_scope})
+        WHEN MATCHED THEN DELETE
+        WHEN NOT MATCHED AND s.merge_action = 'INSERT' THEN INSERT ({", ".join(f"`{column}`" for column in written_columns)})
+          VALUES ({", ".join(f"s.`{column}`" for column in written_columns)})
+
+        """
+        ).collect())
+
+    spark.sql(f"UNCACHE TABLE IF EXISTS {temp_view_name}_merge_source")
+
+    # The MERGE returns its own row counts; the latest history entry may belong to another market's unit.
+    print(f"MERGE into {table_name} (run {run_id}):")
+    for metric, value in (merge_metrics[0].asDict() if merge_metrics else {}).items():
+        print(f"  {metric}: {value}")
+
+    if optimize_flg:
+        optimize_table(table_name)
+    if vacuum_flg:
+        vacuum_table(table_name)
+
+
+table_layouts = {}
+
+
+def apply_table_layout(table_name, dict_table_metadata):
+    """Apply the physical layout declared in dict_table_metadata to a Delta table, on create and on alter.
+
+    `cluster_by` declares liquid-clustering keys and is applied with ALTER TABLE ... CLUSTER BY whenever the table's
+    clustering columns differ. `zorder_by` is used instead on tables that cannot be clustered (partitioned tables)
+    and is applied by the next OPTIMIZE. Without either key the table is left as is.
+    """
+    cluster_by = dict_table_metadata.get("cluster_by") or []
+    zorder_by = dict_table_metadata.get("zorder_by") or []
+
+    detail = spark.sql(f"DESCRIBE DETAIL {table_name}").collect()[0].asDict()
+    partition_columns = detail.get("partitionColumns") or []
+    clustering_columns = detail.get("clusteringColumns") or []
+
+    if cluster_by and partition_columns:
+        # Liquid clustering and partitioning are exclusive; keep the partitions and Z-order on the same keys.
+        print(f"{table_name} is partitioned by {partition_columns}; using ZORDER BY {cluster_by} instead of CLUSTER BY.")
+        zorder_by = zorder_by or [column for column in cluster_by if column not in partition_columns]
+        cluster_by = []
+
+    if cluster_by and [c.lower() for c in clustering_columns] != [c.lower() for c in cluster_by]:
+        spark.sql(f"ALTER TABLE {table_name} CLUSTER BY ({', '.join(f'`{column}`' for column in cluster_by)})")
+        print(f"{table_name} clustered by {cluster_by} (was {clustering_columns or 'not clustered'}).")
+
+    table_layouts[table_name] = {"cluster_by": cluster_by, "zorder_by": zorder_by}
+
+
+def optimize_table(table_name):
+    """Compact a table, clustering or Z-ordering it by the layout registered with apply_table_layout."""
+    zorder_by = table_layouts.get(table_name, {}).get("zorder_by")
+
+    with track_stage(table_name, "OPTIMIZE"):
+        if zorder_by:
+            spark.sql(f"OPTIMIZE {table_name} ZORDER BY ({', '.join(f'`{column}`' for column in zorder_by)})")
+        else:
+            # On a liquid-clustered table a plain OPTIMIZE incrementally clusters the new files.
+            spark.sql(f"OPTIMIZE {table_name}")
+
+
+VACUUM_RETAIN_DAYS = 1
+VACUUM_WEEKDAY = 6  # Sunday, as date.weekday()
+
+
+def vacuum_due(fecha):
+    """True when the weekly VACUUM falls on fecha (a date or a YYYY-MM-DD string), the window end of a scheduled run."""
+    if isinstance(fecha, str):
+        fecha = date.fromisoformat(fecha)
+    return fecha.weekday() == VACUUM_WEEKDAY
+
+
+def vacuum_table(table_name, retain_days=VACUUM_RETAIN_DAYS):
+    """Remove the files no version of the last retain_days still reads, those replaced by the MERGE and OPTIMIZE."""
+    if retain_days * 24 < 168:
+        # Delta refuses a retention under its 7-day default unless the safety check is turned off
+        spark.conf.set("spark.databricks.delta.retentionDurationCheck.enabled", "false")
+
+    with track_stage(table_name, "VACUUM"):
+        spark.sql(f"VACUUM {table_name} RETAIN {retain_days * 24} HOURS")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 3. Materialization of shared base views
+# MAGIC
+
+# COMMAND ----------
+
+materialized_views = []
+
+
+def materialize_view(view_name, storage_level="MEMORY_AND_DISK"):
+    """Persist a temp view once so every downstream view reads the cached copy.
+
+    CACHE TABLE stores the view in Spark's compressed columnar in-memory format and is eager, so the
+    source scan and joins of the view run exactly once. Views defined on top of it are matched
+    against the cached plan and read the copy instead of re-evaluating it.
+    """
+    with track_stage(view_name, "CACHE"):
+        if sql_backend == "DUCKDB":
+            materialize_single_node_view(view_name)
+        else:
+            spark.sql(f"CACHE TABLE {view_name} OPTIONS ('storageLevel' '{storage_level}')")
+    materialized_views.append(view_name)
+
+    print(f"Materialized view {view_name} ({storage_level}).")
+
+
+def cache_table_as(view_name, select_sql, storage_level="MEMORY_ONLY"):
+    """Create view_name from select_sql and persist it at once (CACHE TABLE ... AS) on the active SQL backend."""
+    if sql_backend == "DUCKDB":
+        spark.sql(f"CREATE OR REPLACE TEMP VIEW {view_name} AS {select_sql}")
+        create_single_node_view(view_name, select_sql, materialize=True)
+    else:
+        spark.sql(f"CACHE TABLE {view_name} OPTIONS ('storageLevel' '{storage_level}') AS {select_sql}")
+    materialized_views.append(view_name)
+
+
+def release_materialized_views():
+    """Drop every cached copy created by materialize_view during the run."""
+    while materialized_views:
+        view_name = materialized_views.pop()
+        spark.sql(f"UNCACHE TABLE IF EXISTS {view_name}")
+
+        print(f"Released view {view_name}.")
+
+    close_single_node_connection()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 4. Reconciliation engine
+# MAGIC
+# MAGIC Both notebooks run the same pipeline: TLD base, credit notes, integrated matching on the order id, manual matching
+# MAGIC on the date + location + amount concat key, duplicate concat splitting and the classification of every row into its
+# MAGIC output branch. The engine builds those views from a provider adapter (`dict_proveedor`), so each notebook only
+# MAGIC defines its source views and how every output column is computed in each branch.
+# MAGIC
+# MAGIC Adapter keys:
+# MAGIC - `vista_tld` / `vista_proveedor`: base views of each side (TLD sales and provider payments, one row per payment).
+# MAGIC - `tld_clave` / `proveedor_clave`: order id column used for integrated matching on each side.
+# MAGIC - `tld_monto`: TLD gross sale amount column.
+# MAGIC - `proveedor_monto`: provider amount column, only summed by the checkpoints.
+# MAGIC - `proveedor_id`: provider row identifier used to tell manual rows from integrated ones.
+# MAGIC - `llave_tld` / `llave_proveedor`: components of the manual matching key of each side (aliases `a` and `y`): `fecha`
+# MAGIC   (DATE), `local` (location code) and `monto` (amount in integer units). They are hashed into the BIGINT `llave_manual`.
+# MAGIC - `concat_tld` / `concat_proveedor`: readable concat key of each side, only used for the `clave_concatenada` output.
+# MAGIC - `tld_manuales`: `NO_INTEGRADAS` (every sale without an integrated match) or `SIN_CLAVE` (only sales without order id;
+# MAGIC   sales with an order id but no provider row get their own branch).
+# MAGIC - `columnas`: output columns built with `reconciliation_column`; the integrated/manual amount pairs come from a rule
+# MAGIC   table expanded by `reconciliation_amount_columns`.
+# MAGIC
+# MAGIC Skew: NULL, empty and blank order ids never take part in integrated matching. Rows without a match key join on a
+# MAGIC per-side surrogate, so they do not pile up in one task. The manual key counts use a GROUP BY plus a salted join for
+# MAGIC keys above `SKEW_HOT_KEY_ROWS`. The rows per key are recorded as SKEW stages of the run metrics; the integrated
+# MAGIC order ids only with `RUN_METRICS_FORCE_COUNT`.
+# MAGIC
+# MAGIC Checkpoints: with `RECONCILIATION_CHECKPOINTS` the engine aggregates the base views and the two conciliation views
+# MAGIC in one pass each. It records rows, distinct provider ids and the sums of `tld_monto` / `proveedor_monto` as
+# MAGIC CHECKPOINT stages. The conciliation views are materialized first, so their aggregates read the cached rows that
+# MAGIC `cte_temp` reads next. Two conservation rules are recorded as CHECK stages:
+# MAGIC - the TLD sales rows and their amount are found exactly once across the TLD branches;
+# MAGIC - every provider id is found in the provider branches.
+# MAGIC
+# MAGIC `assert_reconciliation_checkpoints` fails the run before the MERGE when a rule does not hold.
+
+# COMMAND ----------
+
+RECONCILIATION_BRANCHES = [
+    "integradas",
+    "manuales_asociadas",
+    "tld_manuales_sin_match",
+    "tld_manuales_duplicadas",
+    "tld_integradas_sin_proveedor",
+    "proveedor_duplicadas",
+    "proveedor_sin_match",
+]
+
+MANUAL_KEY_NULL_SQL = """CAST(NULL AS INT) AS llave_fecha,
+      CAST(NULL AS STRING) AS llave_local,
+      CAST(NULL AS BIGINT) AS llave_monto,
+      CAST(NULL AS BIGINT) AS llave_manual,
+      CAST(NULL AS BIGINT) AS llave_repeticiones"""
+
+RECONCILIATION_BRANCH_GROUPS = {
+    "conciliadas": ["integradas", "manuales_asociadas"],
+    "solo_tld": ["tld_manuales_sin_match", "tld_manuales_duplicadas", "tld_integradas_sin_proveedor"],
+    "solo_proveedor": ["proveedor_duplicadas", "proveedor_sin_match"],
+}
+
+
+def reconciliation_column(name, default="NULL", tld=None, proveedor=None, **expressions):
+    """Describe one output column of the reconciliation as a SQL expression per branch.
+
+    In the branches the TLD row is aliased `a`, the provider row `y` and, for integrated rows, the credit
+    note `nc` (`nc.nc_repeticiones` is the number of credit notes of the order). The expression of a
+    branch is resolved in this order: the branch itself, its group (conciliadas, solo_tld, solo_proveedor),
+    the `tld` shortcut (branches with a TLD row) or the `proveedor` shortcut (branches with a provider row),
+    and finally `default`. When both shortcuts apply, matched branches take the TLD one.
+    """
+    unknown = set(expressions) - set(RECONCILIATION_BRANCHES) - set(RECONCILIATION_BRANCH_GROUPS)
+    if unknown:
+        raise ValueError(f"Unknown reconciliation branches for column {name}: {sorted(unknown)}")
+
+    resolved = {}
+    for branch in RECONCILIATION_BRANCHES:
+        group = next(g for g, branches in RECONCILIATION_BRANCH_GROUPS.items() if branch in branches)
+        candidates = [expressions.get(branch), expressions.get(group)]
+        if group in ("conciliadas", "solo_tld"):
+            candidates.append(tld)
+        if group in ("conciliadas", "solo_proveedor"):
+            candidates.append(proveedor)
+        resolved[branch] = next((candidate for candidate in candidates if candidate is not None), default)
+
+    return (name, resolved)
+
+
+# Row predicate of each branch over the FULL OUTER JOIN of cte_tld_conciliacion (a) and cte_proveedor_conciliacion (y)
+RECONCILIATION_BRANCH_CONDITIONS = {
+    "integradas": "a.rama_conciliacion = 'integradas'",
+    "manuales_asociadas": "a.rama_conciliacion = 'manuales' AND y.rama_conciliacion IS NOT NULL",
+    "tld_manuales_sin_match": "a.rama_conciliacion = 'manuales' AND y.rama_conciliacion IS NULL",
+    "tld_manuales_duplicadas": "a.rama_conciliacion = 'tld_manuales_duplicadas'",
+    "tld_integradas_sin_proveedor": "a.rama_conciliacion = 'tld_integradas_sin_proveedor'",
+    "proveedor_duplicadas": "y.rama_conciliacion = 'proveedor_duplicadas'",
+    "proveedor_sin_match": "a.rama_conciliacion IS NULL AND y.rama_conciliacion = 'manuales'",
+}
+
+
+def reconciliation_amount_columns(reglas):
+    """Expand an amount rule table into reconciliation columns, the integrated columns first and then the manual ones.
+
+    Each rule is (integrated column, manual column, expression for the `integradas` branch or None, {branch or
+    group: expression} for the manual column). Every branch without an expression gets 0.
+    """
+    integradas = [
+        reconciliation_column(columna_integrada, "0", **({"integradas": expresion} if expresion is not None else {}))
+        for columna_integrada, _, expresion, _ in reglas
+    ]
+    manuales = [
+        reconciliation_column(columna_manual, "0", **expresiones)
+        for _, columna_manual, _, expresiones in reglas
+    ]
+
+    return integradas + manuales
+
+
+def reconciliation_branch_sql(branches):
+    """Classify a row of the FULL OUTER JOIN into its output branch; NULL for rows without a branch."""
+    return "CASE " + " ".join(f"WHEN {RECONCILIATION_BRANCH_CONDITIONS[branch]} THEN '{branch}'" for branch in branches) + " END"
+
+
+def reconciliation_case_sql(expressions, branches):
+    """Fold the per-branch expressions of a column into one CASE on `rama_salida`, grouping branches that share an expression.
+
+    The branch is computed once per row by `reconciliation_branch_sql`, so each column only tests a string code
+    instead of repeating the join predicates.
+    """
+    grouped = {}
+    for branch in branches:
+        grouped.setdefault(expressions[branch], []).append(branch)
+
+    if len(grouped) == 1:
+        return next(iter(grouped))
+
+    # The most common expression becomes the ELSE so the CASE only lists the exceptions.
+    default = max(grouped, key=lambda expression: len(grouped[expression]))
+    whens = [
+        "WHEN rama_salida IN (" + ", ".join(f"'{branch}'" for branch in grouped_branches) + f") THEN {expression}"
+        for expression, grouped_branches in grouped.items()
+        if expression != default
+    ]
+
+    return "CASE " + " ".join(whens) + f" ELSE {default} END"
+
+
+def status_case_sql(reglas, default="NULL"):
+    """Render an ordered status rule table [(condition, value), ...] as one CASE; the first matching rule wins."""
+    return "CASE\n    " + "\n    ".join(f"WHEN {condicion} THEN {valor}" for condicion, valor in reglas) + f"\n    ELSE {default}\n  END"
+
+
+# Credit note status of an integrated sale, shared by every provider
+ESTADO_NC_REGLAS = [
+    ("nc_duplicada = 1", "'Nota de crédito duplicada'"),
+    ("sales_transaction_id_nc IS NULL", "'No aplica NC'"),
+    ("sales_transaction_id_nc IS NOT NULL", "'Nota de crédito aplicada'"),
+]
+
+
+def manual_key_hash_sql(llave):
+    """Return the 64-bit hash of a manual matching key (date as int, location code, amount in integer units).
+
+    Rows with a NULL component get a NULL hash (XXHASH64 skips NULL inputs), so they never match,
+    as with the string CONCAT key it replaces.
+    """
+    nulos = " OR ".join(f"({llave[c]}) IS NULL" for c in ("fecha", "local", "monto"))
+
+    return f"CASE WHEN {nulos} THEN NULL ELSE XXHASH64(UNIX_DATE({llave['fecha']}), {llave['local']}, {llave['monto']}) END"
+
+
+def manual_key_sql(llave):
+    """Return the typed components and the hash of a manual matching key as SQL select items."""
+    return f"""UNIX_DATE({llave['fecha']}) AS llave_fecha,
+      {llave['local']} AS llave_local,
+      {llave['monto']} AS llave_monto,
+      {manual_key_hash_sql(llave)} AS llave_manual"""
+
+
+# A manual key shared by more rows than this is split over SKEW_SALT_BUCKETS tasks when its rows are counted
+SKEW_HOT_KEY_ROWS = 5000
+SKEW_SALT_BUCKETS = 16
+
+
+def valid_key_sql(column):
+    """An order id usable for integrated matching: NULL, empty and blank ids would all join with each other."""
+    return f"NULLIF(TRIM({column}), '') IS NOT NULL"
+
+
+def record_key_skew(stage_name, counts_sql):
+    """Record the rows-per-key distribution of a join key as a SKEW stage of the run metrics.
+
+    `counts_sql` returns one row per key value with columns `clave` (NULL included) and `filas`.
+    """
+    with track_stage(stage_name, "SKEW") as record:
+        stats = collect_sql(f"""
+
+        SELECT
+          SUM(filas) AS filas,
+          PERCENTILE_APPROX(CASE WHEN clave IS NOT NULL THEN filas END, 0.5) AS mediana,
+          MAX(CASE WHEN clave IS NOT NULL THEN filas END) AS maximo,
+          COALESCE(SUM(CASE WHEN clave IS NULL THEN filas END), 0) AS nulas,
+          COUNT_IF(clave IS NOT NULL AND filas > {SKEW_HOT_KEY_ROWS}) AS calientes
+        FROM
+          ({counts_sql})
+
+        """
+        )[0]
+
+        record.update({
+            "row_count": stats["filas"],
+            "key_rows_median": stats["mediana"],
+            "key_rows_max": stats["maximo"],
+            "null_key_rows": stats["nulas"],
+            "hot_keys": stats["calientes"],
+        })
+
+    print(
+        f"Key skew {stage_name}: {stats['filas']} rows, median {stats['mediana']} and max {stats['maximo']} rows per key, "
+        f"{stats['nulas']} NULL keys, {stats['calientes']} keys above {SKEW_HOT_KEY_ROWS}."
+    )
+
+
+def create_manual_key_repetitions(base_view, view_name, fila_id, distinct=False):
+    """Create view_name as base_view plus `llave_repeticiones`, the number of rows of base_view sharing its llave_manual.
+
+    The counts come from a GROUP BY, which is combined map-side, instead of a window that sends every row of a
+    key to one task. They are joined back with a salt: the count of a hot key (more than SKEW_HOT_KEY_ROWS rows) is
+    replicated SKEW_SALT_BUCKETS times, and its rows are spread over the copies by the hash of `fila_id`. Rows
+    with a NULL key never join; they take the count of the NULL group, as the window did. With `distinct` the
+    duplicated rows of base_view are removed after being counted.
+    """
+    conteo = f"{view_name}_conteo"
+
+    with track_stage(conteo, "CACHE"):
+        cache_table_as(conteo, f"""
+        SELECT
+          llave_manual,
+          COUNT(*) AS llave_repeticiones
+        FROM
+          {base_view}
+        GROUP BY
+          llave_manual
+        """, storage_level="MEMORY_AND_DISK")
+
+    record_key_skew(f"{view_name}.llave_manual", f"SELECT llave_manual AS clave, llave_repeticiones AS filas FROM {conteo}")
+
+    run_view_sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW {view_name} AS
+    SELECT /*+ BROADCAST(h) */ {"DISTINCT" if distinct else ""}
+      b.*,
+      COALESCE(c.llave_repeticiones, (SELECT MAX(llave_repeticiones) FROM {conteo} WHERE llave_manual IS NULL)) AS llave_repeticiones
+    FROM
+      {base_view} AS b
+      LEFT JOIN
+        (SELECT llave_manual FROM {conteo} WHERE llave_manual IS NOT NULL AND llave_repeticiones > {SKEW_HOT_KEY_ROWS}) AS h
+        ON
+          b.llave_manual = h.llave_manual
+      LEFT JOIN
+        (
+          SELECT
+            llave_manual,
+            llave_repeticiones,
+            EXPLODE(SEQUENCE(0, CASE WHEN llave_repeticiones > {SKEW_HOT_KEY_ROWS} THEN {SKEW_SALT_BUCKETS - 1} ELSE 0 END)) AS sal
+          FROM
+            {conteo}
+          WHERE
+            llave_manual IS NOT NULL
+        ) AS c
+        ON
+          b.llave_manual = c.llave_manual
+          AND c.sal = CASE WHEN h.llave_manual IS NOT NULL THEN PMOD(XXHASH64(b.{fila_id}), {SKEW_SALT_BUCKETS}) ELSE 0 END
+
+    """
+    )
+
+
+def check_manual_key_collisions():
+    """Fail the run if two different manual key tuples share a hash in cte_tld_manuales or cte_proveedor_manuales."""
+    colisiones = collect_sql(f"""
+
+    SELECT
+      llave_manual,
+      COUNT(*) AS tuplas
+    FROM
+      (
+        SELECT llave_manual, llave_fecha, llave_local, llave_monto
+        FROM cte_tld_manuales
+        WHERE llave_manual IS NOT NULL
+
+        UNION
+
+        SELECT llave_manual, llave_fecha, llave_local, llave_monto
+        FROM cte_proveedor_manuales
+        WHERE llave_manual IS NOT NULL
+      )
+    GROUP BY
+      llave_manual
+    HAVING
+      COUNT(*) > 1
+    LIMIT 10
+
+    """
+    )
+
+    if colisiones:
+        raise ValueError(f"Manual key hash collisions detected: {[row.llave_manual for row in colisiones]}")
+
+    print("No manual key hash collisions detected.")
+
+
+# Record the reconciliation checkpoints and run the conservation rules in build_reconciliation
+RECONCILIATION_CHECKPOINTS = True
+# Amount differences below this are rounding of the DOUBLE sums, not lost rows
+CHECKPOINT_AMOUNT_TOLERANCE = 0.01
+
+
+def record_checkpoint(view_name, monto, clave=None, grupo=None):
+    """Aggregate view_name in one pass and record its rows, distinct `clave` values and sum of `monto` as CHECKPOINT stages.
+
+    With `grupo` the view is also aggregated per value of that column, recorded as `view_name[value]`.
+    Returns {group value: {"filas", "claves", "monto"}} with the whole view under None.
+    """
+    claves_sql = f"COUNT(DISTINCT {clave})" if clave else "CAST(NULL AS BIGINT)"
+    if grupo:
+        grupo_sql, group_by_sql = f"{grupo} AS grupo, GROUPING({grupo}) AS total", f"GROUP BY GROUPING SETS (({grupo}), ())"
+    else:
+        grupo_sql, group_by_sql = "NULL AS grupo, 1 AS total", ""
+
+    with track_stage(view_name, "CHECKPOINT") as record:
+        rows = collect_sql(f"""
+
+        SELECT
+          {grupo_sql},
+          COUNT(*) AS filas,
+          {claves_sql} AS claves,
+          SUM({monto}) AS monto
+        FROM
+          {view_name}
+        {group_by_sql}
+
+        """
+        )
+
+        checkpoint = {None: {"filas": 0, "claves": 0 if clave else None, "monto": None}}
+        for row in rows:
+            # The total row has grupo NULL as well; a NULL group value is kept under "NULL"
+            valor = None if row["total"] else ("NULL" if row["grupo"] is None else row["grupo"])
+            checkpoint[valor] = {"filas": row["filas"], "claves": row["claves"], "monto": row["monto"]}
+
+        record.update({"row_count": checkpoint[None]["filas"], "key_count": checkpoint[None]["claves"], "amount_sum": checkpoint[None]["monto"]})
+
+    for valor, metricas in checkpoint.items():
+        if valor is not None:
+            run_metrics.append({
+                **new_stage_record(f"{view_name}[{valor}]", "CHECKPOINT"),
+                "row_count": metricas["filas"],
+                "key_count": metricas["claves"],
+                "amount_sum": metricas["monto"],
+            })
+
+    print(f"Checkpoint {view_name}: {checkpoint[None]['filas']} rows, {checkpoint[None]['claves']} keys, amount {checkpoint[None]['monto']}.")
+    return checkpoint
+
+
+def check_conservation(rule_name, observed, expected):
+    """Record a CHECK stage comparing the metrics ("filas", "claves", "monto") given in both observed and expected."""
+    diferencias = []
+    for metrica in ("filas", "claves", "monto"):
+        if metrica not in observed or metrica not in expected:
+            continue
+        if metrica == "monto":
+            passed = abs((observed[metrica] or 0) - (expected[metrica] or 0)) <= CHECKPOINT_AMOUNT_TOLERANCE
+        else:
+            passed = observed[metrica] == expected[metrica]
+        if not passed:
+            diferencias.append(f"{metrica} {observed[metrica]} != {expected[metrica]}")
+
+    run_metrics.append({
+        **new_stage_record(rule_name, "CHECK"),
+        "row_count": observed.get("filas"),
+        "key_count": observed.get("claves"),
+        "amount_sum": observed.get("monto"),
+        "expected_rows": expected.get("filas"),
+        "expected_keys": expected.get("claves"),
+        "expected_amount": expected.get("monto"),
+        "check_passed": not diferencias,
+    })
+
+    print(f"Check {rule_name}: {'passed' if not diferencias else 'FAILED, ' + ', '.join(diferencias)}.")
+
+
+def check_reconciliation(dict_proveedor):
+    """Checkpoints of both sides of the reconciliation and their conservation rules."""
+    p = dict_proveedor
+    vacio = {"filas": 0, "monto": None}
+
+    # sales_type_id is a string in some sources; the groups are keyed by its integer value either way
+    tld = record_checkpoint(p["vista_tld"], p["tld_monto"], grupo="CAST(sales_type_id AS INT)")
+    materialize_view("cte_tld_conciliacion")
+    tld_conciliacion = record_checkpoint("cte_tld_conciliacion", p["tld_monto"], grupo="rama_conciliacion")
+
+    # Every TLD sale is integrated, manual or (SIN_CLAVE) integrated without a provider row, exactly once
+    check_conservation(
+        f"{p['vista_tld']} ventas = cte_tld_conciliacion",
+        {metrica: tld_conciliacion[None][metrica] for metrica in ("filas", "monto")},
+        {metrica: tld.get(1, vacio)[metrica] for metrica in ("filas", "monto")},
+    )
+
+    proveedor = record_checkpoint(p["vista_proveedor"], p["proveedor_monto"], clave=p["proveedor_id"])
+    materialize_view("cte_proveedor_conciliacion")
+    proveedor_conciliacion = record_checkpoint(
+        "cte_proveedor_conciliacion", p["proveedor_monto"], clave=p["proveedor_id"], grupo="rama_conciliacion"
+    )
+
+    # Both provider branches drop duplicated rows, so the provider ids are conserved rather than the rows
+    check_conservation(
+        f"{p['vista_proveedor']} = cte_proveedor_conciliacion",
+        {"claves": proveedor_conciliacion[None]["claves"]},
+        {"claves": proveedor[None]["claves"]},
+    )
+
+
+def assert_reconciliation_checkpoints(run_metrics_table_name, pipeline_name, run_id, country_ids):
+    """Fail the run when a conservation rule did not hold, after saving the run metrics that show it."""
+    fallidas = [record["stage_name"] for record in run_metrics if record["stage_type"] == "CHECK" and record["check_passed"] is False]
+    if not fallidas:
+        return
+
+    save_run_metrics(run_metrics_table_name, pipeline_name, run_id, country_ids)
+    raise ValueError(f"Reconciliation checks failed: {fallidas}. See the CHECK stages of run {run_id} in {run_metrics_table_name}.")
+
+
+def build_reconciliation(dict_proveedor):
+    """Create the reconciliation views of a provider and return the unified `cte_temp` DataFrame.
+
+    `cte_temp` is built in a single pass: one FULL OUTER JOIN between the tagged TLD and provider sides
+    classifies every row into its branch, and one DISTINCT removes the duplicates of the many-to-many
+    integrated matches. Every row of `cte_temp` carries its output branch in `rama_salida`.
+    """
+    p = dict_proveedor
+
+    if RUN_METRICS_FORCE_COUNT:
+        # Rows per order id on each side of the integrated joins; empty ids count as NULL
+        for vista, clave in ((p["vista_tld"], p["tld_clave"]), (p["vista_proveedor"], p["proveedor_clave"])):
+            record_key_skew(
+                f"{vista}.{clave}",
+                f"SELECT NULLIF(TRIM({clave}), '') AS clave, COUNT(*) AS filas FROM {vista} GROUP BY NULLIF(TRIM({clave}), '')",
+            )
+
+    # Credit notes, with the number of credit notes of the same order to flag duplicates
+    run_view_sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW cte_nc AS
+    SELECT DISTINCT
+      sales_start_dttm,
+      sales_end_dttm,
+      sales_date,
+      location_name,
+      sales_transaction_id,
+      {p["tld_clave"]} AS special_sale_order,
+      {p["tld_monto"]} AS venta_bruta_nc,
+      COUNT(*) OVER (PARTITION BY {p["tld_clave"]}) AS nc_repeticiones
+    FROM
+      {p["vista_tld"]}
+    WHERE
+      sales_type_id = 2
+      AND {valid_key_sql(p["tld_clave"])}
+
+    """
+    )
+
+    # Provider side: integrated on order id, manual on the hashed date + location + amount key
+    run_view_sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW cte_proveedor_integradas AS
+    SELECT DISTINCT y.*
+    FROM
+      {p["vista_proveedor"]} AS y
+      INNER JOIN
+        {p["vista_tld"]} AS t
+        ON
+          y.{p["proveedor_clave"]} = t.{p["tld_clave"]}
+    WHERE
+      {valid_key_sql(f"y.{p['proveedor_clave']}")}
+      AND {valid_key_sql(f"t.{p['tld_clave']}")}
+
+    """
+    )
+
+    # llave_repeticiones > 1 means the manual key is shared by several rows of the same side,
+    # so those rows cannot be associated and go to the duplicated branches.
+    run_view_sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW cte_proveedor_manuales_base AS
+    SELECT
+      y.*,
+      {p["concat_proveedor"]} AS concat_proveedor,
+      {manual_key_sql(p["llave_proveedor"])}
+    FROM
+      {p["vista_proveedor"]} AS y
+    WHERE
+      NOT EXISTS (
+        SELECT 1
+        FROM
+          cte_proveedor_integradas AS i
+        WHERE
+          i.{p["proveedor_id"]} = y.{p["proveedor_id"]}
+      )
+
+    """
+    )
+
+    # Duplicated provider rows are counted before the DISTINCT, as the window did
+    create_manual_key_repetitions("cte_proveedor_manuales_base", "cte_proveedor_manuales", p["proveedor_id"], distinct=True)
+
+    # TLD side: integrated on order id, manual on the hashed date + location + amount key
+    run_view_sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW cte_tld_integradas AS
+    SELECT t.*
+    FROM
+      {p["vista_tld"]} AS t
+    WHERE
+      t.sales_type_id = 1
+      AND {valid_key_sql(f"t.{p['tld_clave']}")}
+      AND EXISTS (SELECT 1 FROM cte_proveedor_integradas AS i WHERE i.{p["proveedor_clave"]} = t.{p["tld_clave"]})
+
+    """
+    )
+
+    if p["tld_manuales"] == "NO_INTEGRADAS":
+        filtro_tld_manuales = "NOT EXISTS (SELECT 1 FROM cte_tld_integradas AS i WHERE i.sales_transaction_id = a.sales_transaction_id)"
+    elif p["tld_manuales"] == "SIN_CLAVE":
+        filtro_tld_manuales = "NOT " + valid_key_sql(f"a.{p['tld_clave']}")
+    else:
+        raise ValueError(f"Unknown tld_manuales mode: {p['tld_manuales']}")
+
+    run_view_sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW cte_tld_manuales_base AS
+    SELECT
+      a.*,
+      {p["concat_tld"]} AS concat_tld,
+      {manual_key_sql(p["llave_tld"])}
+    FROM
+      {p["vista_tld"]} AS a
+    WHERE
+      a.sales_type_id = 1
+      AND {filtro_tld_manuales}
+
+    """
+    )
+
+    create_manual_key_repetitions("cte_tld_manuales_base", "cte_tld_manuales", "sales_transaction_id")
+
+    check_manual_key_collisions()
+
+    # Single pass: every TLD row and every provider row is tagged with its side branch and a match key
+    # ('I:' + order id for integrated rows, 'M:' + manual key hash for associable manual rows, NULL otherwise),
+    # and one FULL OUTER JOIN on that key yields all the output branches at once.
+    tld_sin_proveedor_sql = ""
+    if p["tld_manuales"] == "SIN_CLAVE":
+        tld_sin_proveedor_sql = f"""
+
+    UNION ALL
+
+    SELECT
+      t.*,
+      CAST(NULL AS STRING) AS concat_tld,
+      {MANUAL_KEY_NULL_SQL},
+      'tld_integradas_sin_proveedor' AS rama_conciliacion,
+      CAST(NULL AS STRING) AS clave_match
+    FROM
+      {p["vista_tld"]} AS t
+    WHERE
+      t.sales_type_id = 1
+      AND {valid_key_sql(f"t.{p['tld_clave']}")}
+      AND NOT EXISTS (SELECT 1 FROM cte_proveedor_integradas AS y WHERE y.{p["proveedor_clave"]} = t.{p["tld_clave"]})"""
+
+    run_view_sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW cte_tld_conciliacion AS
+    SELECT
+      t.*,
+      CAST(NULL AS STRING) AS concat_tld,
+      {MANUAL_KEY_NULL_SQL},
+      'integradas' AS rama_conciliacion,
+      CONCAT('I:', t.{p["tld_clave"]}) AS clave_match
+    FROM
+      cte_tld_integradas AS t
+
+    UNION ALL
+
+    SELECT
+      t.*,
+      CASE WHEN t.llave_repeticiones = 1 THEN 'manuales' ELSE 'tld_manuales_duplicadas' END AS rama_conciliacion,
+      CASE WHEN t.llave_repeticiones = 1 THEN CONCAT('M:', t.llave_manual) END AS clave_match
+    FROM
+      cte_tld_manuales AS t{tld_sin_proveedor_sql}
+
+    """
+    )
+
+    run_view_sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW cte_proveedor_conciliacion AS
+    SELECT
+      y.*,
+      CAST(NULL AS STRING) AS concat_proveedor,
+      {MANUAL_KEY_NULL_SQL},
+      'integradas' AS rama_conciliacion,
+      CONCAT('I:', y.{p["proveedor_clave"]}) AS clave_match
+    FROM
+      cte_proveedor_integradas AS y
+
+    UNION ALL
+
+    SELECT
+      y.*,
+      CASE WHEN y.llave_repeticiones = 1 THEN 'manuales' ELSE 'proveedor_duplicadas' END AS rama_conciliacion,
+      CASE WHEN y.llave_repeticiones = 1 THEN CONCAT('M:', y.llave_manual) END AS clave_match
+    FROM
+      cte_proveedor_manuales AS y
+
+    """
+    )
+
+    if RECONCILIATION_CHECKPOINTS:
+        check_reconciliation(p)
+
+    # With NO_INTEGRADAS, sales with an order id but no provider row are already manual rows.
+    branches = [
+        branch for branch in RECONCILIATION_BRANCHES
+        if branch != "tld_integradas_sin_proveedor" or p["tld_manuales"] == "SIN_CLAVE"
+    ]
+
+    select_list = ",\n      ".join(
+        f"{reconciliation_case_sql(expressions, branches)} AS `{name}`" for name, expressions in p["columnas"]
+    )
+
+    # Integrated provider rows whose order id only matches credit notes have no output branch.
+    # rama_salida is a lateral column alias: Spark computes it once in a projection below the column list.
+    # Rows without a match key join on a per-side surrogate ('T:' / 'P:' never equals 'I:' / 'M:' nor each other),
+    # so they are spread over the shuffle instead of all landing in the task of the NULL key.
+    run_view_sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW cte_temp AS
+    SELECT DISTINCT
+      {reconciliation_branch_sql(branches)} AS rama_salida,
+      {select_list}
+    FROM
+      cte_tld_conciliacion AS a
+      FULL OUTER JOIN
+        cte_proveedor_conciliacion AS y
+        ON
+          COALESCE(a.clave_match, CONCAT('T:', a.sales_transaction_id)) = COALESCE(y.clave_match, CONCAT('P:', y.{p["proveedor_id"]}))
+      LEFT JOIN
+        cte_nc AS nc
+        ON
+          a.rama_conciliacion = 'integradas'
+          AND a.{p["tld_clave"]} = nc.special_sale_order
+    WHERE
+      a.rama_conciliacion IS NOT NULL
+      OR y.rama_conciliacion <> 'integradas'
+
+    """
+    )
+
+    return spark.table("cte_temp")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 5. Dimension snapshots
+# MAGIC
+# MAGIC The lookup dimensions joined to the fact tables are a few thousand rows once filtered to their current version.
+# MAGIC They are loaded once per run into cached temp views (`*_actual`) and joined with an explicit BROADCAST hint, so the
+# MAGIC fact side is never shuffled. A dimension that grows past `DIMENSION_SNAPSHOT_MAX_ROWS` is still snapshotted but
+# MAGIC left out of the hint, and Spark picks the join strategy on its own.
+
+# COMMAND ----------
+
+DIMENSION_SNAPSHOT_MAX_ROWS = 100000
+
+broadcast_dimensions = {}
+
+
+def create_dimension_snapshots(max_rows=DIMENSION_SNAPSHOT_MAX_ROWS):
+    """Cache the current rows of the lookup dimensions and record which ones are small enough to broadcast."""
+    dict_snapshots = {
+        "dim_location_actual": f"""
+        SELECT *
+        FROM {l3_foundation_catalog_name}.common.dim_location
+        WHERE location_end_dt = '9999-12-31T00:00:00.000Z'
+        """,
+        "dim_country_actual": f"""
+        SELECT *
+        FROM {l3_foundation_catalog_name}.common.dim_country
+        WHERE country_end_dt = '9999-12-31T00:00:00.000Z'
+        """,
+        "lk_sale_channel_actual": f"""
+        SELECT *
+        FROM {l2_foundation_catalog_name}.common.lk_sale_channel
+        """,
+        "lk_sale_subchannel_actual": f"""
+        SELECT *
+        FROM {l2_foundation_catalog_name}.common.lk_sale_subchannel
+        """,
+    }
+
+    for view_name, snapshot_sql in dict_snapshots.items():
+        with track_stage(view_name, "CACHE"):
+            cache_table_as(view_name, snapshot_sql)
+
+        row_count = collect_sql(f"SELECT COUNT(*) AS filas FROM {view_name}")[0]["filas"]
+        broadcast_dimensions[view_name] = row_count <= max_rows
+
+        if broadcast_dimensions[view_name]:
+            print(f"Dimension snapshot {view_name}: {row_count} rows, broadcast.")
+        else:
+            print(f"Dimension snapshot {view_name}: {row_count} rows exceeds {max_rows}, not broadcast.")
+
+
+def dimension_broadcast_hint(dict_aliases):
+    """Return the BROADCAST hint for the aliases whose snapshot passed the size guard.
+
+    `dict_aliases` maps each alias used in the query to its snapshot view, e.g. {"loc": "dim_location_actual"}.
+    """
+    aliases = [alias for alias, view_name in dict_aliases.items() if broadcast_dimensions.get(view_name)]
+
+    if not aliases:
+        return ""
+
+    return f"/*+ BROADCAST({', '.join(aliases)}) */"
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 6. Per-country UTC windows
+# MAGIC
+# MAGIC Provider tables store `created_at` in UTC while the processing window is expressed in local business dates. The
+# MAGIC UTC bounds of the window are resolved once per run in Python from `dim_country_actual.COUNTRY_TIMEZONE`, using the
+# MAGIC offset in force on each boundary date (so DST changes inside the window are honoured), and registered as the
+# MAGIC `ventana_utc_pais` temp view. The queries then filter on literal timestamp ranges that Delta data skipping can use,
+# MAGIC instead of computing the offset against `current_timestamp()` for every row.
+
+# COMMAND ----------
+
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+FIXED_OFFSET_TIMEZONE_PATTERN = re.compile(r"^(?:UTC|GMT)?\s*([+-])(\d{1,2})(?::?(\d{2}))?$")
+
+
+def resolve_timezone(timezone_name):
+    """Return a tzinfo for a COUNTRY_TIMEZONE value, either a region id ('America/Bogota') or a fixed offset ('UTC-3')."""
+    timezone_name = (timezone_name or "").strip()
+
+    if timezone_name.upper() in ("UTC", "GMT", "Z"):
+        return timezone.utc
+
+    try:
+        return ZoneInfo(timezone_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        pass
+
+    offset_match = FIXED_OFFSET_TIMEZONE_PATTERN.match(timezone_name.upper())
+    if offset_match is None:
+        raise ValueError(f"Unsupported COUNTRY_TIMEZONE value: '{timezone_name}'")
+
+    sign, hours, minutes = offset_match.groups()
+    offset = timedelta(hours=int(hours), minutes=int(minutes or 0))
+    return timezone(-offset if sign == "-" else offset)
+
+
+def create_country_utc_windows(fecha_desde, fecha_hasta, view_name="ventana_utc_pais", country_ids=None):
+    """Resolve the UTC bounds of the local window [fecha_desde 00:00, fecha_hasta 23:59:59.999] for every country.
+
+    Reads the `dim_country_actual` snapshot, registers the result as `view_name` and returns it as a list of dicts
+    with COUNTRY_SHORT_ABBREVIATION_CD, COUNTRY_ID, COUNTRY_TIMEZONE, inicio_utc and fin_utc (naive UTC datetimes).
+    When `country_ids` is given, only those countries get a window.
+    """
+    if isinstance(fecha_desde, str):
+        fecha_desde = date.fromisoformat(fecha_desde)
+    if isinstance(fecha_hasta, str):
+        fecha_hasta = date.fromisoformat(fecha_hasta)
+    if isinstance(fecha_desde, datetime):
+        fecha_desde = fecha_desde.date()
+    if isinstance(fecha_hasta, datetime):
+        fecha_hasta = fecha_hasta.date()
+
+    countries = spark.sql("""
+    SELECT DISTINCT COUNTRY_SHORT_ABBREVIATION_CD, COUNTRY_ID, COUNTRY_TIMEZONE
+    FROM dim_country_actual
+    WHERE COUNTRY_SHORT_ABBREVIATION_CD IS NOT NULL AND COUNTRY_TIMEZONE IS NOT NULL
+    """).collect()
+
+    if country_ids is not None:
+        country_ids = {str(country_id) for country_id in country_ids}
+        countries = [row for row in countries if str(row["COUNTRY_ID"]) in country_ids]
+
+    windows = []
+    for row in countries:
+        tzinfo = resolve_timezone(row["COUNTRY_TIMEZONE"])
+        inicio_local = datetime.combine(fecha_desde, time.min, tzinfo=tzinfo)
+        fin_local = datetime.combine(fecha_hasta, time(23, 59, 59, 999000), tzinfo=tzinfo)
+
+        windows.append({
+            "COUNTRY_SHORT_ABBREVIATION_CD": row["COUNTRY_SHORT_ABBREVIATION_CD"],
+            "COUNTRY_ID": str(row["COUNTRY_ID"]),
+            "COUNTRY_TIMEZONE": row["COUNTRY_TIMEZONE"],
+            "inicio_utc": inicio_local.astimezone(timezone.utc).replace(tzinfo=None),
+            "fin_utc": fin_local.astimezone(timezone.utc).replace(tzinfo=None),
+        })
+
+    if not windows:
+        raise ValueError("dim_country_actual returned no countries with a timezone; cannot resolve the UTC window.")
+
+    spark.createDataFrame(
+        [(w["COUNTRY_SHORT_ABBREVIATION_CD"], w["COUNTRY_ID"], w["COUNTRY_TIMEZONE"], w["inicio_utc"], w["fin_utc"]) for w in windows],
+        "COUNTRY_SHORT_ABBREVIATION_CD STRING, COUNTRY_ID STRING, COUNTRY_TIMEZONE STRING, inicio_utc TIMESTAMP_NTZ, fin_utc TIMESTAMP_NTZ",
+    ).createOrReplaceTempView(view_name)
+
+    print(f"Resolved UTC window for {len(windows)} countries ({fecha_desde} to {fecha_hasta}) into {view_name}.")
+    return windows
+
+
+def utc_timestamp_literal(value):
+    """Render a naive UTC datetime as a Spark timestamp literal with an explicit zone, independent of the session timezone."""
+    return f"TIMESTAMP '{value.strftime('%Y-%m-%dT%H:%M:%S')}.{value.microsecond // 1000:03d}+00:00'"
+
+
+def country_utc_window_filter(windows, timestamp_column, country_column):
+    """Return a predicate restricting `timestamp_column` to each country's UTC window.
+
+    The outer range over all countries is a plain literal BETWEEN so file pruning applies even before the per-country
+    branches are evaluated. Rows whose country has no window are excluded, as the former INNER/LEFT join did.
+    """
+    inicio_global = min(w["inicio_utc"] for w in windows)
+    fin_global = max(w["fin_utc"] for w in windows)
+
+    country_predicates = "\n        OR ".join(
+        f"({country_column} = '{w['COUNTRY_SHORT_ABBREVIATION_CD']}' AND {timestamp_column} BETWEEN "
+        f"{utc_timestamp_literal(w['inicio_utc'])} AND {utc_timestamp_literal(w['fin_utc'])})"
+        for w in windows
+    )
+
+    return f"""{timestamp_column} BETWEEN {utc_timestamp_literal(inicio_global)} AND {utc_timestamp_literal(fin_global)}
+    AND (
+        {country_predicates}
+    )"""
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 7. Per-market work units
+# MAGIC
+# MAGIC A multi-market run is split into one notebook run per country, executed concurrently on the same cluster with
+# MAGIC bounded parallelism. Each unit only reads and writes its own country, so a large market does not hold back the
+# MAGIC small ones and a failed market is retried on its own. Units share the target, the pending-order index, the
+# MAGIC watermarks and the run metrics. Every MERGE and DELETE on them is scoped to the unit's countries or sources, and
+# MAGIC the tables have row-level concurrency enabled (deletion vectors and row tracking). A commit that still loses a
+# MAGIC concurrent-modification conflict is retried alone by `run_delta_write`, not the whole unit.
+
+# COMMAND ----------
+
+import ast
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def parse_mercados(mercados):
+    """Parse the `mercados` widget (a tuple literal such as ("080", "131"), or a single id) into a list of country ids."""
+    mercados = (mercados or "").strip()
+    if not mercados:
+        return []
+
+    try:
+        parsed = ast.literal_eval(mercados)
+    except (ValueError, SyntaxError):
+        parsed = [value.strip().strip("'\"") for value in mercados.strip("()").split(",")]
+
+    if isinstance(parsed, (str, int)):
+        parsed = [parsed]
+
+    return [str(country_id) for country_id in parsed if str(country_id).strip() != ""]
+
+
+def mercados_sql(country_ids):
+    """Render a list of country ids as a SQL IN list, e.g. ('080', '131')."""
+    return "(" + ", ".join(f"'{country_id}'" for country_id in country_ids) + ")"
+
+
+DELTA_WRITE_MAX_ATTEMPTS = 4
+
+# Optimistic-concurrency errors raised when another writer committed to the same rows or files first
+DELTA_WRITE_CONFLICTS = (
+    "ConcurrentAppendException",
+    "ConcurrentDeleteReadException",
+    "ConcurrentDeleteDeleteException",
+    "ConcurrentTransactionException",
+    "MetadataChangedException",
+    "DELTA_CONCURRENT_",
+)
+
+ROW_LEVEL_CONCURRENCY_PROPERTIES = {
+    "delta.enableDeletionVectors": "true",
+    "delta.enableRowTracking": "true",
+}
+
+
+def enable_row_level_concurrency(table_name):
+    """Enable deletion vectors and row tracking on a shared table, so writers of different rows do not conflict.
+
+    Only the missing properties are set: changing table properties is itself a commit that conflicts with every
+    concurrent writer.
+    """
+    current = {row["key"]: row["value"] for row in spark.sql(f"SHOW TBLPROPERTIES {table_name}").collect()}
+    missing = {key: value for key, value in ROW_LEVEL_CONCURRENCY_PROPERTIES.items() if current.get(key) != value}
+    if missing:
+        properties = ", ".join(f"'{key}' = {value}" for key, value in missing.items())
+        spark.sql(f"ALTER TABLE {table_name} SET TBLPROPERTIES ({properties})")
+        print(f"{table_name}: row-level concurrency enabled ({', '.join(missing)}).")
+
+
+def run_delta_write(label, write, max_attempts=DELTA_WRITE_MAX_ATTEMPTS):
+    """Call `write`, which commits one Delta transaction, again when it loses a conflict with a concurrent writer.
+
+    The market units share the target and control tables, so a conflict only repeats the losing commit, after a
+    growing pause. Any other error is raised at once.
+    """
+    if max_attempts < 1:
+        raise ValueError(f"{label}: max_attempts must be at least 1, got {max_attempts}.")
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return write()
+        except Exception as e:
+            if attempt == max_attempts or not any(name in f"{type(e).__name__}: {e}" for name in DELTA_WRITE_CONFLICTS):
+                raise
+            print(f"{label}: write conflict on attempt {attempt}/{max_attempts}, retrying in {2 ** attempt}s: {type(e).__name__}")
+            time_module.sleep(2 ** attempt)
+
+
+def run_notebook_with_retries(notebook_path, arguments, label, max_attempts=2, timeout_seconds=7200):
+    """Run `notebook_path` up to `max_attempts` times and return (None, attempts) or (last error message, attempts)."""
+    if max_attempts < 1:
+        raise ValueError(f"{label}: max_attempts must be at least 1, got {max_attempts}.")
+    for attempt in range(1, max_attempts + 1):
+        start_time = time_module.time()
+        try:
+            dbutils.notebook.run(notebook_path, timeout_seconds, arguments)
+            print(f"{label}: succeeded on attempt {attempt} in {time_module.time() - start_time:.0f}s.")
+            return None, attempt
+        except Exception as e:
+            print(f"{label}: attempt {attempt}/{max_attempts} failed after {time_module.time() - start_time:.0f}s: {e}")
+            error = str(e)
+
+    return error, max_attempts
+
+
+def run_market_units(notebook_path, country_ids, arguments, max_parallel=4, max_attempts=1, timeout_seconds=7200):
+    """Run `notebook_path` once per country id on a thread pool and return {country_id: result}.
+
+    Every unit receives `arguments` plus `mercados` set to its own country. Write conflicts between units are
+    retried inside the unit by run_delta_write. A unit that fails otherwise is run again up to `max_attempts`
+    runs in total; the result of a unit that never succeeded is the last exception message.
+    """
+    def run_unit(country_id):
+        unit_arguments = {**arguments, "mercados": mercados_sql([country_id])}
+        error, _ = run_notebook_with_retries(notebook_path, unit_arguments, f"Market {country_id}", max_attempts, timeout_seconds)
+        return country_id, error
+
+    dict_results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(country_ids)))) as executor:
+        futures = [executor.submit(run_unit, country_id) for country_id in country_ids]
+        for future in as_completed(futures):
+            country_id, error = future.result()
+            dict_results[country_id] = error
+
+    return dict_results
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 8. Run metrics per stage
+# MAGIC
+# MAGIC Temp views are lazy, so without instrumentation the whole cost of a run shows up in the final write. Every view
+# MAGIC is created through `run_view_sql`, and every eager step (CACHE TABLE, MERGE) runs inside `track_stage`. Each
+# MAGIC stage tags its Spark jobs with its own job group and then records:
+# MAGIC - its job ids and duration;
+# MAGIC - input rows and bytes;
+# MAGIC - shuffle read and write;
+# MAGIC - memory and disk spill.
+# MAGIC
+# MAGIC Each stage also keeps the median and slowest task run time of its most unbalanced Spark stage.
+# MAGIC
+# MAGIC With `RUN_METRICS_FORCE_COUNT` each view is also counted when it is created. The count adds a pass over the
+# MAGIC view but attributes its cost to the view itself. `save_run_metrics` writes the stages to a Delta table keyed by
+# MAGIC `pipeline_run_id` and the `mercados` of the unit.
+
+# COMMAND ----------
+
+import json as json_module
+import urllib.request
+import uuid
+from contextlib import contextmanager
+
+RUN_METRICS_FORCE_COUNT = False
+
+RUN_METRICS_STAGE_FIELDS = {
+    "input_rows": "inputRecords",
+    "input_bytes": "inputBytes",
+    "shuffle_read_bytes": "shuffleReadBytes",
+    "shuffle_write_bytes": "shuffleWriteBytes",
+    "memory_spill_bytes": "memoryBytesSpilled",
+    "disk_spill_bytes": "diskBytesSpilled",
+}
+
+# Skew columns of a stage: task run time quantiles of its slowest stage and, for SKEW stages, the rows per join key
+RUN_METRICS_SKEW_FIELDS = {
+    "task_median_ms": "BIGINT",
+    "task_max_ms": "BIGINT",
+    "key_rows_median": "DOUBLE",
+    "key_rows_max": "BIGINT",
+    "null_key_rows": "BIGINT",
+    "hot_keys": "BIGINT",
+}
+
+# Columns of the reconciliation checkpoints: CHECKPOINT stages aggregate a view, CHECK stages compare two of them
+RUN_METRICS_CHECK_FIELDS = {
+    "key_count": "BIGINT",
+    "amount_sum": "DOUBLE",
+    "expected_rows": "BIGINT",
+    "expected_keys": "BIGINT",
+    "expected_amount": "DOUBLE",
+    "check_passed": "BOOLEAN",
+}
+
+run_metrics = []
+
+TEMP_VIEW_NAME_PATTERN = re.compile(r"CREATE\s+OR\s+REPLACE\s+TEMP(?:ORARY)?\s+VIEW\s+([\w.`]+)", re.IGNORECASE)
+
+
+def get_spark_stage_metrics(job_ids):
+    """Sum the task metrics of every stage of the given jobs, read from the Spark UI REST API of the driver."""
+    sc = spark.sparkContext
+    status_tracker = sc.statusTracker()
+
+    stage_ids = set()
+    for job_id in job_ids:
+        job_info = status_tracker.getJobInfo(job_id)
+        if job_info is not None:
+            stage_ids.update(job_info.stageIds)
+
+    totals = {metric: 0 for metric in RUN_METRICS_STAGE_FIELDS}
+    if not stage_ids or not sc.uiWebUrl:
+        return totals
+
+    base_url = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}/stages"
+
+    try:
+        # Task metrics reach the status store through the listener bus, after the job has returned
+        sc._jsc.sc().listenerBus().waitUntilEmpty(10000)
+    except Exception:
+        pass
+
+    for stage_id in stage_ids:
+        try:
+            with urllib.request.urlopen(f"{base_url}/{stage_id}", timeout=10) as response:
+                attempts = json_module.loads(response.read())
+        except Exception:
+            # Skipped stages (reused shuffle output) are not always exposed; they did no work.
+            continue
+
+        for attempt in attempts:
+            for metric, field in RUN_METRICS_STAGE_FIELDS.items():
+                totals[metric] += attempt.get(field, 0) or 0
+
+            # The stage whose slowest task is furthest from its median is the straggler of the block
+            try:
+                url = f"{base_url}/{stage_id}/{attempt['attemptId']}/taskSummary?quantiles=0.5,1.0"
+                with urllib.request.urlopen(url, timeout=10) as response:
+                    median_ms, max_ms = json_module.loads(response.read())["executorRunTime"]
+            except Exception:
+                continue
+
+            if totals.get("task_max_ms") is None or max_ms / max(median_ms, 1) > totals["task_max_ms"] / max(totals["task_median_ms"], 1):
+                totals["task_median_ms"], totals["task_max_ms"] = int(median_ms), int(max_ms)
+
+    return totals
+
+
+def new_stage_record(stage_name, stage_type):
+    """Empty run_metrics record of a stage; every metric starts as NULL."""
+    return {
+        "stage_order": len(run_metrics) + 1,
+        "stage_name": stage_name,
+        "stage_type": stage_type,
+        "job_ids": [],
+        "started_at": datetime.now(timezone.utc).replace(tzinfo=None),
+        "duration_s": None,
+        "row_count": None,
+        **{metric: None for metric in RUN_METRICS_STAGE_FIELDS},
+        **{metric: None for metric in RUN_METRICS_SKEW_FIELDS},
+        **{metric: None for metric in RUN_METRICS_CHECK_FIELDS},
+    }
+
+
+@contextmanager
+def track_stage(stage_name, stage_type):
+    """Tag the Spark jobs run inside the block with a job group and append the stage metrics to run_metrics.
+
+    Yields the stage record so the caller can add the row count. Metrics collection never fails the run:
+    on clusters without access to the SparkContext only the duration is recorded.
+    """
+    record = new_stage_record(stage_name, stage_type)
+
+    job_group = f"fraudes_{stage_name}_{uuid.uuid4().hex[:8]}"
+    try:
+        spark.sparkContext.setJobGroup(job_group, f"{stage_type} {stage_name}")
+    except Exception:
+        job_group = None
+
+    start_time = time_module.time()
+    try:
+        yield record
+    finally:
+        record["duration_s"] = round(time_module.time() - start_time, 3)
+
+        if job_group is not None:
+            try:
+                spark.sparkContext.setLocalProperty("spark.jobGroup.id", None)
+                record["job_ids"] = sorted(spark.sparkContext.statusTracker().getJobIdsForGroup(job_group))
+                record.update(get_spark_stage_metrics(record["job_ids"]))
+            except Exception as e:
+                print(f"Could not collect Spark metrics for {stage_name}: {e}")
+
+        run_metrics.append(record)
+
+
+def run_view_sql(sql_text, force_count=None):
+    """Run a CREATE OR REPLACE TEMP VIEW statement as a tracked stage named after the view.
+
+    When `force_count` (default RUN_METRICS_FORCE_COUNT) is set the view is counted inside the stage, so its
+    Spark work and row count are attributed to it instead of to the step that first reads it.
+    """
+    view_match = TEMP_VIEW_NAME_PATTERN.search(sql_text)
+    if view_match is None:
+        raise ValueError("run_view_sql expects a CREATE OR REPLACE TEMP VIEW statement.")
+
+    view_name = view_match.group(1).strip("`")
+    if force_count is None:
+        force_count = RUN_METRICS_FORCE_COUNT
+
+    with track_stage(view_name, "VIEW") as record:
+        result = spark.sql(sql_text)
+        if sql_backend == "DUCKDB":
+            create_single_node_view(view_name, re.sub(r"^\s*AS\b", "", sql_text[view_match.end():], flags=re.IGNORECASE))
+        if force_count:
+            record["row_count"] = collect_sql(f"SELECT COUNT(*) AS filas FROM {view_name}")[0]["filas"]
+
+    if force_count:
+        print(f"View {view_name}: {record['row_count']} rows in {record['duration_s']}s.")
+
+    return result
+
+
+def create_run_metrics_table(run_metrics_table_name):
+    """Create the table that keeps the stage metrics of every run."""
+    spark.sql(f"""
+
+    CREATE TABLE IF NOT EXISTS {run_metrics_table_name} (
+      pipeline_run_id STRING COMMENT 'Ejecucion a la que pertenece la etapa.',
+      pipeline_name STRING COMMENT 'Notebook que ejecuto la etapa.',
+      stage_order INT COMMENT 'Orden de la etapa dentro de la ejecucion.',
+      stage_name STRING COMMENT 'Vista o tabla de la etapa.',
+      stage_type STRING COMMENT 'VIEW, CACHE, EXPORT, MERGE, OPTIMIZE, VACUUM, SKEW, CHECKPOINT o CHECK.',
+      job_ids ARRAY<INT> COMMENT 'Jobs de Spark lanzados por la etapa.',
+      started_at TIMESTAMP COMMENT 'Inicio de la etapa (UTC).',
+      duration_s DOUBLE COMMENT 'Duracion de la etapa en segundos.',
+      row_count BIGINT COMMENT 'Filas de la vista, solo con conteo forzado.',
+      input_rows BIGINT COMMENT 'Filas leidas de las fuentes.',
+      input_bytes BIGINT COMMENT 'Bytes leidos de las fuentes.',
+      shuffle_read_bytes BIGINT COMMENT 'Bytes leidos del shuffle.',
+      shuffle_write_bytes BIGINT COMMENT 'Bytes escritos al shuffle.',
+      memory_spill_bytes BIGINT COMMENT 'Bytes derramados en memoria.',
+      disk_spill_bytes BIGINT COMMENT 'Bytes derramados a disco.',
+      recorded_at TIMESTAMP COMMENT 'Fecha de registro de la metrica.',
+      task_median_ms BIGINT COMMENT 'Mediana del tiempo de tarea de la etapa Spark mas desbalanceada.',
+      task_max_ms BIGINT COMMENT 'Tarea mas lenta de la etapa Spark mas desbalanceada.',
+      key_rows_median DOUBLE COMMENT 'Mediana de filas por clave de join, solo etapas SKEW.',
+      key_rows_max BIGINT COMMENT 'Filas de la clave de join mas repetida, solo etapas SKEW.',
+      null_key_rows BIGINT COMMENT 'Filas con clave de join nula, solo etapas SKEW.',
+      hot_keys BIGINT COMMENT 'Claves de join sobre el umbral de salting, solo etapas SKEW.',
+      key_count BIGINT COMMENT 'Claves distintas de la vista, solo etapas CHECKPOINT y CHECK.',
+      amount_sum DOUBLE COMMENT 'Suma del monto de la vista, solo etapas CHECKPOINT y CHECK.',
+      expected_rows BIGINT COMMENT 'Filas esperadas por la regla de conservacion, solo etapas CHECK.',
+      expected_keys BIGINT COMMENT 'Claves esperadas por la regla de conservacion, solo etapas CHECK.',
+      expected_amount DOUBLE COMMENT 'Monto esperado por la regla de conservacion, solo etapas CHECK.',
+      check_passed BOOLEAN COMMENT 'Resultado de la regla de conservacion, solo etapas CHECK.',
+      mercados STRING COMMENT 'Paises de la ejecucion separados por coma, una unidad por mercado.'
+    )
+    COMMENT 'Metricas por etapa de las ejecuciones de deteccion de fraudes.'
+
+    """
+    )
+
+    # Tables created before the skew, checkpoint and market columns existed get them appended
+    existing_columns = {column.lower() for column in spark.table(run_metrics_table_name).columns}
+    missing_columns = [
+        f"{column} {data_type}"
+        for column, data_type in {**RUN_METRICS_SKEW_FIELDS, **RUN_METRICS_CHECK_FIELDS, "mercados": "STRING"}.items()
+        if column not in existing_columns
+    ]
+    if missing_columns:
+        spark.sql(f"ALTER TABLE {run_metrics_table_name} ADD COLUMNS ({', '.join(missing_columns)})")
+
+    enable_row_level_concurrency(run_metrics_table_name)
+
+
+def save_run_metrics(run_metrics_table_name, pipeline_name, run_id, country_ids):
+    """Replace the stage metrics stored for run_id and its markets with the ones collected in this run.
+
+    The market units of one orchestrated run share its run_id, so each one only replaces its own rows.
+    """
+    if not run_metrics:
+        return
+
+    mercados = ",".join(sorted(country_ids))
+
+    columns = [
+        "stage_order", "stage_name", "stage_type", "job_ids", "started_at", "duration_s", "row_count",
+        *RUN_METRICS_STAGE_FIELDS,
+        *RUN_METRICS_SKEW_FIELDS,
+        *RUN_METRICS_CHECK_FIELDS,
+    ]
+    spark.createDataFrame(
+        [tuple(record[column] for column in columns) for record in run_metrics],
+        "stage_order INT, stage_name STRING, stage_type STRING, job_ids ARRAY<INT>, started_at TIMESTAMP, duration_s DOUBLE, "
+        "row_count BIGINT, input_rows BIGINT, input_bytes BIGINT, shuffle_read_bytes BIGINT, shuffle_write_bytes BIGINT, "
+        "memory_spill_bytes BIGINT, disk_spill_bytes BIGINT, "
+        + ", ".join(f"{column} {data_type}" for column, data_type in {**RUN_METRICS_SKEW_FIELDS, **RUN_METRICS_CHECK_FIELDS}.items()),
+    ).createOrReplaceTempView("run_metrics_source")
+
+    run_delta_write(run_metrics_table_name, lambda: spark.sql(f"""
+
+    DELETE FROM {run_metrics_table_name}
+    WHERE
+      pipeline_run_id = '{run_id}'
+      AND pipeline_name = '{pipeline_name}'
+      AND mercados = '{mercados}'
+
+    """
+    ))
+    run_delta_write(run_metrics_table_name, lambda: spark.sql(f"""
+
+    INSERT INTO {run_metrics_table_name} (pipeline_run_id, pipeline_name, mercados, {", ".join(columns)}, recorded_at)
+    SELECT
+      '{run_id}' AS pipeline_run_id,
+      '{pipeline_name}' AS pipeline_name,
+      '{mercados}' AS mercados,
+      {", ".join(columns)},
+      CURRENT_TIMESTAMP() AS recorded_at
+    FROM
+      run_metrics_source
+
+    """
+    ))
+
+    print(f"Saved {len(run_metrics)} stage metrics of run {run_id} into {run_metrics_table_name}.")
+    for record in sorted(run_metrics, key=lambda r: r["duration_s"] or 0, reverse=True)[:5]:
+        print(f"  {record['stage_type']} {record['stage_name']}: {record['duration_s']}s")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 9. Column pruning check
+# MAGIC
+# MAGIC Provider sources are projected to the columns consumed downstream. A `SELECT *` over a wide source that reaches a
+# MAGIC DISTINCT, window or join cannot be pruned by the optimizer and drags every column through the shuffle.
+# MAGIC `check_shuffle_column_pruning` inspects the physical plan of the final view and fails the run when any shuffle
+# MAGIC still carries every column of one of the given source tables.
+
+# COMMAND ----------
+
+EXCHANGE_INPUT_PATTERN = re.compile(r"^\(\d+\) (\w*Exchange\w*)[^\n]*\nInput \[\d+\]: \[([^\]]*)\]", re.MULTILINE)
+
+
+def check_shuffle_column_pruning(view_name, source_table_names):
+    """Raise ValueError if a shuffle of view_name carries all the columns of any of source_table_names."""
+    plan = spark.sql(f"EXPLAIN FORMATTED SELECT * FROM {view_name}").collect()[0][0]
+
+    exchanges = [
+        {re.sub(r"#\d+L?$", "", column.strip()).lower() for column in columns.split(",") if column.strip()}
+        for _, columns in EXCHANGE_INPUT_PATTERN.findall(plan)
+    ]
+
+    wide_sources = []
+    for source_table_name in source_table_names:
+        source_columns = {column.lower() for column in spark.table(source_table_name).columns}
+        if any(source_columns <= exchange_columns for exchange_columns in exchanges):
+            wide_sources.append(source_table_name)
+
+    if wide_sources:
+        raise ValueError(
+            f"Every column of {wide_sources} reaches a shuffle of {view_name}. "
+            "Project the source to the columns consumed downstream instead of selecting *."
+        )
+
+    print(f"Column pruning check passed for {view_name}: {len(exchanges)} shuffles inspected.")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 10. Currency rate lookup
+# MAGIC
+# MAGIC The month rates in force today are kept in a small Delta lookup keyed by (source_currency_cd, calendar_month_id
+# MAGIC as INT yyyyMM), shared by both notebooks. It is rebuilt only when the rate table gets a new version or when today
+# MAGIC crosses the start or end date of one of its rates. Otherwise the run reads the lookup as is. Each run caches
+# MAGIC the lookup as the `cte_currency_rate` temp view, which is broadcast into the final projection and joined on an
+# MAGIC integer month key.
+
+# COMMAND ----------
+
+CURRENCY_RATE_TYPE_ID = 4
+
+
+def month_key_sql(date_column):
+    """Integer yyyyMM key of a date column, the join key of the currency rate lookup."""
+    return f"(YEAR({date_column}) * 100 + MONTH({date_column}))"
+
+
+def refresh_currency_rate_lookup(lookup_table_name, source_table_name, currency_type_id=CURRENCY_RATE_TYPE_ID):
+    """Rebuild the currency rate lookup if the source version or today's validity window changed."""
+    try:
+        source_version = spark.sql(f"DESCRIBE HISTORY {source_table_name} LIMIT 1").collect()[0]["version"]
+    except Exception:
+        # Not a Delta table (e.g. a view): no version to compare, so the lookup is rebuilt on every run.
+        source_version = None
+
+    if source_version is not None and spark.catalog.tableExists(lookup_table_name):
+        stored = spark.sql(f"""
+
+        SELECT MAX(source_version) AS source_version, MAX(valid_until) AS valid_until, CURRENT_DATE() AS today
+        FROM
+          {lookup_table_name}
+
+        """
+        ).collect()[0]
+
+        if stored["source_version"] == source_version and (stored["valid_until"] is None or stored["today"] < stored["valid_until"]):
+            print(f"Currency rate lookup {lookup_table_name} is current (source version {source_version}).")
+            return
+
+    # valid_until is the next date on which a rate starts or expires, when the rates in force change without a new version
+    spark.sql(f"""
+
+    CREATE OR REPLACE TABLE {lookup_table_name}
+    COMMENT 'Tipos de cambio vigentes por moneda y mes (yyyyMM) para deteccion de fraudes.'
+    AS
+    WITH limites AS (
+      SELECT MIN(
+        CASE
+          WHEN cr.curr_translation_rate_start_dt > CURRENT_DATE() THEN cr.curr_translation_rate_start_dt
+          WHEN cr.curr_translation_rate_end_dt >= CURRENT_DATE() THEN DATE_ADD(cr.curr_translation_rate_end_dt, 1)
+        END
+      ) AS valid_until
+      FROM
+        {source_table_name} AS cr
+      WHERE
+        cr.currency_type_id = {currency_type_id}
+    )
+    SELECT DISTINCT
+      cr.source_currency_cd,
+      {month_key_sql("cr.curr_trans_calendar_dt")} AS calendar_month_id,
+      cr.source_to_target_currency_rate,
+      CAST({"NULL" if source_version is None else source_version} AS BIGINT) AS source_version,
+      l.valid_until
+    FROM
+      {source_table_name} AS cr
+      CROSS JOIN limites AS l
+    WHERE
+      cr.currency_type_id = {currency_type_id}
+      AND CURRENT_DATE() BETWEEN cr.curr_translation_rate_start_dt AND cr.curr_translation_rate_end_dt
+
+    """
+    )
+
+    print(f"Currency rate lookup {lookup_table_name} rebuilt from source version {source_version}.")
+
+
+def create_currency_rate_view(lookup_table_name, source_table_name, view_name="cte_currency_rate"):
+    """Refresh the lookup if needed and cache it as view_name for the run."""
+    try:
+        refresh_currency_rate_lookup(lookup_table_name, source_table_name)
+    except Exception as e:
+        # Another run may be rebuilding the shared lookup at the same time; its result is just as valid.
+        if not spark.catalog.tableExists(lookup_table_name):
+            raise
+        print(f"Currency rate lookup refresh skipped: {e}")
+
+    with track_stage(view_name, "CACHE"):
+        cache_table_as(view_name, f"""
+        SELECT source_currency_cd, calendar_month_id, source_to_target_currency_rate
+        FROM
+          {lookup_table_name}
+        """)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 11. Pending sale order index for late events
+# MAGIC
+# MAGIC A credit note or provider refund can arrive after the sale has left the processing window. Every sale order
+# MAGIC loaded by a run is kept in a `<target>_pending_orders` index (special_sale_order → sale transaction, amount and
+# MAGIC business date) for `PENDING_ORDER_RETENTION_DAYS` before the end of the run's window. Before reading the sources, each run looks up the orders that
+# MAGIC have a late event inside the window but whose sale is older. It registers them as the `ordenes_tardias` temp view.
+# MAGIC The source views then add just those orders, by their literal sale dates and a key semi-join. The MERGE scope
+# MAGIC adds their keys, so the old target rows of those orders are rebuilt without widening the window for everyone.
+
+# COMMAND ----------
+
+PENDING_ORDER_RETENTION_DAYS = 180
+
+
+def create_pending_order_index(index_table_name):
+    """Create the index of sale orders that can still receive a credit note or a provider refund."""
+    spark.sql(f"""
+
+    CREATE TABLE IF NOT EXISTS {index_table_name} (
+      special_sale_order STRING COMMENT 'Clave del pedido.',
+      country_id STRING COMMENT 'Pais de la venta.',
+      sales_transaction_id BIGINT COMMENT 'Transaccion de venta del pedido.',
+      sales_business_dt DATE COMMENT 'Fecha comercial de la venta.',
+      venta_bruta DOUBLE COMMENT 'Venta bruta de la transaccion.',
+      pipeline_run_id STRING COMMENT 'Ejecucion que registro el pedido.',
+      registered_at TIMESTAMP COMMENT 'Fecha de registro del pedido.'
+    )
+    COMMENT 'Pedidos abiertos para conciliar notas de credito y reembolsos tardios de deteccion de fraudes.'
+    CLUSTER BY (country_id, special_sale_order)
+
+    """
+    )
+
+    # Indexes created before the market units get the country column; their rows keep a NULL country
+    if "country_id" not in {column.lower() for column in spark.table(index_table_name).columns}:
+        spark.sql(f"ALTER TABLE {index_table_name} ADD COLUMNS (country_id STRING COMMENT 'Pais de la venta.')")
+        spark.sql(f"ALTER TABLE {index_table_name} CLUSTER BY (country_id, special_sale_order)")
+
+    enable_row_level_concurrency(index_table_name)
+
+
+def find_late_orders(index_table_name, eventos_sql, fecha_inicio_ventana, country_ids, view_name="ordenes_tardias"):
+    """Register view_name with the indexed orders of country_ids older than the window that have an event in eventos_sql.
+
+    `eventos_sql` is a query returning one `special_sale_order` column: the keys of the credit notes and provider
+    events found inside the window. Returns the sorted list of distinct sale dates of the late orders.
+    """
+    cache_table_as(view_name, f"""
+    SELECT DISTINCT
+      i.special_sale_order,
+      i.sales_business_dt
+    FROM
+      {index_table_name} AS i
+    WHERE
+      i.sales_business_dt < '{fecha_inicio_ventana}'
+      AND (i.country_id IN {mercados_sql(country_ids)} OR i.country_id IS NULL)
+      AND i.special_sale_order IN ({eventos_sql})
+    """)
+
+    fechas = sorted(row["sales_business_dt"] for row in collect_sql(f"SELECT DISTINCT sales_business_dt FROM {view_name}"))
+    orders_count = collect_sql(f"SELECT COUNT(*) AS filas FROM {view_name}")[0]["filas"]
+
+    print(f"Late orders before {fecha_inicio_ventana}: {orders_count} orders on {len(fechas)} dates.")
+    return fechas
+
+
+def late_orders_filter_sql(fechas_tardias, date_column, key_expression, view_name="ordenes_tardias"):
+    """Predicate selecting the rows of the late orders: their literal sale dates plus a key semi-join."""
+    if not fechas_tardias:
+        return "FALSE"
+
+    fechas = ", ".join(f"'{fecha}'" for fecha in fechas_tardias)
+    return f"({date_column} IN ({fechas}) AND {key_expression} IN (SELECT special_sale_order FROM {view_name}))"
+
+
+def register_pending_orders(index_table_name, view_name, key_column, amount_column, date_column, country_ids, fecha_fin, run_id):
+    """Add the sales of view_name in country_ids to the index and drop their orders older than the retention period.
+
+    The retention counts back from fecha_fin, the last date of the run's window, so a backfill chunk keeps the
+    orders it has just registered. Both writes are scoped to country_ids, so market units running at the same time
+    touch disjoint rows.
+    """
+    filtro_paises = f"country_id IN {mercados_sql(country_ids)}"
+
+    run_delta_write(index_table_name, lambda: spark.sql(f"""
+
+    MERGE INTO {index_table_name} AS t
+    USING (
+      SELECT
+        {key_column} AS special_sale_order,
+        country_id,
+        MIN(sales_transaction_id) AS sales_transaction_id,
+        MIN(CAST({date_column} AS DATE)) AS sales_business_dt,
+        MIN_BY(CAST({amount_column} AS DOUBLE), sales_transaction_id) AS venta_bruta
+      FROM
+        {view_name}
+      WHERE
+        sales_type_id = 1
+        AND {key_column} IS NOT NULL
+        AND {filtro_paises}
+      GROUP BY
+        {key_column},
+        country_id
+    ) AS s
+    ON
+      t.{filtro_paises}
+      AND t.country_id = s.country_id
+      AND t.special_sale_order = s.special_sale_order
+    WHEN NOT MATCHED THEN INSERT (special_sale_order, country_id, sales_transaction_id, sales_business_dt, venta_bruta, pipeline_run_id, registered_at)
+      VALUES (s.special_sale_order, s.country_id, s.sales_transaction_id, s.sales_business_dt, s.venta_bruta, '{run_id}', CURRENT_TIMESTAMP())
+
+    """
+    ))
+
+    # Rows indexed before the country column existed are dropped by whichever unit reaches their retention first
+    run_delta_write(index_table_name, lambda: spark.sql(f"""
+
+    DELETE FROM {index_table_name}
+    WHERE
+      ({filtro_paises} OR country_id IS NULL)
+      AND sales_business_dt < DATE_SUB('{fecha_fin}', {PENDING_ORDER_RETENTION_DAYS})
+
+    """
+    ))
+    print(f"Pending order index {index_table_name} updated from {view_name}.")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 12. Keyed streaming state
+# MAGIC
+# MAGIC The streaming variant keeps its matching state in Delta tables, one per streamed source. Each table holds the
+# MAGIC latest row of every source key, the order key (`special_sale_order`) and the manual concat key (`concat_key`) of
+# MAGIC the row, its event time and the micro-batch that last touched it. The sources are read from their change feeds
+# MAGIC in one query (`delta.enableChangeDataFeed = true`). Each micro-batch is upserted into the state by key, and
+# MAGIC deletes and rows that no longer pass the source rules leave the state.
+# MAGIC
+# MAGIC The watermark of a state table is its newest event time minus the retention. Changes older than the
+# MAGIC watermark are dropped, and state rows older than it are evicted. Orders older than the retention are left to the
+# MAGIC daily batch.
+# MAGIC
+# MAGIC A row is matched together with every row sharing its order key or its concat key. The scope of a micro-batch
+# MAGIC starts from the keys of the rows it touched, before and after the change. It is then closed over the state,
+# MAGIC until no row adds a new key. Rows without a concat key form one group, as in the engine's manual key counts.
+# MAGIC Everything outside the closed scope is unaffected by the micro-batch. A failed micro-batch stops the query and
+# MAGIC is replayed from the checkpoint; the upsert of a replayed batch leaves the state as it was.
+
+# COMMAND ----------
+
+STREAMING_STATE_COLUMNS = {
+    "special_sale_order": "STRING COMMENT 'Clave del pedido de la fila.'",
+    "concat_key": "STRING COMMENT 'Clave concatenada fecha + local + monto para el cruce manual.'",
+    "event_time": "TIMESTAMP COMMENT 'Tiempo de evento de la fila, base del watermark.'",
+    "streaming_batch_id": "BIGINT COMMENT 'Ultimo micro-batch que modifico la fila.'",
+    "updated_at": "TIMESTAMP COMMENT 'Fecha de actualizacion de la fila.'",
+}
+
+
+def create_streaming_state_table(dict_fuente):
+    """Create the keyed state table of a streamed source, with the source columns it keeps plus STREAMING_STATE_COLUMNS.
+
+    dict_fuente describes the source: source_table_name, columns, state_table_name and country_column, plus the
+    keys read by change_feed_stream and upsert_streaming_state.
+    """
+    f = dict_fuente
+    schema = spark.table(f["source_table_name"]).select(*f["columns"]).schema
+    columns = [f"`{field.name}` {field.dataType.simpleString()}" for field in schema.fields]
+    columns += [f"{column} {definition}" for column, definition in STREAMING_STATE_COLUMNS.items()]
+    columns_sql = ",\n      ".join(columns)
+
+    spark.sql(f"""
+
+    CREATE TABLE IF NOT EXISTS {f["state_table_name"]} (
+      {columns_sql}
+    )
+    COMMENT 'Estado por clave del streaming de deteccion de fraudes sobre {f["source_table_name"]}.'
+    CLUSTER BY ({f["country_column"]}, special_sale_order)
+
+    """
+    )
+
+    enable_row_level_concurrency(f["state_table_name"])
+
+
+def change_feed_stream(dict_fuentes, starting_timestamp=None):
+    """One stream of (fuente, fila) over the change feeds of every source, with each change row as JSON.
+
+    A single query keeps one checkpoint and one foreachBatch for all sources. A new checkpoint starts at the latest
+    version of each table, or at `starting_timestamp` when given: versions are not shared between tables, so a
+    timestamp is the only start point common to every source.
+    """
+    stream = None
+    for fuente, f in dict_fuentes.items():
+        reader = spark.readStream.format("delta").option("readChangeFeed", "true")
+        if starting_timestamp:
+            reader = reader.option("startingTimestamp", starting_timestamp)
+        else:
+            reader = reader.option("startingVersion", "latest")
+
+        cambios = (
+            reader
+            .table(f["source_table_name"])
+            .where(f"_change_type IN ('insert', 'update_postimage', 'delete') AND ({f['where_sql']})")
+            .selectExpr(f"'{fuente}' AS fuente", f"TO_JSON(STRUCT({', '.join(f['columns'])}, _change_type, _commit_version)) AS fila")
+        )
+        stream = cambios if stream is None else stream.unionByName(cambios)
+
+    return stream
+
+
+def change_feed_rows(batch_df, fuente, dict_fuente):
+    """The change rows of one source in a micro-batch of change_feed_stream, with their source column types."""
+    schema = spark.table(dict_fuente["source_table_name"]).select(*dict_fuente["columns"]).schema.simpleString()
+    schema = schema[len("struct<"):-1] + ",_change_type:string,_commit_version:bigint"
+    return batch_df.where(f"fuente = '{fuente}'").selectExpr(f"FROM_JSON(fila, 'struct<{schema}>') AS c").select("c.*")
+
+
+def upsert_streaming_state(cambios_df, dict_fuente, batch_id, retention_days):
+    """Apply the change rows of a micro-batch to the state table and evict the rows past the watermark.
+
+    The latest change of every key wins; a delete, or a row that fails keep_sql, removes the key. Updated rows keep
+    their concat_key, which the caller recomputes. Returns the (special_sale_order, concat_key) the touched keys had
+    before the change, so that the groups they leave are matched again.
+    """
+    f = dict_fuente
+    a = f["alias"]
+    sesion = cambios_df.sparkSession
+    vista_cambios = f"{f['state_table_name'].split('.')[-1]}_cambios"
+    cambios_df.createOrReplaceTempView(vista_cambios)
+
+    filtro_paises = f"{f['country_column']} IN {mercados_sql(f['country_values'])}"
+    clave_fila = " AND ".join(f"t.{column} = s.{column}" for column in f["key_columns"])
+
+    # The watermark stays a timestamp string of the session, so it does not go through the driver's timezone
+    limite = sesion.sql(f"""
+    SELECT CAST(MAX(event_time) - INTERVAL {retention_days} DAYS AS STRING) AS limite
+    FROM (
+      SELECT event_time FROM {f["state_table_name"]} WHERE {filtro_paises}
+      UNION ALL
+      SELECT {f["event_time_sql"]} AS event_time FROM {vista_cambios} AS {a}
+    )
+    """).collect()[0]["limite"]
+    if limite is None:
+        return []
+    limite = f"TIMESTAMP '{limite}'"
+
+    sesion.sql(f"""
+
+    CREATE OR REPLACE TEMP VIEW {vista_cambios}_ultimos AS
+    SELECT
+      {", ".join(f"{a}.{column}" for column in f["columns"])},
+      {f["key_sql"]} AS special_sale_order,
+      {f["event_time_sql"]} AS event_time,
+      {a}._change_type = 'delete' OR NOT COALESCE({f["keep_sql"]}, FALSE) OR COALESCE({f["event_time_sql"]} < {limite}, FALSE) AS descartar
+    FROM
+      (
+        SELECT
+          *,
+          ROW_NUMBER() OVER (PARTITION BY {", ".join(f["key_columns"])} ORDER BY _commit_version DESC) AS orden_cambio
+        FROM
+          {vista_cambios}
+      ) AS {a}
+    WHERE
+      {a}.orden_cambio = 1
+
+    """
+    )
+
+    previas = sesion.sql(f"""
+    SELECT DISTINCT t.special_sale_order, t.concat_key
+    FROM {f["state_table_name"]} t INNER JOIN {vista_cambios}_ultimos s ON {clave_fila}
+    WHERE t.{filtro_paises}
+    """).collect()
+
+    columnas = f["columns"] + ["special_sale_order", "event_time"]
+    run_delta_write(f["state_table_name"], lambda: sesion.sql(f"""
+
+    MERGE INTO {f["state_table_name"]} AS t
+    USING {vista_cambios}_ultimos AS s
+    ON
+      t.{filtro_paises}
+      AND {clave_fila}
+    WHEN MATCHED AND s.descartar THEN DELETE
+    WHEN MATCHED THEN UPDATE SET
+      {", ".join(f"t.`{column}` = s.`{column}`" for column in columnas)},
+      t.streaming_batch_id = {batch_id},
+      t.updated_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED AND NOT s.descartar THEN INSERT ({", ".join(f"`{column}`" for column in columnas)}, concat_key, streaming_batch_id, updated_at)
+      VALUES ({", ".join(f"s.`{column}`" for column in columnas)}, NULL, {batch_id}, CURRENT_TIMESTAMP())
+
+    """
+    ))
+
+    run_delta_write(f["state_table_name"], lambda: sesion.sql(f"DELETE FROM {f['state_table_name']} WHERE {filtro_paises} AND event_time < {limite}"))
+    print(f"Streaming state {f['state_table_name']}: micro-batch {batch_id} applied, watermark {limite}.")
+
+    return [(row["special_sale_order"], row["concat_key"]) for row in previas]
+
+
+def streaming_scope_sql(claves, concats, alias):
+    """Rows of a state table (alias) in the scope: their order key is in claves or their concat key in concats."""
+    condiciones = [
+        literal_in_sql(f"{alias}.special_sale_order", claves),
+        literal_in_sql(f"{alias}.concat_key", concats),
+    ]
+    if None in concats:
+        condiciones.append(f"{alias}.concat_key IS NULL")
+    return "(" + " OR ".join(condiciones) + ")"
+
+
+def expand_streaming_scope(state_table_names, claves, concats, filtro_sql="TRUE"):
+    """Close the order keys and concat keys of a micro-batch over the rows of the state tables.
+
+    Adds the keys of every row in the scope until no row adds a new one. Only valid order keys are followed, since
+    the engine never matches on NULL or blank ids; None in concats stands for the rows without concat key.
+    """
+    claves = {clave for clave in claves if clave is not None and clave.strip()}
+    concats = set(concats)
+
+    while True:
+        filas = collect_sql(" UNION ".join(
+            f"SELECT DISTINCT s.special_sale_order, s.concat_key FROM {table_name} s WHERE {filtro_sql} AND {streaming_scope_sql(claves, concats, 's')}"
+            for table_name in state_table_names
+        ))
+        nuevas_claves = {row["special_sale_order"] for row in filas if row["special_sale_order"] is not None and row["special_sale_order"].strip()} - claves
+        nuevos_concats = {row["concat_key"] for row in filas} - concats
+        if not nuevas_claves and not nuevos_concats:
+            return claves, concats
+        claves |= nuevas_claves
+        concats |= nuevos_concats
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 13. Chunked backfill of historical ranges
+# MAGIC
+# MAGIC A historical range is split into consecutive, non-overlapping chunks of days. Each chunk is one run of the batch
+# MAGIC notebook over exactly its own dates (RANGE mode in iFood, `fecha_desde` in Yuno), so the 30 and 60-day re-reads
+# MAGIC of the scheduled runs are not repeated for every day of the range. Chunks run concurrently with bounded
+# MAGIC parallelism. Every finished chunk is recorded in a `<target>_backfill_chunks` table under the backfill id, so a
+# MAGIC backfill that is run again with the same id only runs the chunks that have not finished yet. A chunk only matches
+# MAGIC orders within its own dates. Orders whose sale and provider event fall in different chunks are matched through
+# MAGIC the pending-order index (section 11), which only sees chunks that have already finished. Chunks of later dates
+# MAGIC should therefore be rerun, or followed by a scheduled run, when the range is backfilled in parallel.
+
+# COMMAND ----------
+
+import threading
+
+BACKFILL_CORES_PER_CHUNK = 16
+
+backfill_checkpoint_lock = threading.Lock()
+
+
+def create_backfill_checkpoint_table(checkpoint_table_name):
+    """Create the table with the status of every chunk of every backfill."""
+    spark.sql(f"""
+
+    CREATE TABLE IF NOT EXISTS {checkpoint_table_name} (
+      backfill_id STRING COMMENT 'Identificador del backfill.',
+      pipeline_name STRING COMMENT 'Notebook ejecutado por el backfill.',
+      chunk_desde DATE COMMENT 'Primer dia del tramo.',
+      chunk_hasta DATE COMMENT 'Ultimo dia del tramo.',
+      status STRING COMMENT 'DONE o FAILED.',
+      attempts INT COMMENT 'Ejecuciones del tramo en la ultima corrida.',
+      error STRING COMMENT 'Ultimo error del tramo.',
+      duration_s DOUBLE COMMENT 'Duracion del tramo en segundos.',
+      updated_at TIMESTAMP COMMENT 'Fecha de la ultima actualizacion.'
+    )
+    COMMENT 'Tramos de los backfills de deteccion de fraudes.'
+
+    """
+    )
+
+
+def backfill_chunks(fecha_desde, fecha_hasta, chunk_days):
+    """Split [fecha_desde, fecha_hasta] into consecutive (desde, hasta) date pairs of at most chunk_days days."""
+    if fecha_hasta < fecha_desde:
+        raise ValueError(f"fecha_desde {fecha_desde} is after fecha_hasta {fecha_hasta}.")
+
+    chunks = []
+    chunk_desde = fecha_desde
+    while chunk_desde <= fecha_hasta:
+        chunk_hasta = min(chunk_desde + timedelta(days=chunk_days - 1), fecha_hasta)
+        chunks.append((chunk_desde, chunk_hasta))
+        chunk_desde = chunk_hasta + timedelta(days=1)
+
+    return chunks
+
+
+def backfill_parallelism(cores_per_chunk=BACKFILL_CORES_PER_CHUNK):
+    """Chunks the cluster can run at the same time, from its default parallelism."""
+    return max(1, spark.sparkContext.defaultParallelism // cores_per_chunk)
+
+
+def get_completed_chunks(checkpoint_table_name, backfill_id):
+    """(chunk_desde, chunk_hasta) pairs already DONE for the backfill."""
+    rows = spark.sql(f"""
+    SELECT chunk_desde, chunk_hasta
+    FROM {checkpoint_table_name}
+    WHERE backfill_id = '{backfill_id}' AND status = 'DONE'
+    """).collect()
+
+    return {(row["chunk_desde"], row["chunk_hasta"]) for row in rows}
+
+
+def save_backfill_chunk(checkpoint_table_name, backfill_id, pipeline_name, chunk, error, attempts, duration_s):
+    """Record the result of a chunk. Writes are serialized so concurrent chunks do not conflict on the table."""
+    chunk_desde, chunk_hasta = chunk
+    status = "DONE" if error is None else "FAILED"
+    error_sql = "NULL" if error is None else "'" + error[:2000].replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+    with backfill_checkpoint_lock:
+        spark.sql(f"""
+        MERGE INTO {checkpoint_table_name} AS t
+        USING (
+          SELECT '{backfill_id}' AS backfill_id, '{pipeline_name}' AS pipeline_name,
+            DATE '{chunk_desde}' AS chunk_desde, DATE '{chunk_hasta}' AS chunk_hasta,
+            '{status}' AS status, {attempts} AS attempts, {error_sql} AS error,
+            {duration_s:.1f} AS duration_s, CURRENT_TIMESTAMP() AS updated_at
+        ) AS s
+        ON t.backfill_id = s.backfill_id AND t.chunk_desde = s.chunk_desde AND t.chunk_hasta = s.chunk_hasta
+        WHEN MATCHED THEN UPDATE SET *
+        WHEN NOT MATCHED THEN INSERT *
+        """)
+
+
+def run_backfill(notebook_path, pipeline_name, chunks, arguments, checkpoint_table_name, backfill_id,
+                 max_parallel=None, max_attempts=2, timeout_seconds=7200):
+    """Run `notebook_path` once per chunk not yet DONE for backfill_id and return {chunk: error or None}.
+
+    Every run receives `arguments` plus `fecha_desde` and `fecha_ayer` set to the first and last day of its chunk.
+    """
+    completed = get_completed_chunks(checkpoint_table_name, backfill_id)
+    pending = [chunk for chunk in chunks if chunk not in completed]
+    print(f"Backfill {backfill_id}: {len(chunks) - len(pending)} of {len(chunks)} chunks already done, {len(pending)} to run.")
+    if not pending:
+        return {}
+
+    def run_chunk(chunk):
+        chunk_desde, chunk_hasta = chunk
+        chunk_arguments = {
+            **arguments,
+            "fecha_desde": str(chunk_desde),
+            "fecha_ayer": str(chunk_hasta),
+            "pipeline_run_id": f"{backfill_id}-{chunk_desde}",
+        }
+        start_time = time_module.time()
+        error, attempts = run_notebook_with_retries(notebook_path, chunk_arguments, f"Chunk {chunk_desde}..{chunk_hasta}", max_attempts, timeout_seconds)
+        save_backfill_chunk(checkpoint_table_name, backfill_id, pipeline_name, chunk, error, attempts, time_module.time() - start_time)
+        return chunk, error
+
+    dict_results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_parallel or backfill_parallelism(), len(pending)))) as executor:
+        futures = [executor.submit(run_chunk, chunk) for chunk in pending]
+        for future in as_completed(futures):
+            chunk, error = future.result()
+            dict_results[chunk] = error
+
+    return dict_results
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 14. Single-node SQL backend
+# MAGIC
+# MAGIC A small run, such as one small Yuno market, spends more time scheduling Spark stages for its temp views than
+# MAGIC processing its rows. With the DUCKDB backend every view is still declared in Spark, where it stays lazy and only
+# MAGIC gives the schema. The view is also created in one DuckDB process on the driver, translated from Spark SQL with
+# MAGIC sqlglot. Catalog tables are read directly from their Delta or Parquet files, so the driver needs read access to
+# MAGIC their storage. Temp views built in Spark from driver data are copied over. CACHE steps become DuckDB tables and
+# MAGIC the counts and checks of the run (`collect_sql`) are answered by DuckDB.
+# MAGIC
+# MAGIC `export_single_node_views` then replaces the views the MERGE reads with the DuckDB result, cast to the Spark
+# MAGIC schema of each view, so the MERGE and the target table do not change. The `sql_backend` widget defaults to
+# MAGIC SPARK; DUCKDB is opt-in, per run. AUTO picks DUCKDB when duckdb and sqlglot are installed and the estimated row
+# MAGIC count of the run is at most `SINGLE_NODE_MAX_ROWS`.
+# MAGIC `benchmarks/check_backend_parity.py` compares both backends on the same data.
+
+# COMMAND ----------
+
+import importlib.util
+
+SQL_BACKENDS = ["SPARK", "AUTO", "DUCKDB"]
+
+SINGLE_NODE_MAX_ROWS = 2000000
+
+# Spark functions sqlglot leaves untranslated, renamed to their DuckDB counterpart. XXHASH64 only builds join keys
+# and salts inside the view chain, so DuckDB's own 64-bit hash gives the same matches.
+SINGLE_NODE_FUNCTIONS = {"XXHASH64": "HASH"}
+
+SINGLE_NODE_MACROS = [
+    "CREATE OR REPLACE MACRO pmod(a, b) AS ((a % b) + b) % b",
+    """CREATE OR REPLACE MACRO substring_index(s, delim, n) AS
+    CASE WHEN n >= 0 THEN ARRAY_TO_STRING(STRING_SPLIT(s, delim)[1:n], delim) ELSE ARRAY_TO_STRING(STRING_SPLIT(s, delim)[n:], delim) END""",
+]
+
+# DuckDB type of each Spark type of an exported view; decimals keep their precision and scale
+SINGLE_NODE_TYPES = {
+    "string": "VARCHAR",
+    "boolean": "BOOLEAN",
+    "tinyint": "TINYINT",
+    "smallint": "SMALLINT",
+    "int": "INTEGER",
+    "bigint": "BIGINT",
+    "float": "FLOAT",
+    "double": "DOUBLE",
+    "date": "DATE",
+    "timestamp": "TIMESTAMP",
+    "timestamp_ntz": "TIMESTAMP",
+}
+
+sql_backend = "SPARK"
+single_node_connection = None
+single_node_relations = {}
+single_node_queries = {}
+
+
+def single_node_available():
+    """True when duckdb and sqlglot can be imported on the driver."""
+    return importlib.util.find_spec("duckdb") is not None and importlib.util.find_spec("sqlglot") is not None
+
+
+def choose_sql_backend(requested="SPARK", estimate_sql=None, max_rows=SINGLE_NODE_MAX_ROWS):
+    """Set the backend of the view chain for the run and return it.
+
+    AUTO picks DUCKDB when duckdb and sqlglot are installed and `estimate_sql`, a query returning one row count, is
+    at most max_rows; SPARK otherwise. Must be called before the first view is created.
+    """
+    global sql_backend
+
+    requested = (requested or "SPARK").upper()
+    if requested not in SQL_BACKENDS:
+        raise ValueError(f"Unknown SQL backend {requested}; expected one of {SQL_BACKENDS}.")
+    if requested == "DUCKDB" and not single_node_available():
+        raise ValueError("The DUCKDB backend needs the duckdb and sqlglot packages on the driver.")
+
+    if requested != "AUTO":
+        sql_backend, reason = requested, "requested"
+    elif not single_node_available():
+        sql_backend, reason = "SPARK", "duckdb or sqlglot not installed"
+    elif estimate_sql is None:
+        sql_backend, reason = "SPARK", "no row estimate"
+    else:
+        estimated_rows = spark.sql(estimate_sql).first()[0] or 0
+        sql_backend = "DUCKDB" if estimated_rows <= max_rows else "SPARK"
+        reason = f"{estimated_rows} estimated rows, limit {max_rows}"
+
+    print(f"SQL backend: {sql_backend} ({reason}).")
+    return sql_backend
+
+
+def get_single_node_connection():
+    """The DuckDB connection of the run, created on first use."""
+    global single_node_connection
+
+    if single_node_connection is None:
+        import duckdb
+
+        single_node_connection = duckdb.connect()
+        # Naive timestamps are read and written in the Spark session time zone, as Spark does
+        single_node_connection.execute(f"SET TimeZone = '{spark.conf.get('spark.sql.session.timeZone')}'")
+        for macro_sql in SINGLE_NODE_MACROS:
+            single_node_connection.execute(macro_sql)
+        single_node_relations.clear()
+        single_node_queries.clear()
+
+    return single_node_connection
+
+
+def close_single_node_connection():
+    """Close the DuckDB connection of the run, if any."""
+    global single_node_connection
+
+    if single_node_connection is not None:
+        single_node_connection.close()
+        single_node_connection = None
+
+
+def register_single_node_source(table_name):
+    """Expose a catalog table or a Spark temp view to DuckDB and return the DuckDB relation that replaces it."""
+    key = table_name.lower()
+    if key in single_node_relations:
+        return single_node_relations[key]
+
+    con = get_single_node_connection()
+    relation_name = "src_" + re.sub(r"\W", "_", key)
+
+    if "." not in table_name:
+        # A temp view built in Spark from driver data, such as ventana_utc_pais: its rows are copied
+        df_rows = spark.table(table_name).toPandas()
+        con.register(f"{relation_name}_rows", df_rows)
+        con.execute(f"CREATE OR REPLACE TABLE {relation_name} AS SELECT * FROM {relation_name}_rows")
+        con.unregister(f"{relation_name}_rows")
+    else:
+        detail = {row["col_name"]: row["data_type"] for row in spark.sql(f"DESCRIBE TABLE EXTENDED {table_name}").collect()}
+        location = re.sub(r"^file:", "", detail["Location"]).rstrip("/")
+        provider = (detail.get("Provider") or "delta").lower()
+
+        if provider == "delta":
+            con.execute("INSTALL delta")
+            con.execute("LOAD delta")
+            scan_sql = f"delta_scan('{location}')"
+        elif provider == "parquet":
+            scan_sql = f"read_parquet('{location}/**/*.parquet', hive_partitioning = true)"
+        else:
+            raise ValueError(f"{table_name}: the DUCKDB backend cannot read {provider} tables.")
+
+        con.execute(f"CREATE OR REPLACE VIEW {relation_name} AS SELECT * FROM {scan_sql}")
+
+    single_node_relations[key] = relation_name
+    return relation_name
+
+
+def single_node_sql(sql_text):
+    """Translate a Spark SQL query to DuckDB, pointing its tables at the DuckDB relations that replace them."""
+    import sqlglot
+    from sqlglot import exp
+
+    tree = sqlglot.parse_one(sql_text, read="databricks")
+    cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+
+    # Join hints have no DuckDB counterpart
+    for hint in list(tree.find_all(exp.Hint)):
+        hint.pop()
+
+    for table in list(tree.find_all(exp.Table)):
+        table_name = ".".join(part.name for part in table.parts)
+        if not table.name or table_name.lower() in cte_names:
+            continue
+        table.set("this", exp.to_identifier(register_single_node_source(table_name)))
+        table.set("db", None)
+        table.set("catalog", None)
+
+    for function in list(tree.find_all(exp.Anonymous)):
+        if function.name.upper() in SINGLE_NODE_FUNCTIONS:
+            function.set("this", SINGLE_NODE_FUNCTIONS[function.name.upper()])
+
+    # Spark turns the number of NVL(key, 0) into a string next to a string column, DuckDB refuses to mix them. A
+    # string literal takes the type of the other arguments in DuckDB, so the result type is Spark's either way.
+    for coalesce in list(tree.find_all(exp.Coalesce)):
+        arguments = [coalesce.this, *coalesce.expressions]
+        if any(not isinstance(argument, (exp.Literal, exp.Null)) for argument in arguments):
+            for argument in arguments:
+                if isinstance(argument, exp.Literal) and not argument.is_string:
+                    argument.replace(exp.Literal.string(argument.this))
+
+    # sqlglot reads FROM_UTC_TIMESTAMP(ts, tz) as `ts AT TIME ZONE tz`, which DuckDB applies the other way round
+    for at_time_zone in list(tree.find_all(exp.AtTimeZone)):
+        at_time_zone.replace(
+            exp.Anonymous(this="TIMEZONE", expressions=[at_time_zone.args["zone"], exp.cast(at_time_zone.this, "TIMESTAMPTZ")])
+        )
+
+    return tree.sql(dialect="duckdb")
+
+
+def create_single_node_view(view_name, select_sql, materialize=False):
+    """Create view_name in DuckDB from a Spark SQL query, as a table when `materialize`."""
+    con = get_single_node_connection()
+    duckdb_sql = single_node_sql(select_sql)
+
+    drop_single_node_relation(view_name)
+    con.execute(f"CREATE {'TABLE' if materialize else 'VIEW'} {view_name} AS {duckdb_sql}")
+
+    single_node_relations[view_name.lower()] = view_name
+    single_node_queries[view_name.lower()] = (duckdb_sql, materialize)
+
+
+def drop_single_node_relation(view_name):
+    """Drop a view or table created by create_single_node_view, so a view can be redefined with another kind."""
+    if view_name.lower() in single_node_queries:
+        _, materialized = single_node_queries.pop(view_name.lower())
+        get_single_node_connection().execute(f"DROP {'TABLE' if materialized else 'VIEW'} {view_name}")
+
+
+def materialize_single_node_view(view_name):
+    """Replace a DuckDB view by a table with its rows, the DuckDB counterpart of CACHE TABLE."""
+    duckdb_sql, materialized = single_node_queries[view_name.lower()]
+    if materialized:
+        return
+
+    drop_single_node_relation(view_name)
+    get_single_node_connection().execute(f"CREATE TABLE {view_name} AS {duckdb_sql}")
+    single_node_queries[view_name.lower()] = (duckdb_sql, True)
+
+
+def collect_sql(sql_text):
+    """Run a query on the active SQL backend and return its rows as Spark Rows."""
+    if sql_backend != "DUCKDB":
+        return spark.sql(sql_text).collect()
+
+    from pyspark.sql import Row
+
+    result = get_single_node_connection().sql(single_node_sql(sql_text))
+    return [Row(**dict(zip(result.columns, values))) for values in result.fetchall()]
+
+
+def single_node_column_sql(column, field):
+    """Select item casting a DuckDB result column to the DuckDB type of a Spark field."""
+    spark_type = field.dataType.simpleString()
+    duckdb_type = spark_type.upper() if spark_type.startswith("decimal") else SINGLE_NODE_TYPES.get(spark_type)
+
+    if duckdb_type is None:
+        return f'"{column}" AS "{field.name}"'
+    return f'CAST("{column}" AS {duckdb_type}) AS "{field.name}"'
+
+
+def export_single_node_views(view_names):
+    """Replace Spark views by their DuckDB rows, cast to the Spark schema of each view. No-op on the SPARK backend."""
+    if sql_backend != "DUCKDB":
+        return
+
+    con = get_single_node_connection()
+    for view_name in view_names:
+        with track_stage(view_name, "EXPORT") as record:
+            schema = spark.table(view_name).schema
+            columns = con.sql(f"SELECT * FROM {view_name}").columns
+            if len(columns) != len(schema.fields):
+                raise ValueError(f"{view_name}: DuckDB returned {len(columns)} columns, Spark declares {len(schema.fields)}.")
+
+            select_items = ", ".join(single_node_column_sql(column, field) for column, field in zip(columns, schema.fields))
+            arrow_rows = con.sql(f"SELECT {select_items} FROM {view_name}").fetch_arrow_table()
+            df_rows = arrow_rows.to_pandas(integer_object_nulls=True, date_as_object=True)
+            spark.createDataFrame(df_rows, schema=schema).createOrReplaceTempView(view_name)
+            record["row_count"] = len(df_rows)
+
+        print(f"Exported {view_name} from DuckDB: {record['row_count']} rows.")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 15. Eligible payment lines
+# MAGIC
+# MAGIC The TLD views only need to know whether a sale has a payment line accepted by the payment-subtype rule of the
+# MAGIC pipeline. A row-for-row join with the payment lines returned the sale once per line. The downstream DISTINCTs
+# MAGIC and manual key counts then had to deal with the copies. A `<target>_eligible_payment_lines` table keeps one row per
+# MAGIC (rule_id, sales_transaction_id, country_id, location_id) with an eligible line, and the newest adls_audit_date
+# MAGIC of its eligible lines. Each run refreshes it from the payment lines changed since the watermark of the rule
+# MAGIC and country. Every line of a changed key is re-read, so a key whose lines no longer pass the rule is deleted.
+# MAGIC The TLD views use the table as an existence filter.
+
+# COMMAND ----------
+
+def create_eligible_payment_lines_table(eligible_table_name):
+    """Create the table of sales with a payment line accepted by each payment-subtype rule, and its watermarks."""
+    spark.sql(f"""
+
+    CREATE TABLE IF NOT EXISTS {eligible_table_name} (
+      rule_id STRING COMMENT 'Regla de subtipo de pago que acepta la linea.',
+      sales_transaction_id BIGINT COMMENT 'Transaccion de venta con al menos una linea de pago aceptada.',
+      country_id STRING COMMENT 'Pais de la transaccion.',
+      location_id STRING COMMENT 'Local de la transaccion.',
+      adls_audit_date TIMESTAMP COMMENT 'Ultimo adls_audit_date de las lineas de pago aceptadas.',
+      pipeline_run_id STRING COMMENT 'Ejecucion que actualizo la fila.',
+      updated_at TIMESTAMP COMMENT 'Fecha de actualizacion de la fila.'
+    )
+    COMMENT 'Transacciones con lineas de pago elegibles por regla de subtipo de pago para deteccion de fraudes.'
+    CLUSTER BY (country_id, sales_transaction_id)
+
+    """
+    )
+
+    enable_row_level_concurrency(eligible_table_name)
+    create_watermark_table(f"{eligible_table_name}_watermarks")
+
+
+def refresh_eligible_payment_lines(eligible_table_name, source_table_name, rule_id, rule_sql, country_ids, run_id):
+    """Bring the keys of rule_id in country_ids up to date with the payment lines changed since the last refresh.
+
+    `rule_sql` is a predicate on the payment line columns, e.g. "payment_subtype_id = '28_086'".
+    """
+    watermark_table_name = f"{eligible_table_name}_watermarks"
+    dict_sources = {f"{rule_id}:{country_id}": source_table_name for country_id in country_ids}
+
+    # The high-water mark is captured before the lines are read, as in the incremental loads
+    current_watermark = get_source_high_water_marks({rule_id: source_table_name})[rule_id]
+    if current_watermark is None:
+        print(f"Eligible payment lines {rule_id}: {source_table_name} is empty, nothing to refresh.")
+        return
+
+    previous_watermarks = get_watermarks(watermark_table_name, list(dict_sources)).values()
+    previous_watermark = None if None in previous_watermarks else min(previous_watermarks)
+
+    filtro_paises = f"country_id IN {mercados_sql(country_ids)}"
+    filtro_cambios = f"adls_audit_date <= '{current_watermark}'"
+    if previous_watermark is not None:
+        # Only the keys with a changed line are rebuilt, from all of their lines
+        filtro_cambios = f"""(sales_transaction_id, country_id, location_id) IN (
+          SELECT sales_transaction_id, country_id, location_id
+          FROM
+            {source_table_name}
+          WHERE
+            {filtro_paises}
+            AND adls_audit_date > '{previous_watermark}'
+            AND adls_audit_date <= '{current_watermark}'
+        )"""
+
+    run_delta_write(eligible_table_name, lambda: spark.sql(f"""
+
+    MERGE INTO {eligible_table_name} AS t
+    USING (
+      SELECT
+        sales_transaction_id,
+        country_id,
+        CAST(location_id AS STRING) AS location_id,
+        MAX(CASE WHEN {rule_sql} THEN adls_audit_date END) AS adls_audit_date,
+        COUNT_IF({rule_sql}) AS lineas_elegibles
+      FROM
+        {source_table_name}
+      WHERE
+        {filtro_paises}
+        AND {filtro_cambios}
+      GROUP BY
+        sales_transaction_id,
+        country_id,
+        CAST(location_id AS STRING)
+    ) AS s
+    ON
+      t.rule_id = '{rule_id}'
+      AND t.{filtro_paises}
+      AND t.sales_transaction_id = s.sales_transaction_id
+      AND t.country_id = s.country_id
+      AND t.location_id = s.location_id
+    WHEN MATCHED AND s.lineas_elegibles = 0 THEN DELETE
+    WHEN MATCHED THEN UPDATE SET
+      t.adls_audit_date = s.adls_audit_date,
+      t.pipeline_run_id = '{run_id}',
+      t.updated_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED AND s.lineas_elegibles > 0 THEN INSERT (rule_id, sales_transaction_id, country_id, location_id, adls_audit_date, pipeline_run_id, updated_at)
+      VALUES ('{rule_id}', s.sales_transaction_id, s.country_id, s.location_id, s.adls_audit_date, '{run_id}', CURRENT_TIMESTAMP())
+
+    """
+    ))
+
+    save_watermarks(watermark_table_name, dict_sources, {source_name: current_watermark for source_name in dict_sources}, run_id)
+    print(f"Eligible payment lines {rule_id} refreshed for {country_ids}: {previous_watermark} -> {current_watermark}")
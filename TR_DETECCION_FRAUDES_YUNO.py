@@ -7,6 +7,14 @@
 
 # COMMAND ----------
 
+# MAGIC %run "./TR_DETECCION_FRAUDES_INCLUDE"
+
+# COMMAND ----------
+
+# MAGIC %run "./TR_DETECCION_FRAUDES_YUNO_INCLUDE"
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC # 1. Define widgets
 # MAGIC
@@ -14,8 +22,11 @@
 # COMMAND ----------
 
 dbutils.widgets.text('fecha_ayer', '')
+dbutils.widgets.text('fecha_desde', '', 'Window start (YYYY-MM-DD, backfill only)')
 dbutils.widgets.text('mercados', '', 'Country IDs (tuple) e.g., ("080", "131")') # Example default for UY, CR
 dbutils.widgets.text('pipeline_run_id', '')
+dbutils.widgets.dropdown('metrics_force_count', 'false', ['false', 'true'], 'Count every view (metrics)')
+dbutils.widgets.dropdown('sql_backend', 'SPARK', ['SPARK', 'AUTO', 'DUCKDB'], 'SQL backend of the views')
 
 # COMMAND ----------
 
@@ -31,8 +42,13 @@ from datetime import datetime, timedelta
 
 # Get widget values
 fecha_ayer = dbutils.widgets.get('fecha_ayer').strip() if dbutils.widgets.get('fecha_ayer').strip() != '' else (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
-mercados = dbutils.widgets.get('mercados').strip() # Keep as string, will be used directly in SQL IN clause
+mercados = dbutils.widgets.get('mercados').strip() # Tuple of country ids; a single country when run as a market unit
+lista_mercados = parse_mercados(mercados)
+if not lista_mercados:
+    raise ValueError("The 'mercados' widget is empty. Pass a tuple of country ids, e.g. (\"080\", \"131\").")
 pipeline_run_id = dbutils.widgets.get('pipeline_run_id').strip() if dbutils.widgets.get('pipeline_run_id').strip() != '' else 'Ejecución Manual'
+RUN_METRICS_FORCE_COUNT = dbutils.widgets.get('metrics_force_count') == 'true'
+fecha_desde = dbutils.widgets.get('fecha_desde').strip()
 
 # Get target table details using the helper function
 _, _, _, table_full_name = get_table_full_name()
@@ -58,9 +74,16 @@ try:
     print(f"Calculated Processing End Date: {fecha_ayer}")
     dias_ventana = -30
 
+    if fecha_desde:
+        # Backfill chunk: exactly [fecha_desde, fecha_ayer], consecutive chunks do not re-read each other's days
+        dias_ventana = -(fecha_ayer_date - datetime.strptime(fecha_desde, '%Y-%m-%d')).days
+        print(f"Backfill window: {fecha_desde} to {fecha_ayer}.")
+
 except ValueError as e:
-    raise ValueError(f"Error parsing date 'fecha_ayer': {fecha_ayer}. Ensure format is YYYY-MM-DD. Error: {e}")
+    raise ValueError(f"Error parsing date 'fecha_ayer' or 'fecha_desde': {fecha_ayer}, {fecha_desde}. Ensure format is YYYY-MM-DD. Error: {e}")
 
+if dias_ventana > 0:
+    raise ValueError(f"fecha_desde {fecha_desde} is after fecha_ayer {fecha_ayer}.")
 
 # COMMAND ----------
 
@@ -149,9 +172,12 @@ dict_table_metadata = {
         {"name": "nc_status", "type": "STRING", "comment": "Estado de la nota de crédito."},
         {"name": "external_order_cancellation_date", "type": "STRING", "comment": "Fecha de cancelación del pedido externo."},
         {"name": "external_order_cancellation_liability", "type": "STRING", "comment": "Responsabilidad de la cancelación del pedido externo."},
-        {"name": "external_order_cancellation_code_description", "type": "STRING", "comment": "Descripción del código de cancelación."}
+        {"name": "external_order_cancellation_code_description", "type": "STRING", "comment": "Descripción del código de cancelación."},
+        {"name": "row_hash", "type": "STRING", "comment": "Hash del contenido de la fila, usado por la carga MERGE para detectar cambios."}
     ],
-    "primary_key": ["id"]
+    "primary_key": ["id"],
+    # Every load deletes by sales_business_dt and country; the dashboards filter by country as well
+    "cluster_by": ["sales_business_dt", "country_name_desc"]
 }
 
 create_or_alter_table(
@@ -159,6 +185,13 @@ create_or_alter_table(
     dict_table_metadata=dict_table_metadata
 )
 
+apply_table_layout(table_full_name, dict_table_metadata)
+# Market units MERGE into the same target, each scoped to its own countries
+enable_row_level_concurrency(table_full_name)
+
+run_metrics_table_name = f"{table_full_name}_run_metrics"
+create_run_metrics_table(run_metrics_table_name)
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -171,985 +204,202 @@ l1_raw_catalog_name_prod = 'l1_raw'
 
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal de TLD (`_TLD_YUNO`)
-spark.sql(f"""
-CREATE OR REPLACE TEMPORARY VIEW tr_deteccion_fraudes_yuno_TLD_YUNO AS
-
-SELECT
-    st.SALES_TRANSACTION_ID,
-    st.SPECIALSALEORDERLD AS SPECIAL_SALE_ORDER,
-    st.SALEKEY,
-    st.INTEGRATED,
-    st.SALES_TYPE_ID,
-    st.POS_REGISTER_ID,
-    st.COUNTRY_ID,
-    cou.COUNTRY_NAME_DESC,
-    loc.OWNERSHIPS,
-    st.LOYALTY_MCID AS MC_ID,
-    st.SALES_DATE,
-    st.SALES_BUSINESS_DT AS FECHA,
-    st.sales_start_dttm,
-    st.sales_end_dttm,
-    lss.SALE_CHANNEL_ID,
-    lss.SALE_SUBCHANNEL_ID,
-    cm.SALE_CHANNEL_DESC AS CHANNEL_NAME_DESC,
-    lss.SALE_SUBCHANNEL_DESC AS SUBCHANNEL_NAME_DESC,
-    ROUND(st.SALES_GROSS_AMT, 5) AS VENTA_BRUT_LC,
-    st.MANAGER_ASSOCIATE_ID,
-    st.SALES_ASSOCIATE_ID,
-    loc.LOCATION_ID,
-    loc.LOCATION_BASE_ID,
-    loc.LOCATION_NAME,
-    loc.LOC_STORE_OAK_ID
-FROM
-    {l1_raw_catalog_name_prod}.adw.SALES_TRANSACTION_SIN_BRASIL ST -- Table for non-Brazil countries
-    INNER JOIN {l2_foundation_catalog_name}.common.lk_sale_subchannel lss ON st.sale_subchannel_id = lss.sale_subchannel_id
-    INNER JOIN {l2_foundation_catalog_name}.common.lk_sale_channel cm ON lss.sale_channel_id = cm.sale_channel_id
-    INNER JOIN {l3_foundation_catalog_name}.common.dim_location loc ON loc.LOCATION_ID = st.LOCATION_ID AND loc.LOCATION_END_DT = '9999-12-31T00:00:00Z'
-    INNER JOIN {l3_foundation_catalog_name}.common.dim_country cou ON cou.country_id = st.COUNTRY_ID AND cou.COUNTRY_END_DT = '9999-12-31T00:00:00Z'
-    LEFT JOIN {l1_raw_catalog_name_prod}.adw.payment_line_sin_brasil pl on st.SALES_TRANSACTION_ID = pl.SALES_TRANSACTION_ID and st.country_id = pl.country_id and st.location_id = pl.location_id
-WHERE
-    st.SALES_BUSINESS_DT BETWEEN date_add('{fecha_ayer}T00:00:00.000', {dias_ventana}) AND '{fecha_ayer}T23:59:59.999'
-    AND (
-        (lss.SALE_SUBCHANNEL_ID IN (2002) AND upper(st.PARTNER_DESC) = 'MCD APP') OR
-        lss.SALE_SUBCHANNEL_ID IN (1001, 1002, 1003) OR
-        (lss.SALE_SUBCHANNEL_ID IN (1004) AND st.channel_id <> 99)
-    )
-    AND st.COUNTRY_ID IN {mercados}
-    AND st.SALES_GROSS_AMT NOT BETWEEN 0 AND 0.2
-    AND st.SALES_TYPE_ID IN (1, 2)
-    
-    ------- omitir transacciones en efectivo en colombia en yuno
-    and pl.PAYMENT_SUBTYPE_ID not in ('1_102','47_102')
-    -----------------------------------------------------------
-/*
-UNION ALL -- Combine with Brazil data
-
--- Section for Brazil (not filtered by 'mercados' widget)
-SELECT
-    st.SALES_TRANSACTION_ID,
-    st.SPECIALSALEORDERLD AS SPECIAL_SALE_ORDER,
-    st.SALEKEY,
-    st.INTEGRATED,
-    st.SALES_TYPE_ID,
-    st.POS_REGISTER_ID,
-    st.COUNTRY_ID,
-    cou.COUNTRY_NAME_DESC,
-    loc.OWNERSHIPS,
-    st.LOYALTY_MCID AS MC_ID,
-    st.SALES_DATE,
-    st.SALES_BUSINESS_DT AS FECHA,
-    st.sales_start_dttm,
-    st.sales_end_dttm,
-    lss.SALE_CHANNEL_ID,
-    lss.SALE_SUBCHANNEL_ID,
-    cm.SALE_CHANNEL_DESC AS CHANNEL_NAME_DESC,
-    lss.SALE_SUBCHANNEL_DESC AS SUBCHANNEL_NAME_DESC,
-    ROUND(st.SALES_GROSS_AMT, 5) AS VENTA_BRUT_LC,
-    st.MANAGER_ASSOCIATE_ID,
-    st.SALES_ASSOCIATE_ID,
-    loc.LOCATION_ID,
-    loc.LOCATION_BASE_ID,
-    loc.LOCATION_NAME,
-    loc.LOC_STORE_OAK_ID
-FROM
-    {l1_raw_catalog_name_prod}.adw.SALES_TRANSACTION ST -- Table specifically for Brazil
-    INNER JOIN {l2_foundation_catalog_name}.common.lk_sale_subchannel lss ON st.sale_subchannel_id = lss.sale_subchannel_id
-    INNER JOIN {l2_foundation_catalog_name}.common.lk_sale_channel cm ON lss.sale_channel_id = cm.sale_channel_id
-    INNER JOIN {l3_foundation_catalog_name}.common.dim_location loc ON loc.LOCATION_ID = st.LOCATION_ID AND loc.LOCATION_END_DT = '9999-12-31T00:00:00Z'
-    INNER JOIN {l3_foundation_catalog_name}.common.dim_country cou ON cou.country_id = st.COUNTRY_ID AND cou.COUNTRY_END_DT = '9999-12-31T00:00:00Z'
-WHERE
-    st.SALES_BUSINESS_DT BETWEEN date_add('{fecha_ayer}T00:00:00.000', {dias_ventana}) AND '{fecha_ayer}T23:59:59.999'
-    AND (
-        (lss.SALE_SUBCHANNEL_ID IN (2002) AND upper(st.PARTNER_DESC) = 'MCD APP') OR
-        lss.SALE_SUBCHANNEL_ID IN (1001, 1002, 1003) OR
-        (lss.SALE_SUBCHANNEL_ID IN (1004) AND st.channel_id <> 99)
-    )
-    -- No COUNTRY_ID filter here, assuming this table is only Brazil and should always be included
-    AND st.SALES_GROSS_AMT NOT BETWEEN 0 AND 0.2
-    AND st.SALES_TYPE_ID IN (1, 2) -- Include sales (1) and credit notes (2)
-    */
-"""
+# DBTITLE 1,Motor SQL de la Corrida (Spark o DuckDB)
+# Spark unless the widget asks otherwise; with AUTO, small markets run the view chain on DuckDB in the driver.
+# The estimate is the TLD rows of the window.
+choose_sql_backend(
+    dbutils.widgets.get('sql_backend'),
+    estimate_sql=f"""
+    SELECT COUNT(*)
+    FROM {l1_raw_catalog_name_prod}.adw.SALES_TRANSACTION_SIN_BRASIL
+    WHERE SALES_BUSINESS_DT BETWEEN date_add('{fecha_ayer}T00:00:00.000', {dias_ventana}) AND '{fecha_ayer}T23:59:59.999'
+      AND COUNTRY_ID IN {mercados_sql(lista_mercados)}
+      AND SALES_TYPE_ID IN (1, 2)
+    """,
 )
 
-
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal de Notas de Crédito (`cte_nc`)
-spark.sql( f"""
-CREATE OR REPLACE TEMP VIEW cte_nc AS
-SELECT DISTINCT
-    sales_start_dttm,
-    sales_end_dttm,
-    SALES_DATE,
-    LOCATION_NAME,
-    SALES_TRANSACTION_ID,
-    SPECIAL_SALE_ORDER,
-    VENTA_BRUT_LC AS VENTA_BRUTA_NC,
-    ROW_NUMBER() OVER(PARTITION BY SPECIAL_SALE_ORDER ORDER BY SALES_TRANSACTION_ID DESC) as aux_Orden_NC
-FROM
-    tr_deteccion_fraudes_yuno_TLD_YUNO
-WHERE
-    SALES_TYPE_ID = 2
-    AND SPECIAL_SALE_ORDER IS NOT NULL
-"""
-)
-
+# DBTITLE 1,Snapshots de Dimensiones (`*_actual`)
+create_dimension_snapshots()
 
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal de Notas de Crédito Duplicadas (`cte_nc_duplicadas`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_nc_duplicadas AS
-SELECT DISTINCT
-    SPECIAL_SALE_ORDER
-FROM
-    cte_nc
-WHERE
-    aux_Orden_NC > 1
-"""
-)
+# DBTITLE 1,Ventana UTC por País (`ventana_utc_pais`)
+# Yuno timestamps are UTC; the local window is resolved per country once here and applied as literal ranges.
+# Only the markets of this run get a window, so Yuno payments of other countries are not read.
+fecha_inicio_ventana = (datetime.strptime(fecha_ayer, '%Y-%m-%d') + timedelta(days=dias_ventana)).strftime('%Y-%m-%d')
+ventanas_utc = create_country_utc_windows(fecha_inicio_ventana, fecha_ayer, country_ids=lista_mercados)
 
+filtro_utc_transactions = country_utc_window_filter(ventanas_utc, "y.created_at", "y.country")
+filtro_utc_pagos = country_utc_window_filter(ventanas_utc, "p.created_at", "p.country")
 
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal de Transacciones Yuno (`cte_yuno_transactions`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_yuno_transactions AS
-SELECT
-    y.*,
-    ROW_NUMBER() OVER(PARTITION BY merchant_order_id ORDER BY created_at DESC) AS aux_ordenTransaction
-FROM
-    {l2_foundation_catalog_name}.app_yuno.tr_transactions y 
-    INNER JOIN {l3_foundation_catalog_name}.common.dim_country c ON c.COUNTRY_SHORT_ABBREVIATION_CD = y.country AND c.COUNTRY_END_DT = '9999-12-31T00:00:00Z'
-WHERE
-    y.status = 'SUCCEEDED'
-    AND y.created_at BETWEEN
-        TIMESTAMPADD(HOUR, -1 * (TIMESTAMPDIFF(HOUR, current_timestamp(), FROM_UTC_TIMESTAMP(CURRENT_TIMESTAMP(), c.COUNTRY_TIMEZONE))), date_add('{fecha_ayer}T00:00:00.000', {dias_ventana}))
-    AND
-        TIMESTAMPADD(HOUR, -1 * (TIMESTAMPDIFF(HOUR, current_timestamp(), FROM_UTC_TIMESTAMP(CURRENT_TIMESTAMP(), c.COUNTRY_TIMEZONE))), '{fecha_ayer}T23:59:59.999')
-"""
-)
-print("Created temporary view cte_yuno_transactions.")
-
-# COMMAND ----------
-
-# DBTITLE 1,Creación de Vista Temporal de Última Transacción Yuno (`cte_yuno_ultima_transaction`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_yuno_ultima_transaction AS
-SELECT
-    payment_id,
-    provider_id
-FROM
-    cte_yuno_transactions
-WHERE
-    aux_ordenTransaction = 1
-"""
-)
-print("Created temporary view cte_yuno_ultima_transaction.")
+# DBTITLE 1,Pedidos Tardíos desde el Índice de Pedidos Pendientes (`ordenes_tardias`)
+# Credit notes and Yuno refunds inside the window whose sale is older than the window. Only those orders are read
+# outside the window, by their literal sale dates and key.
+pending_orders_table_name = f"{table_full_name}_pending_orders"
+create_pending_order_index(pending_orders_table_name)
 
-# COMMAND ----------
+inicio_utc_ventana = utc_timestamp_literal(min(w["inicio_utc"] for w in ventanas_utc))
+fin_utc_ventana = utc_timestamp_literal(max(w["fin_utc"] for w in ventanas_utc))
+paises_ventana = mercados_sql([w["COUNTRY_SHORT_ABBREVIATION_CD"] for w in ventanas_utc])
 
-# DBTITLE 1,Creación de Vista Temporal de Pagos Yuno (`cte_yuno`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_yuno AS
-SELECT
-    c.COUNTRY_NAME_DESC,
-    l.LOCATION_ACRONYM_CD,
-    l.OWNERSHIPS,
-    SUBSTRING(p.merchant_order_id, CHARINDEX('-', p.merchant_order_id) + 1, LENGTH(p.merchant_order_id) - CHARINDEX('-', p.merchant_order_id)) AS SPECIAL_SALES_ORDER,
-    FROM_UTC_TIMESTAMP(p.created_at, c.COUNTRY_TIMEZONE) AS created_at_local,
-    FROM_UTC_TIMESTAMP(p.updated_at, c.COUNTRY_TIMEZONE) AS updated_at_local,
-    ROW_NUMBER() OVER(PARTITION BY p.merchant_order_id ORDER BY p.updated_at DESC) as aux_OrdenTransaccion,
-    p.* 
-FROM
-    {l2_foundation_catalog_name}.app_yuno.tr_payments p
-    LEFT JOIN {l3_foundation_catalog_name}.common.dim_country c ON c.COUNTRY_SHORT_ABBREVIATION_CD = p.country AND c.COUNTRY_END_DT = '9999-12-31T00:00:00Z'
-    LEFT JOIN {l3_foundation_catalog_name}.common.dim_location l ON l.COUNTRY_ID = c.COUNTRY_ID AND l.LOCATION_ACRONYM_CD = LEFT(p.merchant_order_id, 3) AND l.location_end_dt = '9999-12-31T00:00:00Z'
-WHERE
-    p.status IN ('SUCCEEDED', 'REFUNDED')
-    AND p.created_at BETWEEN
-        TIMESTAMPADD(HOUR, -1 * (TIMESTAMPDIFF(HOUR, current_timestamp(), FROM_UTC_TIMESTAMP(CURRENT_TIMESTAMP(), c.COUNTRY_TIMEZONE))), date_add('{fecha_ayer}T00:00:00.000', {dias_ventana}))
-    AND
-        TIMESTAMPADD(HOUR, -1 * (TIMESTAMPDIFF(HOUR, current_timestamp(), FROM_UTC_TIMESTAMP(CURRENT_TIMESTAMP(), c.COUNTRY_TIMEZONE))), '{fecha_ayer}T23:59:59.999')
-"""
-)
-print("Created temporary view cte_yuno.")
+eventos_tardios_sql = f"""
+    SELECT st.SPECIALSALEORDERLD AS special_sale_order
+    FROM {l1_raw_catalog_name_prod}.adw.SALES_TRANSACTION_SIN_BRASIL st
+    WHERE
+        st.SALES_BUSINESS_DT BETWEEN '{fecha_inicio_ventana}T00:00:00.000' AND '{fecha_ayer}T23:59:59.999'
+        AND st.COUNTRY_ID IN {mercados_sql(lista_mercados)}
+        AND st.SALES_TYPE_ID = 2
 
-# COMMAND ----------
+    UNION
 
-# DBTITLE 1,Creación de Vista Temporal de Último Pago Yuno (`cte_yuno_ultimo_pago`)
-spark.sql( f"""
-CREATE OR REPLACE TEMP VIEW cte_yuno_ultimo_pago AS
-SELECT
-    *
-FROM
-    cte_yuno
-WHERE
-    aux_OrdenTransaccion = 1
+    SELECT {clave_yuno_sql("p.merchant_order_id")} AS special_sale_order
+    FROM {l2_foundation_catalog_name}.app_yuno.tr_payments p
+    WHERE
+        p.status = 'REFUNDED'
+        AND p.updated_at BETWEEN {inicio_utc_ventana} AND {fin_utc_ventana}
+        AND p.created_at < {inicio_utc_ventana}
+        AND p.country IN {paises_ventana}
 """
-)
-print("Created temporary view cte_yuno_ultimo_pago.")
 
-# COMMAND ----------
-
-# DBTITLE 1,Creación de Vista Temporal de Pagos Yuno Integrados (`cte_yuno_integradas`)
-spark.sql(f"""
+fechas_tardias = find_late_orders(pending_orders_table_name, eventos_tardios_sql, fecha_inicio_ventana, lista_mercados)
 
-CREATE OR REPLACE TEMP VIEW cte_yuno_integradas AS 
+filtro_tardios_tld = late_orders_filter_sql(fechas_tardias, "st.SALES_BUSINESS_DT", "st.SPECIALSALEORDERLD")
 
-SELECT DISTINCT
-  y.*
-FROM
-  cte_yuno_ultimo_pago y
-INNER JOIN
-  tr_deteccion_fraudes_yuno_TLD_YUNO t ON t.SPECIAL_SALE_ORDER = y.SPECIAL_SALES_ORDER;
-"""
-)
-
-# COMMAND ----------
-
-# DBTITLE 1,Creación de Vista Temporal de Pagos Yuno Manuales (`cte_yuno_manuales`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_yuno_manuales AS
-SELECT DISTINCT
-    y.*,
-    CONCAT(CAST(y.updated_at_local AS DATE), y.LOCATION_ACRONYM_CD, CAST(y.amount_value AS INT)) AS yuno_CONCAT,
-    ROW_NUMBER() OVER(PARTITION BY CONCAT(CAST(y.updated_at_local AS DATE), y.LOCATION_ACRONYM_CD, CAST(y.amount_value AS INT)) ORDER BY y.updated_at DESC) AS aux_yuno_CONCAT_orden
-FROM
-    cte_yuno_ultimo_pago y
-WHERE
-    NOT EXISTS (SELECT 1 FROM cte_yuno_integradas i WHERE i.merchant_order_id = y.merchant_order_id)
-"""
-)
-print("Created temporary view cte_yuno_manuales.")
+def filtro_tardios_yuno(alias):
+    # Yuno rows of a late order are read from the day before its sale up to the window, for the markets of this run
+    if not fechas_tardias:
+        return "FALSE"
+    inicio_tardios = utc_timestamp_literal(datetime.combine(fechas_tardias[0] - timedelta(days=1), datetime.min.time()))
+    return (
+        f"({alias}.created_at BETWEEN {inicio_tardios} AND {inicio_utc_ventana}"
+        f" AND {alias}.country IN {paises_ventana}"
+        f" AND {clave_yuno_sql(f'{alias}.merchant_order_id')} IN (SELECT special_sale_order FROM ordenes_tardias))"
+    )
 
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal de Concatenados Duplicados Yuno (`cte_concatenados_duplicados`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_concatenados_duplicados AS
-SELECT DISTINCT
-    m.yuno_CONCAT
-FROM
-    cte_yuno_manuales m
-WHERE
-    aux_yuno_CONCAT_orden > 1 
-"""
+# DBTITLE 1,Prefiltro de Ventas y Líneas de Pago (`_TLD_HECHOS`)
+eligible_payment_lines_table_name = f"{table_full_name}_eligible_payment_lines"
+create_eligible_payment_lines_table(eligible_payment_lines_table_name)
+refresh_eligible_payment_lines(
+    eligible_payment_lines_table_name,
+    f"{l1_raw_catalog_name_prod}.adw.payment_line_sin_brasil",
+    regla_pago_yuno,
+    condicion_pago_yuno,
+    lista_mercados,
+    pipeline_run_id,
 )
 
-
-# COMMAND ----------
-
-# DBTITLE 1,Creación de Vista Temporal de Pagos Yuno Manuales Asociables (`cte_yuno_manuales_asociables`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_yuno_manuales_asociables AS
-SELECT
-    m.*
-FROM
-    cte_yuno_manuales m
-WHERE
-    NOT EXISTS (SELECT 1 FROM cte_concatenados_duplicados md WHERE m.yuno_CONCAT = md.yuno_CONCAT)
-"""
+create_yuno_tld_facts_view(
+    f"{l1_raw_catalog_name_prod}.adw.SALES_TRANSACTION_SIN_BRASIL", # Table for non-Brazil countries
+    f"""st.SALES_BUSINESS_DT BETWEEN date_add('{fecha_ayer}T00:00:00.000', {dias_ventana}) AND '{fecha_ayer}T23:59:59.999'
+        OR {filtro_tardios_tld}""",
+    lista_mercados,
+    eligible_payment_lines_table_name,
 )
 
-
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal de Pagos Yuno Manuales No Asociadas (`cte_yuno_manuales_no_asociadas`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_yuno_manuales_no_asociadas AS
-SELECT
-    m.*
-FROM
-    cte_yuno_manuales m
-WHERE
-    EXISTS (SELECT 1 FROM cte_concatenados_duplicados md WHERE m.yuno_CONCAT = md.yuno_CONCAT)
-"""
-)
-
+# DBTITLE 1,Creación de Vista Temporal de TLD (`_TLD_YUNO`)
+create_yuno_tld_view()
 
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal de Transacciones TLD Manuales (`cte_tld_manuales`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_tld_manuales AS
-SELECT
-    a.*,
-    CONCAT(CAST(a.sales_end_dttm AS DATE), LEFT(a.LOCATION_NAME, 3), CAST(a.VENTA_BRUT_LC AS INT)) AS CONCAT,
-    
-    ROW_NUMBER() OVER(PARTITION BY CONCAT(LEFT(a.LOCATION_NAME, 3), CAST(a.sales_end_dttm AS DATE), CAST(a.VENTA_BRUT_LC AS INT)) ORDER BY 1 DESC) AS aux_CONCAT_orden
-FROM
-    tr_deteccion_fraudes_yuno_TLD_YUNO a
-WHERE
-    a.SALES_TYPE_ID = 1 
-    AND a.SPECIAL_SALE_ORDER IS NULL
-"""
-)
+# DBTITLE 1,Materialización de la Vista TLD (`_TLD_YUNO`)
+# The TLD view is read by cte_nc, cte_proveedor_integradas, cte_tld_integradas, cte_tld_manuales and
+# cte_tld_conciliacion, so the sales_transaction scan and its dimension joins are computed once per run.
+materialize_view("tr_deteccion_fraudes_yuno_TLD_YUNO", storage_level="MEMORY_AND_DISK")
 
 
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal de Concatenados Duplicados TLD (`cte_tld_manuales_mismo_concat`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_tld_manuales_mismo_concat AS
-SELECT DISTINCT
-    m.concat
-FROM
-    cte_tld_manuales m
-WHERE
-    aux_CONCAT_orden > 1
-"""
-)
-
-
-# COMMAND ----------
+# DBTITLE 1,Creación de Vista Temporal de Transacciones Yuno (`cte_yuno_transactions`)
+hint_dimensiones_yuno = dimension_broadcast_hint({"c": "dim_country_actual", "l": "dim_location_actual"})
 
-# DBTITLE 1,Creación de Vista Temporal de TLD Manuales Asociables (`cte_tld_manuales_asociables`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_tld_manuales_asociables AS
-SELECT DISTINCT
-    t.*
+run_view_sql(f"""
+CREATE OR REPLACE TEMP VIEW cte_yuno_transactions AS
+SELECT {hint_dimensiones_yuno}
+    y.payment_id,
+    y.provider_id,
+    ROW_NUMBER() OVER(PARTITION BY y.merchant_order_id ORDER BY y.created_at DESC) AS aux_ordenTransaction
 FROM
-    cte_tld_manuales t
+    {l2_foundation_catalog_name}.app_yuno.tr_transactions y 
+    INNER JOIN dim_country_actual c ON c.COUNTRY_SHORT_ABBREVIATION_CD = y.country
 WHERE
-    
-    NOT EXISTS (SELECT 1 FROM cte_tld_manuales_mismo_concat m WHERE m.concat = t.concat)
+    y.status = 'SUCCEEDED'
+    AND (
+        {filtro_utc_transactions}
+        OR {filtro_tardios_yuno("y")}
+    )
 """
 )
-
+print("Created temporary view cte_yuno_transactions.")
 
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal de TLD Manuales No Asociables (`cte_tld_manuales_no_asociables`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_tld_manuales_no_asociables AS
+# DBTITLE 1,Creación de Vista Temporal de Última Transacción Yuno (`cte_yuno_ultima_transaction`)
+run_view_sql(f"""
+CREATE OR REPLACE TEMP VIEW cte_yuno_ultima_transaction AS
 SELECT
-    t.*
-FROM
-    cte_tld_manuales t
-WHERE
-   
-    EXISTS (SELECT 1 FROM cte_tld_manuales_mismo_concat m WHERE m.concat = t.concat)
-"""
-)
-
-
-# COMMAND ----------
-
-# DBTITLE 1,Creación de Vista Temporal de Transacciones Integradas (`transacciones_integradas_temp`)
-spark.sql(f"""
-
-CREATE OR REPLACE TEMP VIEW transacciones_integradas_temp AS 
-
-  SELECT DISTINCT
-  'App' as Selector,
-  'Integradas' as tipo_integracion,
-  NULL as clave_concatenada,
-  a.OWNERSHIPS,
-  a.COUNTRY_NAME_DESC,
-  LEFT(a.LOCATION_NAME,3) as LOCATION_ACRONYM_CD,
-  concat(a.COUNTRY_NAME_DESC,'-',LEFT(a.LOCATION_NAME,3)) as Key,
-  a.SALES_DATE,
-  FECHA,
-  a.sales_start_dttm,
-  a.sales_end_dttm,
-  a.SALES_TRANSACTION_ID,
-  a.SPECIAL_SALE_ORDER,
-  SALEKEY,
-  POS_REGISTER_ID,
-  SUBSTRING(POS_REGISTER_ID, 0, CHARINDEX('_', POS_REGISTER_ID) - 1) AS POS_REGISTER_NUMBER,
-  CHANNEL_NAME_DESC,
-  SUBCHANNEL_NAME_DESC,
-  INTEGRATED,
-  SALES_TYPE_ID,
-  a.VENTA_BRUT_LC,
-  nc.SALES_TRANSACTION_ID as SALES_TRANSACTION_ID_NC,
-  case when nc_d.special_sale_order is null then 0 else 1 end as NC_duplicada,
-  nc.SALES_DATE as SALES_DATE_NC,
-  nc.sales_start_dttm as sales_start_dttm_nc,
-  nc.sales_end_dttm as sales_end_dttm_nc,
-  nc.VENTA_BRUTA_NC,
-  datediff(second, a.sales_end_dttm, nc.sales_end_dttm) as Tiempo_Reintegro_NC_seg,
-  datediff(minute, a.sales_end_dttm, nc.sales_end_dttm) as Tiempo_Reintegro_NC_min,
-  y.created_at as yuno_created_at,
-  y.updated_at as yuno_updated_at,
-  y.created_at_local as yuno_created_at_gmt,
-  y.updated_at_local as yuno_updated_at_gmt,
-  datediff(second, yuno_created_at, yuno_updated_at) as Tiempo_proceso_yuno_seg,
-  datediff(second, yuno_updated_at_gmt, a.sales_start_dttm) as Tiempo_recepcion_TLD_seg,
-  datediff(second,  a.sales_start_dttm,  a.sales_end_dttm) as Tiempo_transaccion_TLD_seg,
-  y.description,
-  y.payment_id,
-  y.status as yuno_status,
-  y.sub_status as yuno_sub_status,
-  y.amount_value as yuno_amount_value,
-  y.captured as yuno_captured,
-  y.refunded as yuno_refunded,
-  case when sub_status = 'PARTIALLY_REFUNDED' then amount_value - refunded
-        when status = 'SUCCEEDED' then amount_value 
-        else 0 end as yuno_cobro_integrado,
-
-  case when sub_status = 'PARTIALLY_REFUNDED' then VENTA_BRUT_LC - amount_value - refunded 
-    when status = 'SUCCEEDED' then VENTA_BRUT_LC - amount_value 
-    else 0 end as yuno_diferencia_cobro_integrado,
-
-  0 as yuno_cancelacion_integrada,
-  0 as yuno_diferencia_cancelacion_integrada,
-  case when status = 'REFUNDED' then refunded else 0 end as yuno_compensacion_integrada,
-  case when status = 'REFUNDED' then VENTA_BRUT_LC - refunded else 0 end as yuno_diferencia_compensacion_integrada,
-  case when sub_status = 'PARTIALLY_REFUNDED' then refunded else 0 end as yuno_compensacion_parcial_integrada,
-  0 as yuno_cobro_manual,
-  0 as yuno_diferencia_cobro_manual,
-  0 as yuno_cancelacion_manual,
-  0 as yuno_diferencia_cancelacion_manual,
-  0 as yuno_compensacion_manual,
-  0 as yuno_diferencia_compensacion_manual,
-  0 as yuno_compensacion_parcial_manual
- 
-FROM
-  tr_deteccion_fraudes_yuno_TLD_YUNO a 
-INNER JOIN
-  cte_yuno_integradas y on y.SPECIAL_SALES_ORDER = a.SPECIAL_SALE_ORDER
-LEFT JOIN
-  cte_nc nc on nc.SPECIAL_SALE_ORDER = a.SPECIAL_SALE_ORDER
-LEFT JOIN
-  cte_nc_duplicadas nc_d on nc_d.SPECIAL_SALE_ORDER = nc.SPECIAL_SALE_ORDER
- 
-WHERE
-  a.SALES_TYPE_ID = 1
-  and a.SPECIAL_SALE_ORDER IS NOT NULL
-
-  """
-)
-
-# COMMAND ----------
-
-# DBTITLE 1,Creación de Vista Temporal de TLD Manuales Asociables (`tld_manuales_asociables`)
-spark.sql(f"""
-create or replace temp view tld_manuales_asociables as
-
-SELECT DISTINCT 
-  'App' as Selector,
-  'Manuales asociadas' as tipo_integracion,
-  a.CONCAT as clave_concatenada,
-  a.OWNERSHIPS,
-  a.COUNTRY_NAME_DESC,
-  LEFT(a.LOCATION_NAME,3) as LOCATION_ACRONYM_CD,
-  concat(a.COUNTRY_NAME_DESC,'-',LEFT(a.LOCATION_NAME,3)) as Key,
-  a.SALES_DATE,
-  FECHA,
-  a.sales_start_dttm,
-  a.sales_end_dttm,
-  a.SALES_TRANSACTION_ID,
-  a.SPECIAL_SALE_ORDER,
-  SALEKEY,
-  POS_REGISTER_ID,
-  SUBSTRING(POS_REGISTER_ID, 0, CHARINDEX('_', POS_REGISTER_ID) - 1) AS POS_REGISTER_NUMBER,
-  CHANNEL_NAME_DESC,
-  SUBCHANNEL_NAME_DESC,
-  INTEGRATED,
-  SALES_TYPE_ID,
-  a.VENTA_BRUT_LC,
-  null as SALES_TRANSACTION_ID_NC,
-  null as NC_duplicada,
-  null as SALES_DATE_NC,
-  null as sales_start_dttm_nc,
-  null as sales_end_dttm_nc,
-  null as VENTA_BRUTA_NC,
-  null as Tiempo_Reintegro_NC_seg,
-  null as Tiempo_Reintegro_NC_min,
-  y.created_at as yuno_created_at,
-  y.updated_at as yuno_updated_at,
-  y.created_at_local as yuno_created_at_gmt,
-  y.updated_at_local as yuno_updated_at_gmt,
-  datediff(second, yuno_created_at, yuno_updated_at) as Tiempo_proceso_yuno_seg,
-  datediff(second, yuno_updated_at_gmt, a.sales_start_dttm) as Tiempo_recepcion_TLD_seg,
-  datediff(second,  a.sales_start_dttm,  a.sales_end_dttm) as Tiempo_transaccion_TLD_seg,
-  y.description,
-  y.payment_id,
-  y.status as yuno_status,
-  y.sub_status as yuno_sub_status,
-  y.amount_value as yuno_amount_value,
-  y.captured as yuno_captured,
-  y.refunded as yuno_refunded,
-  0 as yuno_cobro_integrado,
-  0 as yuno_diferencia_cobro_integrado,
-  0 as yuno_cancelacion_integrada,
-  0 as yuno_diferencia_cancelacion_integrada,
-  0 as yuno_compensacion_integrada,
-  0 as yuno_diferencia_compensacion_integrada,
-  0 as yuno_compensacion_parcial_integrada,
-  case when sub_status = 'PARTIALLY_REFUNDED' then amount_value - refunded
-        when status = 'SUCCEEDED' then amount_value 
-        else 0 end as yuno_cobro_manual,
-
-  case when sub_status = 'PARTIALLY_REFUNDED' then VENTA_BRUT_LC - amount_value - refunded 
-    when status = 'SUCCEEDED' then VENTA_BRUT_LC - amount_value 
-    else 0 end as yuno_diferencia_cobro_manual,
-
-  0 as yuno_cancelacion_manual,
-  0 as yuno_diferencia_cancelacion_manual,
-  case when status = 'REFUNDED' then refunded else 0 end as yuno_compensacion_manual,
-  case when status = 'REFUNDED' then VENTA_BRUT_LC - refunded else 0 end as yuno_diferencia_compensacion_manual,
-  case when sub_status = 'PARTIALLY_REFUNDED' then refunded else 0 end as yuno_compensacion_parcial_manual
- 
-FROM
-  cte_tld_manuales_asociables a 
-INNER JOIN
-  cte_yuno_manuales_asociables y on y.yuno_CONCAT = a.CONCAT
-
-  """
-)
-
-# COMMAND ----------
-
-# DBTITLE 1,Creación de Vista Temporal de TLD Manuales No Asociadas (vía Concat Key) (`tld_manuales_no_concatenado`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW tld_manuales_no_concatenado AS
-SELECT DISTINCT 
-    'App' AS Selector,
-    'Manuales no asociadas' AS tipo_integracion,
-    a.CONCAT AS clave_concatenada,
-    a.OWNERSHIPS,
-    a.COUNTRY_NAME_DESC,
-    LEFT(a.LOCATION_NAME, 3) AS LOCATION_ACRONYM_CD,
-    CONCAT(a.COUNTRY_NAME_DESC, '-', LEFT(a.LOCATION_NAME, 3)) AS Key,
-    a.SALES_DATE,
-    a.FECHA,
-    a.sales_start_dttm,
-    a.sales_end_dttm,
-    a.SALES_TRANSACTION_ID,
-    a.SPECIAL_SALE_ORDER,
-    a.SALEKEY,
-    a.POS_REGISTER_ID,
-    SUBSTRING(a.POS_REGISTER_ID, 1, COALESCE(NULLIF(CHARINDEX('_', a.POS_REGISTER_ID), 0) - 1, LENGTH(a.POS_REGISTER_ID))) AS POS_REGISTER_NUMBER,
-    a.CHANNEL_NAME_DESC,
-    a.SUBCHANNEL_NAME_DESC,
-    a.INTEGRATED,
-    a.SALES_TYPE_ID,
-    a.VENTA_BRUT_LC,
-    NULL AS SALES_TRANSACTION_ID_NC,
-    NULL AS NC_duplicada,
-    NULL AS SALES_DATE_NC,
-    NULL AS sales_start_dttm_nc,
-    NULL AS sales_end_dttm_nc,
-    NULL AS VENTA_BRUTA_NC,
-    NULL AS Tiempo_Reintegro_NC_seg,
-    NULL AS Tiempo_Reintegro_NC_min,
-    NULL AS yuno_created_at,
-    NULL AS yuno_updated_at,
-    NULL AS yuno_created_at_local,
-    NULL AS yuno_updated_at_local,
-    NULL AS Tiempo_proceso_yuno_seg,
-    NULL AS Tiempo_recepcion_TLD_seg,
-    DATEDIFF(second, a.sales_start_dttm, a.sales_end_dttm) AS Tiempo_transaccion_TLD_seg,
-    NULL AS description,
-    NULL AS payment_id,
-    NULL AS yuno_status,
-    NULL AS yuno_sub_status,
-    NULL AS yuno_amount_value,
-    NULL AS yuno_captured,
-    NULL AS yuno_refunded,
-    0 AS yuno_cobro_integrado,
-    0 AS yuno_diferencia_cobro_integrado,
-    0 AS yuno_cancelacion_integrada,
-    0 AS yuno_diferencia_cancelacion_integrada,
-    0 AS yuno_compensacion_integrada,
-    0 AS yuno_diferencia_compensacion_integrada,
-    0 AS yuno_compensacion_parcial_integrada,
-    0 AS yuno_cobro_manual,
-    0 AS yuno_diferencia_cobro_manual,
-    0 AS yuno_cancelacion_manual,
-    0 AS yuno_diferencia_cancelacion_manual,
-    0 AS yuno_compensacion_manual,
-    0 AS yuno_diferencia_compensacion_manual,
-    0 AS yuno_compensacion_parcial_manual
-FROM
-    cte_tld_manuales_asociables a
-WHERE
-    
-    NOT EXISTS (SELECT 1 FROM cte_yuno_manuales_asociables y WHERE y.yuno_CONCAT = a.CONCAT)
-"""
-)
-
-
-# COMMAND ----------
-
-# DBTITLE 1,Creación de Vista Temporal de TLD Manuales No Asociadas (Concat Duplicado) (`transacciones_manuales_no_asociadas`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW transacciones_manuales_no_asociadas AS
-SELECT DISTINCT
-    'App' AS Selector,
-    'Manuales no asociadas' AS tipo_integracion,
-    a.CONCAT AS clave_concatenada,
-    a.OWNERSHIPS,
-    a.COUNTRY_NAME_DESC,
-    LEFT(a.LOCATION_NAME, 3) AS LOCATION_ACRONYM_CD,
-    CONCAT(a.COUNTRY_NAME_DESC, '-', LEFT(a.LOCATION_NAME, 3)) AS Key,
-    a.SALES_DATE,
-    a.FECHA,
-    a.sales_start_dttm,
-    a.sales_end_dttm,
-    a.SALES_TRANSACTION_ID,
-    a.SPECIAL_SALE_ORDER,
-    a.SALEKEY,
-    a.POS_REGISTER_ID,
-    SUBSTRING(a.POS_REGISTER_ID, 1, COALESCE(NULLIF(CHARINDEX('_', a.POS_REGISTER_ID), 0) - 1, LENGTH(a.POS_REGISTER_ID))) AS POS_REGISTER_NUMBER,
-    a.CHANNEL_NAME_DESC,
-    a.SUBCHANNEL_NAME_DESC,
-    a.INTEGRATED,
-    a.SALES_TYPE_ID,
-    a.VENTA_BRUT_LC,
-    NULL AS SALES_TRANSACTION_ID_NC,
-    NULL AS NC_duplicada,
-    NULL AS SALES_DATE_NC,
-    NULL AS sales_start_dttm_nc,
-    NULL AS sales_end_dttm_nc,
-    NULL AS VENTA_BRUTA_NC,
-    NULL AS Tiempo_Reintegro_NC_seg,
-    NULL AS Tiempo_Reintegro_NC_min,
-    NULL AS yuno_created_at,
-    NULL AS yuno_updated_at,
-    NULL AS yuno_created_at_local,
-    NULL AS yuno_updated_at_local,
-    NULL AS Tiempo_proceso_yuno_seg,
-    NULL AS Tiempo_recepcion_TLD_seg,
-    DATEDIFF(second, a.sales_start_dttm, a.sales_end_dttm) AS Tiempo_transaccion_TLD_seg,
-    NULL AS description,
-    NULL AS payment_id,
-    NULL AS yuno_status,
-    NULL AS yuno_sub_status,
-    NULL AS yuno_amount_value,
-    NULL AS yuno_captured,
-    NULL AS yuno_refunded,
-    0 AS yuno_cobro_integrado,
-    0 AS yuno_diferencia_cobro_integrado,
-    0 AS yuno_cancelacion_integrada,
-    0 AS yuno_diferencia_cancelacion_integrada,
-    0 AS yuno_compensacion_integrada,
-    0 AS yuno_diferencia_compensacion_integrada,
-    0 AS yuno_compensacion_parcial_integrada,
-    0 AS yuno_cobro_manual,
-    0 AS yuno_diferencia_cobro_manual,
-    0 AS yuno_cancelacion_manual,
-    0 AS yuno_diferencia_cancelacion_manual,
-    0 AS yuno_compensacion_manual,
-    0 AS yuno_diferencia_compensacion_manual,
-    0 AS yuno_compensacion_parcial_manual
-FROM
-    cte_tld_manuales_no_asociables AS a
-"""
-)
-
-
-# COMMAND ----------
-
-# DBTITLE 1,Creación de Vista Temporal de TLD Integradas Sin Yuno (`transacciones_integradas_no_yuno`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW transacciones_integradas_no_yuno AS
-SELECT DISTINCT
-    'App' AS Selector,
-    'Manuales no asociadas' AS tipo_integracion,
-    NULL AS clave_concatenada,
-    a.OWNERSHIPS,
-    a.COUNTRY_NAME_DESC,
-    LEFT(a.LOCATION_NAME, 3) AS LOCATION_ACRONYM_CD,
-    CONCAT(a.COUNTRY_NAME_DESC, '-', LEFT(a.LOCATION_NAME, 3)) AS Key,
-    a.SALES_DATE,
-    a.FECHA,
-    a.sales_start_dttm,
-    a.sales_end_dttm,
-    a.SALES_TRANSACTION_ID,
-    a.SPECIAL_SALE_ORDER,
-    a.SALEKEY,
-    a.POS_REGISTER_ID,
-    SUBSTRING(a.POS_REGISTER_ID, 1, COALESCE(NULLIF(CHARINDEX('_', a.POS_REGISTER_ID), 0) - 1, LENGTH(a.POS_REGISTER_ID))) AS POS_REGISTER_NUMBER,
-    a.CHANNEL_NAME_DESC,
-    a.SUBCHANNEL_NAME_DESC,
-    a.INTEGRATED,
-    a.SALES_TYPE_ID,
-    a.VENTA_BRUT_LC,
-    NULL AS SALES_TRANSACTION_ID_NC,
-    NULL AS NC_duplicada,
-    NULL AS SALES_DATE_NC,
-    NULL AS sales_start_dttm_nc,
-    NULL AS sales_end_dttm_nc,
-    NULL AS VENTA_BRUTA_NC,
-    NULL AS Tiempo_Reintegro_NC_seg,
-    NULL AS Tiempo_Reintegro_NC_min,
-    NULL AS yuno_created_at,
-    NULL AS yuno_updated_at,
-    NULL AS yuno_created_at_local,
-    NULL AS yuno_updated_at_local,
-    NULL AS Tiempo_proceso_yuno_seg,
-    NULL AS Tiempo_recepcion_TLD_seg,
-    DATEDIFF(second, a.sales_start_dttm, a.sales_end_dttm) AS Tiempo_transaccion_TLD_seg,
-    NULL AS description,
-    NULL AS payment_id,
-    NULL AS yuno_status,
-    NULL AS yuno_sub_status,
-    NULL AS yuno_amount_value,
-    NULL AS yuno_captured,
-    NULL AS yuno_refunded,
-    0 AS yuno_cobro_integrado,
-    0 AS yuno_diferencia_cobro_integrado,
-    0 AS yuno_cancelacion_integrada,
-    0 AS yuno_diferencia_cancelacion_integrada,
-    0 AS yuno_compensacion_integrada,
-    0 AS yuno_diferencia_compensacion_integrada,
-    0 AS yuno_compensacion_parcial_integrada,
-    0 AS yuno_cobro_manual,
-    0 AS yuno_diferencia_cobro_manual,
-    0 AS yuno_cancelacion_manual,
-    0 AS yuno_diferencia_cancelacion_manual,
-    0 AS yuno_compensacion_manual,
-    0 AS yuno_diferencia_compensacion_manual,
-    0 AS yuno_compensacion_parcial_manual
+    payment_id,
+    provider_id
 FROM
-    tr_deteccion_fraudes_yuno_TLD_YUNO a
+    cte_yuno_transactions
 WHERE
-    NOT EXISTS (SELECT 1 FROM cte_yuno_integradas y WHERE y.SPECIAL_SALES_ORDER = a.SPECIAL_SALE_ORDER)
-    AND a.SALES_TYPE_ID = 1
-    AND a.SPECIAL_SALE_ORDER IS NOT NULL
+    aux_ordenTransaction = 1
 """
 )
-
+print("Created temporary view cte_yuno_ultima_transaction.")
 
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal de Yuno Manuales No Asociadas (Concat Duplicado) (`transacciones_yuno_manuales`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW transacciones_yuno_manuales AS
-SELECT DISTINCT
-    'App' AS Selector,
-    'Yuno sin integración' AS tipo_integracion,
-    y.yuno_CONCAT AS clave_concatenada,
-    y.OWNERSHIPS,
-    y.COUNTRY_NAME_DESC,
-    y.LOCATION_ACRONYM_CD,
-    CONCAT(y.COUNTRY_NAME_DESC, '-', y.LOCATION_ACRONYM_CD) AS Key,
-    NULL AS SALES_DATE,
-    NULL AS FECHA,
-    NULL AS sales_start_dttm,
-    NULL AS sales_end_dttm,
-    NULL AS SALES_TRANSACTION_ID,
-    y.SPECIAL_SALES_ORDER,
-    NULL AS SALEKEY,
-    NULL AS POS_REGISTER_ID,
-    NULL AS POS_REGISTER_NUMBER,
-    NULL AS CHANNEL_NAME_DESC,
-    NULL AS SUBCHANNEL_NAME_DESC,
-    NULL AS INTEGRATED,
-    NULL AS SALES_TYPE_ID,
-    NULL AS VENTA_BRUT_LC,
-    NULL AS SALES_TRANSACTION_ID_NC,
-    NULL AS NC_duplicada,
-    NULL AS SALES_DATE_NC,
-    NULL AS sales_start_dttm_nc,
-    NULL AS sales_end_dttm_nc,
-    NULL AS VENTA_BRUTA_NC,
-    NULL AS Tiempo_Reintegro_NC_seg,
-    NULL AS Tiempo_Reintegro_NC_min,
-    y.created_at AS yuno_created_at,
-    y.updated_at AS yuno_updated_at,
-    y.created_at_local AS yuno_created_at_local,
-    y.updated_at_local AS yuno_updated_at_local,
-    DATEDIFF(second, y.created_at, y.updated_at) AS Tiempo_proceso_yuno_seg,
-    NULL AS Tiempo_recepcion_TLD_seg,
-    NULL AS Tiempo_transaccion_TLD_seg,
-    y.description,
-    y.payment_id,
-    y.status AS yuno_status,
-    y.sub_status AS yuno_sub_status,
-    y.amount_value AS yuno_amount_value,
-    y.captured AS yuno_captured,
-    y.refunded AS yuno_refunded,
-    0 as yuno_cobro_integrado,
-    0 as yuno_diferencia_cobro_integrado,
-    0 as yuno_cancelacion_integrada,
-    0 as yuno_diferencia_cancelacion_integrada,
-    0 as yuno_compensacion_integrada,
-    0 as yuno_diferencia_compensacion_integrada,
-    0 as yuno_compensacion_parcial_integrada,
-    case when sub_status = 'PARTIALLY_REFUNDED' then amount_value - refunded
-            when status = 'SUCCEEDED' then amount_value 
-            else 0 end as yuno_cobro_manual,
-    0 as yuno_diferencia_cobro_manual,
-    case when status = 'REFUNDED' or sub_status = 'PARTIALLY_REFUNDED' then refunded else 0 end as yuno_cancelacion_manual,
-    0 as yuno_diferencia_cancelacion_manual,
-    0 as yuno_compensacion_manual,
-    0 as yuno_diferencia_compensacion_manual,
-    0 as yuno_compensacion_parcial_manual
-FROM
-    cte_yuno_manuales_no_asociadas y
-"""
+# DBTITLE 1,Creación de Vista Temporal de Pagos Yuno (`cte_yuno`)
+create_yuno_payments_view(
+    f"{l2_foundation_catalog_name}.app_yuno.tr_payments",
+    f"""{filtro_utc_pagos}
+        OR {filtro_tardios_yuno("p")}""",
 )
-
+print("Created temporary view cte_yuno.")
 
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal de Yuno Manuales No Asociadas (Sin Match TLD) (`transacciones_no_integradas_en_tld`)
-spark.sql(f"""
-
-create or replace temp view transacciones_no_integradas_en_tld as
-
-SELECT DISTINCT
-  'App' as Selector,
-  'Yuno sin integración' as tipo_integracion,
-  null as clave_concatenada,
-  OWNERSHIPS,
-  COUNTRY_NAME_DESC,
-  null as LOCATION_ACRONYM_CD,
-  concat(COUNTRY_NAME_DESC,'-',LEFT(y.merchant_order_id,3)) as Key,
-  null as SALES_DATE,
-  null as FECHA,
-  null as sales_start_dttm,
-  null as sales_end_dttm,
-  null as SALES_TRANSACTION_ID,
-  y.SPECIAL_SALES_ORDER,
-  null as SALEKEY,
-  null as POS_REGISTER_ID,
-  null AS POS_REGISTER_NUMBER,
-  null as CHANNEL_NAME_DESC,
-  null as SUBCHANNEL_NAME_DESC,
-  null as INTEGRATED,
-  null as SALES_TYPE_ID,
-  null as VENTA_BRUTA,
-  null as SALES_TRANSACTION_ID_NC,
-  null,
-  null as SALES_DATE_NC,
-  null as sales_start_dttm_nc,
-  null as sales_end_dttm_nc,
-  null as VENTA_BRUTA_NC,
-  null as Tiempo_Reintegro_NC_seg,
-  null as Tiempo_Reintegro_NC_min,
-  y.created_at as yuno_created_at,
-  y.updated_at as yuno_updated_at,
-  y.created_at_local as yuno_created_at_gmt,
-  y.updated_at_local as yuno_updated_at_gmt,
-  datediff(second, yuno_created_at, yuno_updated_at) as Tiempo_proceso_yuno_seg,
-  null as Tiempo_recepcion_TLD_seg,
-  null as Tiempo_transaccion_TLD_seg,
-  y.description,
-  y.payment_id,
-  y.status as yuno_status,
-  y.sub_status as yuno_sub_status,
-  y.amount_value as yuno_amount_value,
-  y.captured as yuno_captured,
-  y.refunded as yuno_refunded,
-  0 as yuno_cobro_integrado,
-  0 as yuno_diferencia_cobro_integrado,
-  0 as yuno_cancelacion_integrada,
-  0 as yuno_diferencia_cancelacion_integrada,
-  0 as yuno_compensacion_integrada,
-  0 as yuno_diferencia_compensacion_integrada,
-  0 as yuno_compensacion_parcial_integrada,
-  case when sub_status = 'PARTIALLY_REFUNDED' then amount_value - refunded
-        when status = 'SUCCEEDED' then amount_value 
-        else 0 end as yuno_cobro_manual,
-  0 as yuno_diferencia_cobro_manual,
-  case when status = 'REFUNDED' or sub_status = 'PARTIALLY_REFUNDED' then refunded else 0 end as yuno_cancelacion_manual,
-  0 as yuno_diferencia_cancelacion_manual,
-  0 as yuno_compensacion_manual,
-  0 as yuno_diferencia_compensacion_manual,
-  0 as yuno_compensacion_parcial_manual
- 
-FROM
-  cte_yuno_manuales_asociables y
-WHERE
-  not exists (select 1 from cte_tld_manuales_asociables a where y.yuno_CONCAT = a.CONCAT)
-  
-
- 
- """
-)
+# DBTITLE 1,Creación de Vista Temporal de Último Pago Yuno (`cte_yuno_ultimo_pago`)
+create_yuno_last_payment_view()
+print("Created temporary view cte_yuno_ultimo_pago.")
 
 # COMMAND ----------
 
-# DBTITLE 1,Creación de Vista Temporal Unificada (`cte_temp`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_temp AS
-
-SELECT * FROM transacciones_integradas_temp
-UNION ALL
-SELECT * FROM tld_manuales_asociables
-UNION ALL
-SELECT * FROM tld_manuales_no_concatenado
-UNION ALL
-SELECT * FROM transacciones_manuales_no_asociadas
-UNION ALL
-SELECT * FROM transacciones_integradas_no_yuno
-UNION ALL
-SELECT * FROM transacciones_yuno_manuales
-UNION ALL
-SELECT * FROM transacciones_no_integradas_en_tld
-"""
-)
+# DBTITLE 1,Creación de Vista Temporal Unificada (`cte_temp`) con el motor de conciliación
+build_reconciliation(dict_proveedor_yuno)
+print("Created temporary view cte_temp.")
+assert_reconciliation_checkpoints(run_metrics_table_name, "TR_DETECCION_FRAUDES_YUNO", pipeline_run_id, lista_mercados)
 
 # COMMAND ----------
 
 # DBTITLE 1,Creación de Vista Temporal con Estados Calculados (`cte_temp2`)
-spark.sql(f"""
-create or replace temp view cte_temp2 as
-
-SELECT 
-    CAST(COALESCE(fecha, yuno_updated_at_gmt) AS DATE) as sales_business_dt,
-    *,
-case when
-    tipo_integracion = 'Manual'
-    and
-    (yuno_cancelacion_integrada + yuno_diferencia_cancelacion_integrada
-    + yuno_cancelacion_manual
-    + yuno_cobro_integrado + yuno_diferencia_cobro_integrado
-    + yuno_cobro_manual) = 0 then 1 else 0 end as Error_o_Fraude,
- 
-case 
-    when yuno_status = 'REFUNDED' and SALES_TRANSACTION_ID is not null then 'Compensada'
-    when yuno_status = 'REFUNDED' and SALES_TRANSACTION_ID is null then 'Cancelada'
-    when yuno_sub_status = 'PARTIALLY_REFUNDED' and SALES_TRANSACTION_ID is not null then 'Compensada parcialmente'
-    when yuno_sub_status = 'PARTIALLY_REFUNDED' and SALES_TRANSACTION_ID is null then 'Cancelada parcialmente'
-    when yuno_status = 'SUCCEEDED' and SALES_TRANSACTION_ID is not null then 'Cobrada'
-    when yuno_status = 'SUCCEEDED' and SALES_TRANSACTION_ID is null then 'No encontrada'
-    when yuno_status is null then 'No encontrada' end as Estado_Transacccion,
-
-case when NC_Duplicada = 1 then 'Nota de crédito duplicada'
-when SALES_TRANSACTION_ID_NC is null then 'No aplica NC'
-when SALES_TRANSACTION_ID_NC is not null then 'Nota de crédito aplicada' end as Estado_NC
-
-
-FROM
-  cte_temp
- """
-)
+create_yuno_status_view()
 
 # COMMAND ----------
 
 # DBTITLE 1,Creación de Vista Temporal de Tipos de Cambio (`cte_currency_rate`)
-spark.sql(f"""
-CREATE OR REPLACE TEMP VIEW cte_currency_rate AS
-SELECT DISTINCT
-    cr.SOURCE_CURRENCY_CD,
-    DATE_FORMAT(cr.CURR_TRANS_CALENDAR_DT, 'yMM') AS calendar_month_id,
-    cr.SOURCE_TO_TARGET_CURRENCY_RATE
-FROM
-    {l2_foundation_catalog_name}.common.hist_currency_translation_rate cr
-WHERE
-    cr.CURRENCY_TYPE_ID = 4
-    AND current_date BETWEEN cr.CURR_TRANSLATION_RATE_START_DT AND cr.CURR_TRANSLATION_RATE_END_DT
-"""
-)
+# Shared (currency, yyyyMM) lookup, rebuilt only when the rate table changes
+currency_rate_lookup_name = f"{table_full_name.rsplit('.', 1)[0]}.deteccion_fraudes_currency_rate"
+create_currency_rate_view(currency_rate_lookup_name, f"{l2_foundation_catalog_name}.common.hist_currency_translation_rate")
 
 # COMMAND ----------
 
 # DBTITLE 1,Creación de Vista Temporal Final (`_TEMP`)
 
-spark.sql(f"""
+run_view_sql(f"""
 
 create or replace temp view tr_deteccion_fraudes_yuno_TEMP as 
 
-SELECT
-  date_format(sales_business_dt, 'yMM') as calendar_month_id,
+SELECT /*+ BROADCAST(cr) */
+  CAST({month_key_sql("sales_business_dt")} AS STRING) as calendar_month_id,
   cr.source_to_target_currency_rate,
 sales_business_dt,
 Selector,
@@ -1233,15 +483,23 @@ FROM
 LEFT JOIN
   cte_yuno_ultima_transaction y on y.payment_id = t.payment_id
 LEFT JOIN
-  {l3_foundation_catalog_name}.common.dim_country c ON c.COUNTRY_NAME_DESC = t.COUNTRY_NAME_DESC AND c.COUNTRY_END_DT = '9999-12-31T00:00:00Z'
+  dim_country_actual c ON c.COUNTRY_NAME_DESC = t.COUNTRY_NAME_DESC
 LEFT JOIN
   cte_currency_rate cr on cr.SOURCE_CURRENCY_CD = c.CURRENCY_CD
-                        and date_format(sales_business_dt, 'yMM') = cr.calendar_month_id
+                        and {month_key_sql("sales_business_dt")} = cr.calendar_month_id
 
  
  """
 )
 
+check_shuffle_column_pruning(
+    "tr_deteccion_fraudes_yuno_TEMP",
+    [f"{l2_foundation_catalog_name}.app_yuno.tr_payments", f"{l2_foundation_catalog_name}.app_yuno.tr_transactions"],
+)
+
+# The MERGE and the pending-order index read these views; on DuckDB they are replaced by their rows
+export_single_node_views(["tr_deteccion_fraudes_yuno_TEMP", "tr_deteccion_fraudes_yuno_TLD_YUNO"])
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -1251,14 +509,43 @@ LEFT JOIN
 
 start_date = (datetime.strptime(fecha_ayer, '%Y-%m-%d') + timedelta(days=dias_ventana)).strftime('%Y-%m-%d')
 
-sql_clause = f""" sales_business_dt BETWEEN date_add('{fecha_ayer}T00:00:00.000', {dias_ventana}) AND '{fecha_ayer}T23:59:59.999'"""
+# The MERGE scope is limited to the markets of this run, so concurrent per-market units never delete each other's rows.
+paises_mercados = [row["COUNTRY_NAME_DESC"] for row in collect_sql(f"SELECT DISTINCT COUNTRY_NAME_DESC AS COUNTRY_NAME_DESC FROM dim_country_actual WHERE COUNTRY_ID IN {mercados_sql(lista_mercados)}")]
+if not paises_mercados:
+    raise ValueError(f"None of the markets {lista_mercados} is in dim_country; cannot scope the load to their countries.")
+
+# A row without a country belongs to no market unit, so no later run could replace it: none may be written. Rows left
+# without a country by the former date-range loads are deleted by every unit whose window covers them.
+filas_sin_pais = collect_sql("SELECT COUNT(*) AS filas FROM tr_deteccion_fraudes_yuno_TEMP WHERE COUNTRY_NAME_DESC IS NULL")[0]["filas"]
+if filas_sin_pais:
+    raise ValueError(f"{filas_sin_pais} rows of tr_deteccion_fraudes_yuno_TEMP have no COUNTRY_NAME_DESC; check dim_country for the countries of the payments.")
+
+# Late orders are rebuilt whole, whatever the date of their previous rows
+sql_clause = f""" (
+    sales_business_dt BETWEEN date_add('{fecha_ayer}T00:00:00.000', {dias_ventana}) AND '{fecha_ayer}T23:59:59.999'
+    {"OR " + values_in_sql("special_sale_order", "ordenes_tardias") if fechas_tardias else ""}
+  )
+  AND (country_name_desc IN {mercados_sql(paises_mercados)} OR country_name_desc IS NULL)"""
+
+# COMMAND ----------
+
+load_table_merge(f"{table_full_name}",
+                 'tr_deteccion_fraudes_yuno_TEMP',
+                 dict_table_metadata["primary_key"],
+                 sql_clause,
+                 run_id=pipeline_run_id,
+                 optimize_flg=not fecha_desde,
+                 vacuum_flg=not fecha_desde and vacuum_due(fecha_ayer)
+                 )
+
+# COMMAND ----------
+
+register_pending_orders(pending_orders_table_name, "tr_deteccion_fraudes_yuno_TLD_YUNO", "SPECIAL_SALE_ORDER", "VENTA_BRUT_LC", "FECHA", lista_mercados, fecha_ayer, pipeline_run_id)
+
+# COMMAND ----------
+
+save_run_metrics(run_metrics_table_name, "TR_DETECCION_FRAUDES_YUNO", pipeline_run_id, lista_mercados)
 
 # COMMAND ----------
 
-load_table_replace(f"{table_full_name}", 
-                      'tr_deteccion_fraudes_yuno_TEMP',
-                      sql_clause,
-                      vacuum_retain_days=1,
-                      run_id=pipeline_run_id,
-                      optimize_flg=True
-                      )
\ No newline at end of file
+release_materialized_views()
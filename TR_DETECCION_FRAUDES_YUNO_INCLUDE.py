@@ -0,0 +1,386 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC Descripcion : Reglas y vistas de Yuno compartidas por la notebook diaria y la variante streaming
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 1. Order keys and sale fact rules
+# MAGIC
+# MAGIC The batch notebook reads these rules from the sources, and the streaming variant reads them from its state
+# MAGIC tables. Both build the same views, so the two variants match orders the same way. Run this notebook after
+# MAGIC TR_DETECCION_FRAUDES_INCLUDE.
+
+# COMMAND ----------
+
+def clave_yuno_sql(columna):
+    """Order key of a Yuno merchant_order_id (`<location>-<order>`): the text after the first dash."""
+    return f"SUBSTRING({columna}, CHARINDEX('-', {columna}) + 1, LENGTH({columna}) - CHARINDEX('-', {columna}))"
+
+
+# Allowed sale subchannels: (subchannel ids, extra condition on the sale or None)
+reglas_subcanal_yuno = [
+    ((2002,), "upper(st.PARTNER_DESC) = 'MCD APP'"),
+    ((1001, 1002, 1003), None),
+    ((1004,), "st.channel_id <> 99"),
+]
+
+def subcanales_sql(ids):
+    return "(" + ", ".join(str(id_subcanal) for id_subcanal in ids) + ")"
+
+subcanales_yuno = sorted(id_subcanal for ids, _ in reglas_subcanal_yuno for id_subcanal in ids)
+filtro_subcanal_yuno = " OR\n        ".join(
+    f"(st.SALE_SUBCHANNEL_ID IN {subcanales_sql(ids)} AND {condicion})" if condicion else f"st.SALE_SUBCHANNEL_ID IN {subcanales_sql(ids)}"
+    for ids, condicion in reglas_subcanal_yuno
+)
+
+# Cash payments in Colombia are not paid through Yuno: a sale needs a payment line of another subtype
+regla_pago_yuno = "yuno_sin_efectivo"
+condicion_pago_yuno = "payment_subtype_id NOT IN ('1_102', '47_102')"
+
+# Sale columns read by the TLD view
+columnas_hechos_tld = [
+    "SALES_TRANSACTION_ID",
+    "SPECIALSALEORDERLD",
+    "SALEKEY",
+    "INTEGRATED",
+    "SALES_TYPE_ID",
+    "POS_REGISTER_ID",
+    "COUNTRY_ID",
+    "LOYALTY_MCID",
+    "SALES_DATE",
+    "SALES_BUSINESS_DT",
+    "sales_start_dttm",
+    "sales_end_dttm",
+    "SALE_SUBCHANNEL_ID",
+    "SALES_GROSS_AMT",
+    "MANAGER_ASSOCIATE_ID",
+    "SALES_ASSOCIATE_ID",
+    "LOCATION_ID",
+]
+
+
+def filtro_hechos_yuno_sql(country_ids):
+    """Fact predicates of a Yuno sale (alias st): subchannel rules, markets, gross amount and sales type."""
+    return f"""st.SALE_SUBCHANNEL_ID IN {subcanales_sql(subcanales_yuno)}
+    AND (
+        {filtro_subcanal_yuno}
+    )
+    AND st.COUNTRY_ID IN {mercados_sql(country_ids)}
+    AND st.SALES_GROSS_AMT NOT BETWEEN 0 AND 0.2
+    AND st.SALES_TYPE_ID IN (1, 2)"""
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 2. TLD and payment views
+
+# COMMAND ----------
+
+def create_yuno_tld_facts_view(sales_table_name, sales_filter_sql, country_ids, eligible_table_name=None):
+    """Create `tr_deteccion_fraudes_yuno_TLD_HECHOS` with the Yuno sales of sales_table_name that pass sales_filter_sql (alias st).
+
+    Every fact predicate is applied on the sales table itself, the subchannels as one literal IN list, so data
+    skipping drops files before any join. The payment lines are an existence filter on the eligible keys, so a
+    sale gives one row however many payment lines it has. Without eligible_table_name that filter is left out.
+    """
+    filtro_elegibles = ""
+    if eligible_table_name:
+        filtro_elegibles = f"""
+    AND EXISTS (
+        SELECT 1
+        FROM {eligible_table_name} pl
+        WHERE
+            pl.rule_id = '{regla_pago_yuno}'
+            AND pl.COUNTRY_ID IN {mercados_sql(country_ids)}
+            AND pl.SALES_TRANSACTION_ID = st.SALES_TRANSACTION_ID
+            AND pl.country_id = st.country_id
+            AND pl.location_id = st.location_id
+    )"""
+
+    run_view_sql(f"""
+CREATE OR REPLACE TEMPORARY VIEW tr_deteccion_fraudes_yuno_TLD_HECHOS AS
+
+SELECT
+    {", ".join(f"st.{columna}" for columna in columnas_hechos_tld)}
+FROM
+    {sales_table_name} st
+WHERE
+    (
+        {sales_filter_sql}
+    )
+    AND {filtro_hechos_yuno_sql(country_ids)}{filtro_elegibles}
+"""
+    )
+
+
+def create_yuno_tld_view():
+    """Create `tr_deteccion_fraudes_yuno_TLD_YUNO`: the TLD facts with their channel, location and country."""
+    hint_dimensiones_tld = dimension_broadcast_hint({
+        "lss": "lk_sale_subchannel_actual",
+        "cm": "lk_sale_channel_actual",
+        "loc": "dim_location_actual",
+        "cou": "dim_country_actual",
+    })
+
+    run_view_sql(f"""
+CREATE OR REPLACE TEMPORARY VIEW tr_deteccion_fraudes_yuno_TLD_YUNO AS
+
+SELECT {hint_dimensiones_tld}
+    st.SALES_TRANSACTION_ID,
+    st.SPECIALSALEORDERLD AS SPECIAL_SALE_ORDER,
+    st.SALEKEY,
+    st.INTEGRATED,
+    st.SALES_TYPE_ID,
+    st.POS_REGISTER_ID,
+    st.COUNTRY_ID,
+    cou.COUNTRY_NAME_DESC,
+    loc.OWNERSHIPS,
+    st.LOYALTY_MCID AS MC_ID,
+    st.SALES_DATE,
+    st.SALES_BUSINESS_DT AS FECHA,
+    st.sales_start_dttm,
+    st.sales_end_dttm,
+    lss.SALE_CHANNEL_ID,
+    lss.SALE_SUBCHANNEL_ID,
+    cm.SALE_CHANNEL_DESC AS CHANNEL_NAME_DESC,
+    lss.SALE_SUBCHANNEL_DESC AS SUBCHANNEL_NAME_DESC,
+    ROUND(st.SALES_GROSS_AMT, 5) AS VENTA_BRUT_LC,
+    st.MANAGER_ASSOCIATE_ID,
+    st.SALES_ASSOCIATE_ID,
+    loc.LOCATION_ID,
+    loc.LOCATION_BASE_ID,
+    loc.LOCATION_NAME,
+    loc.LOC_STORE_OAK_ID
+FROM
+    tr_deteccion_fraudes_yuno_TLD_HECHOS st
+    INNER JOIN lk_sale_subchannel_actual lss ON st.sale_subchannel_id = lss.sale_subchannel_id
+    INNER JOIN lk_sale_channel_actual cm ON lss.sale_channel_id = cm.sale_channel_id
+    INNER JOIN dim_location_actual loc ON loc.LOCATION_ID = st.LOCATION_ID
+    INNER JOIN dim_country_actual cou ON cou.country_id = st.COUNTRY_ID
+"""
+    )
+
+
+# Only the payment columns read by the reconciliation adapter. cte_yuno feeds a window and the engine's DISTINCTs,
+# which cannot prune columns, so a p.* here would be shuffled in full.
+columnas_pagos_yuno = [
+    "payment_id",
+    "merchant_order_id",
+    "created_at",
+    "updated_at",
+    "status",
+    "sub_status",
+    "amount_value",
+    "captured",
+    "refunded",
+    "description",
+]
+
+
+def create_yuno_payments_view(payments_table_name, payments_filter_sql):
+    """Create `cte_yuno` with the SUCCEEDED and REFUNDED payments of payments_table_name that pass payments_filter_sql (alias p)."""
+    hint_dimensiones_yuno = dimension_broadcast_hint({"c": "dim_country_actual", "l": "dim_location_actual"})
+
+    run_view_sql(f"""
+CREATE OR REPLACE TEMP VIEW cte_yuno AS
+SELECT {hint_dimensiones_yuno}
+    c.COUNTRY_NAME_DESC,
+    l.LOCATION_ACRONYM_CD,
+    l.OWNERSHIPS,
+    {clave_yuno_sql("p.merchant_order_id")} AS SPECIAL_SALES_ORDER,
+    FROM_UTC_TIMESTAMP(p.created_at, c.COUNTRY_TIMEZONE) AS created_at_local,
+    FROM_UTC_TIMESTAMP(p.updated_at, c.COUNTRY_TIMEZONE) AS updated_at_local,
+    ROW_NUMBER() OVER(PARTITION BY p.merchant_order_id ORDER BY p.updated_at DESC) as aux_OrdenTransaccion,
+    {", ".join(f"p.{columna}" for columna in columnas_pagos_yuno)}
+FROM
+    {payments_table_name} p
+    LEFT JOIN dim_country_actual c ON c.COUNTRY_SHORT_ABBREVIATION_CD = p.country
+    LEFT JOIN dim_location_actual l ON l.COUNTRY_ID = c.COUNTRY_ID AND l.LOCATION_ACRONYM_CD = LEFT(p.merchant_order_id, 3)
+WHERE
+    p.status IN ('SUCCEEDED', 'REFUNDED')
+    AND (
+        {payments_filter_sql}
+    )
+"""
+    )
+
+
+def create_yuno_last_payment_view():
+    """Create `cte_yuno_ultimo_pago`: the latest payment of every merchant order of cte_yuno."""
+    run_view_sql(f"""
+CREATE OR REPLACE TEMP VIEW cte_yuno_ultimo_pago AS
+SELECT
+    *
+FROM
+    cte_yuno
+WHERE
+    aux_OrdenTransaccion = 1
+"""
+    )
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 3. Reconciliation adapter
+
+# COMMAND ----------
+
+cobro_yuno = """CASE WHEN y.sub_status = 'PARTIALLY_REFUNDED' THEN y.amount_value - y.refunded
+        WHEN y.status = 'SUCCEEDED' THEN y.amount_value
+        ELSE 0 END"""
+
+diferencia_cobro_yuno = """CASE WHEN y.sub_status = 'PARTIALLY_REFUNDED' THEN a.VENTA_BRUT_LC - y.amount_value - y.refunded
+    WHEN y.status = 'SUCCEEDED' THEN a.VENTA_BRUT_LC - y.amount_value
+    ELSE 0 END"""
+
+compensacion_yuno = "CASE WHEN y.status = 'REFUNDED' THEN y.refunded ELSE 0 END"
+diferencia_compensacion_yuno = "CASE WHEN y.status = 'REFUNDED' THEN a.VENTA_BRUT_LC - y.refunded ELSE 0 END"
+compensacion_parcial_yuno = "CASE WHEN y.sub_status = 'PARTIALLY_REFUNDED' THEN y.refunded ELSE 0 END"
+cancelacion_yuno = "CASE WHEN y.status = 'REFUNDED' OR y.sub_status = 'PARTIALLY_REFUNDED' THEN y.refunded ELSE 0 END"
+
+# Amount rule table: (integrated column, manual column, integrated expression, manual expressions by branch)
+reglas_montos_yuno = [
+    ("yuno_cobro_integrado", "yuno_cobro_manual", cobro_yuno, {"manuales_asociadas": cobro_yuno, "solo_proveedor": cobro_yuno}),
+    ("yuno_diferencia_cobro_integrado", "yuno_diferencia_cobro_manual", diferencia_cobro_yuno, {"manuales_asociadas": diferencia_cobro_yuno}),
+    ("yuno_cancelacion_integrada", "yuno_cancelacion_manual", None, {"solo_proveedor": cancelacion_yuno}),
+    ("yuno_diferencia_cancelacion_integrada", "yuno_diferencia_cancelacion_manual", None, {}),
+    ("yuno_compensacion_integrada", "yuno_compensacion_manual", compensacion_yuno, {"manuales_asociadas": compensacion_yuno}),
+    ("yuno_diferencia_compensacion_integrada", "yuno_diferencia_compensacion_manual", diferencia_compensacion_yuno, {"manuales_asociadas": diferencia_compensacion_yuno}),
+    ("yuno_compensacion_parcial_integrada", "yuno_compensacion_parcial_manual", compensacion_parcial_yuno, {"manuales_asociadas": compensacion_parcial_yuno}),
+]
+
+dict_proveedor_yuno = {
+    "vista_tld": "tr_deteccion_fraudes_yuno_TLD_YUNO",
+    "vista_proveedor": "cte_yuno_ultimo_pago",
+    "tld_clave": "SPECIAL_SALE_ORDER",
+    "tld_monto": "VENTA_BRUT_LC",
+    "proveedor_monto": "amount_value",
+    "proveedor_clave": "SPECIAL_SALES_ORDER",
+    "proveedor_id": "merchant_order_id",
+    "llave_tld": {
+        "fecha": "CAST(a.sales_end_dttm AS DATE)",
+        "local": "LEFT(a.LOCATION_NAME, 3)",
+        "monto": "CAST(a.VENTA_BRUT_LC AS INT)",
+    },
+    "llave_proveedor": {
+        "fecha": "CAST(y.updated_at_local AS DATE)",
+        "local": "y.LOCATION_ACRONYM_CD",
+        "monto": "CAST(y.amount_value AS INT)",
+    },
+    "concat_tld": "CONCAT(CAST(a.sales_end_dttm AS DATE), LEFT(a.LOCATION_NAME, 3), CAST(a.VENTA_BRUT_LC AS INT))",
+    "concat_proveedor": "CONCAT(CAST(y.updated_at_local AS DATE), y.LOCATION_ACRONYM_CD, CAST(y.amount_value AS INT))",
+    "tld_manuales": "SIN_CLAVE",
+    "columnas": [
+        reconciliation_column("Selector", "'App'"),
+        reconciliation_column(
+            "tipo_integracion",
+            integradas="'Integradas'",
+            manuales_asociadas="'Manuales asociadas'",
+            solo_tld="'Manuales no asociadas'",
+            solo_proveedor="'Yuno sin integración'",
+        ),
+        reconciliation_column(
+            "clave_concatenada",
+            manuales_asociadas="a.concat_tld",
+            tld_manuales_sin_match="a.concat_tld",
+            tld_manuales_duplicadas="a.concat_tld",
+            proveedor_duplicadas="y.concat_proveedor",
+        ),
+        reconciliation_column("OWNERSHIPS", tld="a.OWNERSHIPS", proveedor="y.OWNERSHIPS"),
+        reconciliation_column("COUNTRY_NAME_DESC", tld="a.COUNTRY_NAME_DESC", proveedor="y.COUNTRY_NAME_DESC"),
+        reconciliation_column("LOCATION_ACRONYM_CD", tld="LEFT(a.LOCATION_NAME, 3)", proveedor_duplicadas="y.LOCATION_ACRONYM_CD"),
+        reconciliation_column(
+            "Key",
+            tld="CONCAT(a.COUNTRY_NAME_DESC, '-', LEFT(a.LOCATION_NAME, 3))",
+            proveedor_duplicadas="CONCAT(y.COUNTRY_NAME_DESC, '-', y.LOCATION_ACRONYM_CD)",
+            proveedor_sin_match="CONCAT(y.COUNTRY_NAME_DESC, '-', LEFT(y.merchant_order_id, 3))",
+        ),
+        reconciliation_column("SALES_DATE", tld="a.SALES_DATE"),
+        reconciliation_column("FECHA", tld="a.FECHA"),
+        reconciliation_column("sales_start_dttm", tld="a.sales_start_dttm"),
+        reconciliation_column("sales_end_dttm", tld="a.sales_end_dttm"),
+        reconciliation_column("SALES_TRANSACTION_ID", tld="a.SALES_TRANSACTION_ID"),
+        reconciliation_column("SPECIAL_SALE_ORDER", tld="a.SPECIAL_SALE_ORDER", proveedor="y.SPECIAL_SALES_ORDER"),
+        reconciliation_column("SALEKEY", tld="a.SALEKEY"),
+        reconciliation_column("POS_REGISTER_ID", tld="a.POS_REGISTER_ID"),
+        reconciliation_column(
+            "POS_REGISTER_NUMBER",
+            conciliadas="SUBSTRING(a.POS_REGISTER_ID, 0, CHARINDEX('_', a.POS_REGISTER_ID) - 1)",
+            solo_tld="SUBSTRING(a.POS_REGISTER_ID, 1, COALESCE(NULLIF(CHARINDEX('_', a.POS_REGISTER_ID), 0) - 1, LENGTH(a.POS_REGISTER_ID)))",
+        ),
+        reconciliation_column("CHANNEL_NAME_DESC", tld="a.CHANNEL_NAME_DESC"),
+        reconciliation_column("SUBCHANNEL_NAME_DESC", tld="a.SUBCHANNEL_NAME_DESC"),
+        reconciliation_column("INTEGRATED", tld="a.INTEGRATED"),
+        reconciliation_column("SALES_TYPE_ID", tld="a.SALES_TYPE_ID"),
+        reconciliation_column("VENTA_BRUT_LC", tld="a.VENTA_BRUT_LC"),
+        reconciliation_column("SALES_TRANSACTION_ID_NC", integradas="nc.sales_transaction_id"),
+        reconciliation_column("NC_duplicada", integradas="CASE WHEN nc.nc_repeticiones > 1 THEN 1 ELSE 0 END"),
+        reconciliation_column("SALES_DATE_NC", integradas="nc.sales_date"),
+        reconciliation_column("sales_start_dttm_nc", integradas="nc.sales_start_dttm"),
+        reconciliation_column("sales_end_dttm_nc", integradas="nc.sales_end_dttm"),
+        reconciliation_column("VENTA_BRUTA_NC", integradas="nc.venta_bruta_nc"),
+        reconciliation_column("Tiempo_Reintegro_NC_seg", integradas="DATEDIFF(SECOND, a.sales_end_dttm, nc.sales_end_dttm)"),
+        reconciliation_column("Tiempo_Reintegro_NC_min", integradas="DATEDIFF(MINUTE, a.sales_end_dttm, nc.sales_end_dttm)"),
+        reconciliation_column("yuno_created_at", proveedor="y.created_at"),
+        reconciliation_column("yuno_updated_at", proveedor="y.updated_at"),
+        reconciliation_column("yuno_created_at_gmt", proveedor="y.created_at_local"),
+        reconciliation_column("yuno_updated_at_gmt", proveedor="y.updated_at_local"),
+        reconciliation_column("Tiempo_proceso_yuno_seg", proveedor="DATEDIFF(SECOND, y.created_at, y.updated_at)"),
+        reconciliation_column("Tiempo_recepcion_TLD_seg", conciliadas="DATEDIFF(SECOND, y.updated_at_local, a.sales_start_dttm)"),
+        reconciliation_column("Tiempo_transaccion_TLD_seg", tld="DATEDIFF(SECOND, a.sales_start_dttm, a.sales_end_dttm)"),
+        reconciliation_column("description", proveedor="y.description"),
+        reconciliation_column("payment_id", proveedor="y.payment_id"),
+        reconciliation_column("yuno_status", proveedor="y.status"),
+        reconciliation_column("yuno_sub_status", proveedor="y.sub_status"),
+        reconciliation_column("yuno_amount_value", proveedor="y.amount_value"),
+        reconciliation_column("yuno_captured", proveedor="y.captured"),
+        reconciliation_column("yuno_refunded", proveedor="y.refunded"),
+    ]
+    + reconciliation_amount_columns(reglas_montos_yuno),
+}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 4. Calculated statuses
+
+# COMMAND ----------
+
+# Ordered rule table: the first matching rule sets the status
+reglas_estado_transaccion_yuno = [
+    ("yuno_status = 'REFUNDED' AND SALES_TRANSACTION_ID IS NOT NULL", "'Compensada'"),
+    ("yuno_status = 'REFUNDED' AND SALES_TRANSACTION_ID IS NULL", "'Cancelada'"),
+    ("yuno_sub_status = 'PARTIALLY_REFUNDED' AND SALES_TRANSACTION_ID IS NOT NULL", "'Compensada parcialmente'"),
+    ("yuno_sub_status = 'PARTIALLY_REFUNDED' AND SALES_TRANSACTION_ID IS NULL", "'Cancelada parcialmente'"),
+    ("yuno_status = 'SUCCEEDED' AND SALES_TRANSACTION_ID IS NOT NULL", "'Cobrada'"),
+    ("yuno_status = 'SUCCEEDED' AND SALES_TRANSACTION_ID IS NULL", "'No encontrada'"),
+    ("yuno_status IS NULL", "'No encontrada'"),
+]
+
+
+def create_yuno_status_view():
+    """Create `cte_temp2`: cte_temp with its business date, the fraud flag and the transaction and credit note statuses."""
+    run_view_sql(f"""
+create or replace temp view cte_temp2 as
+
+SELECT
+    CAST(COALESCE(fecha, yuno_updated_at_gmt) AS DATE) as sales_business_dt,
+    *,
+case when
+    tipo_integracion = 'Manual'
+    and
+    (yuno_cancelacion_integrada + yuno_diferencia_cancelacion_integrada
+    + yuno_cancelacion_manual
+    + yuno_cobro_integrado + yuno_diferencia_cobro_integrado
+    + yuno_cobro_manual) = 0 then 1 else 0 end as Error_o_Fraude,
+
+{status_case_sql(reglas_estado_transaccion_yuno)} as Estado_Transacccion,
+
+{status_case_sql(ESTADO_NC_REGLAS)} as Estado_NC
+
+
+FROM
+  cte_temp
+ """
+    )
@@ -0,0 +1,67 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC Descripcion : Ejecuta TR_DETECCION_FRAUDES_YUNO en paralelo, una unidad de trabajo por mercado
+
+# COMMAND ----------
+
+# MAGIC %run "./TR_DETECCION_FRAUDES_INCLUDE"
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 1. Define widgets
+# MAGIC
+
+# COMMAND ----------
+
+dbutils.widgets.text('fecha_ayer', '')
+dbutils.widgets.text('mercados', '', 'Country IDs (tuple) e.g., ("080", "131")')
+dbutils.widgets.text('pipeline_run_id', '')
+dbutils.widgets.text('max_paralelo', '4', 'Markets processed at the same time')
+dbutils.widgets.text('max_intentos', '1', 'Runs per market before it is reported as failed; write conflicts are retried inside the run')
+dbutils.widgets.text('timeout_segundos', '7200', 'Timeout of each market run')
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 2. Run one unit per market
+# MAGIC
+
+# COMMAND ----------
+
+fecha_ayer = dbutils.widgets.get('fecha_ayer').strip()
+lista_mercados = parse_mercados(dbutils.widgets.get('mercados'))
+pipeline_run_id = dbutils.widgets.get('pipeline_run_id').strip()
+max_paralelo = int(dbutils.widgets.get('max_paralelo').strip() or 4)
+max_intentos = int(dbutils.widgets.get('max_intentos').strip() or 1)
+timeout_segundos = int(dbutils.widgets.get('timeout_segundos').strip() or 7200)
+
+if not lista_mercados:
+    raise ValueError("The 'mercados' widget is empty. Pass a tuple of country ids, e.g. (\"080\", \"131\").")
+
+print(f"Running {len(lista_mercados)} markets with up to {max_paralelo} in parallel: {lista_mercados}")
+
+dict_resultados = run_market_units(
+    "./TR_DETECCION_FRAUDES_YUNO",
+    lista_mercados,
+    {"fecha_ayer": fecha_ayer, "pipeline_run_id": pipeline_run_id},
+    max_parallel=max_paralelo,
+    max_attempts=max_intentos,
+    timeout_seconds=timeout_segundos,
+)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 3. Report failed markets
+# MAGIC
+
+# COMMAND ----------
+
+mercados_fallidos = {country_id: error for country_id, error in dict_resultados.items() if error is not None}
+
+if mercados_fallidos:
+    # Re-run this notebook with mercados set to the failed ids to retry only those markets.
+    raise RuntimeError(f"Markets {mercados_sql(sorted(mercados_fallidos))} failed: {mercados_fallidos}")
+
+print(f"All {len(lista_mercados)} markets processed.")
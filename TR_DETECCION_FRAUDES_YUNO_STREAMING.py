@@ -0,0 +1,310 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC Descripcion : Deteccion de fraudes Yuno casi en tiempo real, con estado por pedido sobre el change feed de pagos y ventas
+
+# COMMAND ----------
+
+# MAGIC %run "/Data Analytics/01- Circuito Industrial/00- Common/00.01_init_variables"
+
+# COMMAND ----------
+
+# MAGIC %run "/Data Analytics/01- Circuito Industrial/00- Common/00.02_load_table_include"
+
+# COMMAND ----------
+
+# MAGIC %run "./TR_DETECCION_FRAUDES_INCLUDE"
+
+# COMMAND ----------
+
+# MAGIC %run "./TR_DETECCION_FRAUDES_YUNO_INCLUDE"
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 1. Define widgets
+# MAGIC
+
+# COMMAND ----------
+
+dbutils.widgets.text('mercados', '', 'Country IDs (tuple) e.g., ("080", "131")')
+dbutils.widgets.text('target_table', '', 'Fraud detection table of TR_DETECCION_FRAUDES_YUNO (prefix of the streaming tables)')
+dbutils.widgets.text('checkpoint_location', '', 'Checkpoint of the streaming query')
+dbutils.widgets.text('starting_timestamp', '', 'First change read on a new checkpoint (empty: latest)')
+dbutils.widgets.text('trigger_intervalo', '5 minutes', "Micro-batch interval, or 'availableNow' to process the pending changes and stop")
+dbutils.widgets.text('retencion_dias', '30', 'Days of state kept behind the newest event (watermark)')
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 2. Initialize variables
+# MAGIC
+
+# COMMAND ----------
+
+lista_mercados = parse_mercados(dbutils.widgets.get('mercados'))
+target_table = dbutils.widgets.get('target_table').strip()
+checkpoint_location = dbutils.widgets.get('checkpoint_location').strip()
+starting_timestamp = dbutils.widgets.get('starting_timestamp').strip() or None
+trigger_intervalo = dbutils.widgets.get('trigger_intervalo').strip() or '5 minutes'
+retencion_dias = int(dbutils.widgets.get('retencion_dias').strip() or 30)
+
+if not lista_mercados:
+    raise ValueError("The 'mercados' widget is empty. Pass a tuple of country ids, e.g. (\"080\", \"131\").")
+if not target_table or not checkpoint_location:
+    raise ValueError("The 'target_table' and 'checkpoint_location' widgets are required.")
+
+# Yuno payments carry the country abbreviation, the flags the country name
+paises = spark.sql(f"""
+SELECT COUNTRY_ID, COUNTRY_SHORT_ABBREVIATION_CD, COUNTRY_NAME_DESC
+FROM {l3_foundation_catalog_name}.common.dim_country
+WHERE country_end_dt = '9999-12-31T00:00:00.000Z' AND COUNTRY_ID IN {mercados_sql(lista_mercados)}
+""").collect()
+
+# COMMAND ----------
+
+l1_raw_catalog_name_prod = 'l1_raw'
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 3. Keyed state and flags tables
+# MAGIC
+
+# COMMAND ----------
+
+# The fact rules of the sales read the partner and channel of the sale as well
+columnas_estado_ventas = columnas_hechos_tld + ["PARTNER_DESC", "CHANNEL_ID"]
+
+fuentes_streaming = {
+    "ventas": {
+        "source_table_name": f"{l1_raw_catalog_name_prod}.adw.SALES_TRANSACTION_SIN_BRASIL",
+        "state_table_name": f"{target_table}_streaming_ventas",
+        "columns": columnas_estado_ventas,
+        "key_columns": ["COUNTRY_ID", "SALES_TRANSACTION_ID"],
+        "country_column": "COUNTRY_ID",
+        "country_values": lista_mercados,
+        "where_sql": f"COUNTRY_ID IN {mercados_sql(lista_mercados)}",
+        "alias": "st",
+        "key_sql": "st.SPECIALSALEORDERLD",
+        "event_time_sql": "CAST(st.SALES_BUSINESS_DT AS TIMESTAMP)",
+        "keep_sql": filtro_hechos_yuno_sql(lista_mercados),
+    },
+    "pagos": {
+        "source_table_name": f"{l2_foundation_catalog_name}.app_yuno.tr_payments",
+        "state_table_name": f"{target_table}_streaming_pagos",
+        "columns": columnas_pagos_yuno + ["country"],
+        "key_columns": ["payment_id"],
+        "country_column": "country",
+        "country_values": [row["COUNTRY_SHORT_ABBREVIATION_CD"] for row in paises],
+        "where_sql": f"country IN {mercados_sql([row['COUNTRY_SHORT_ABBREVIATION_CD'] for row in paises])}",
+        "alias": "p",
+        "key_sql": clave_yuno_sql("p.merchant_order_id"),
+        "event_time_sql": "p.created_at",
+        "keep_sql": "p.status IN ('SUCCEEDED', 'REFUNDED')",
+    },
+}
+
+for dict_fuente in fuentes_streaming.values():
+    create_streaming_state_table(dict_fuente)
+
+estado_ventas = fuentes_streaming["ventas"]["state_table_name"]
+estado_pagos = fuentes_streaming["pagos"]["state_table_name"]
+payment_lines_table_name = f"{l1_raw_catalog_name_prod}.adw.payment_line_sin_brasil"
+
+# Shared with the batch notebook, which refreshes it as well
+eligible_payment_lines_table_name = f"{target_table}_eligible_payment_lines"
+create_eligible_payment_lines_table(eligible_payment_lines_table_name)
+
+run_metrics_table_name = f"{target_table}_run_metrics"
+create_run_metrics_table(run_metrics_table_name)
+
+flags_table_name = f"{target_table}_streaming_flags"
+dict_table_metadata = {
+    "comment": "Alertas de deteccion de fraudes Yuno casi en tiempo real. La tabla diaria de TR_DETECCION_FRAUDES_YUNO es la fuente oficial.",
+    "columns": [
+        {"name": "id", "type": "STRING", "comment": "Identificador de la fila, igual al de la tabla diaria."},
+        {"name": "sales_business_dt", "type": "DATE", "comment": "Fecha comercial de la venta o del pago."},
+        {"name": "country_name_desc", "type": "STRING", "comment": "Nombre descriptivo del país."},
+        {"name": "special_sale_order", "type": "STRING", "comment": "Pedido de venta especial."},
+        {"name": "sales_transaction_id", "type": "BIGINT", "comment": "ID de la transacción de venta."},
+        {"name": "payment_id", "type": "STRING", "comment": "ID del pago Yuno."},
+        {"name": "integration_type", "type": "STRING", "comment": "Tipo de integración."},
+        {"name": "concat_key", "type": "STRING", "comment": "Clave concatenada del cruce manual."},
+        {"name": "error_o_fraude", "type": "INT", "comment": "Indicador de error o fraude."},
+        {"name": "transaction_status", "type": "STRING", "comment": "Estado de la transacción."},
+        {"name": "nc_status", "type": "STRING", "comment": "Estado de la nota de crédito."},
+        {"name": "row_hash", "type": "STRING", "comment": "Hash del contenido de la fila, usado por la carga MERGE para detectar cambios."},
+        {"name": "adls_audit_run_id", "type": "STRING", "comment": "Micro-batch que escribio la fila."},
+        {"name": "adls_audit_date", "type": "TIMESTAMP", "comment": "Fecha de escritura de la fila."}
+    ],
+    "primary_key": ["id"],
+    # Every micro-batch replaces the rows of its order keys, per country
+    "cluster_by": ["country_name_desc", "special_sale_order"]
+}
+
+create_or_alter_table(
+    table_name=flags_table_name,
+    dict_table_metadata=dict_table_metadata
+)
+
+apply_table_layout(flags_table_name, dict_table_metadata)
+# Market units MERGE into the same flags table, each scoped to its own countries
+enable_row_level_concurrency(flags_table_name)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 4. Keyed matching on every micro-batch
+# MAGIC
+
+# COMMAND ----------
+
+def actualizar_concat_keys(batch_id):
+    # Concat keys of the rows touched by the micro-batch, with the same expressions as the reconciliation adapter
+    create_yuno_tld_facts_view(estado_ventas, f"st.streaming_batch_id = {batch_id}", lista_mercados)
+    create_yuno_tld_view()
+    create_yuno_payments_view(estado_pagos, f"p.streaming_batch_id = {batch_id}")
+
+    for state_table_name, claves, concat_sql in (
+        (estado_ventas, ["COUNTRY_ID", "SALES_TRANSACTION_ID"], f"SELECT a.COUNTRY_ID, a.SALES_TRANSACTION_ID, {dict_proveedor_yuno['concat_tld']} AS concat_key FROM tr_deteccion_fraudes_yuno_TLD_YUNO a"),
+        (estado_pagos, ["payment_id"], f"SELECT y.payment_id, {dict_proveedor_yuno['concat_proveedor']} AS concat_key FROM cte_yuno y"),
+    ):
+        # Touched rows left out of the views (no dimension match) get no concat key
+        run_delta_write(state_table_name, lambda: spark.sql(f"""
+
+        MERGE INTO {state_table_name} AS t
+        USING (
+          SELECT {", ".join(f"e.{clave}" for clave in claves)}, c.concat_key
+          FROM {state_table_name} e LEFT JOIN ({concat_sql}) c ON {" AND ".join(f"c.{clave} = e.{clave}" for clave in claves)}
+          WHERE e.streaming_batch_id = {batch_id}
+        ) AS s
+        ON
+          t.streaming_batch_id = {batch_id}
+          AND {" AND ".join(f"t.{clave} = s.{clave}" for clave in claves)}
+        WHEN MATCHED THEN UPDATE SET t.concat_key = s.concat_key
+
+        """
+        ))
+
+
+def procesar_lote(batch_df, batch_id):
+    run_id = f"streaming-{batch_id}"
+    run_metrics.clear()
+
+    # Keyed state: the latest row of every key, with the order and concat keys the touched keys had before
+    batch_df.persist()
+    previas = []
+    for fuente, dict_fuente in fuentes_streaming.items():
+        previas += upsert_streaming_state(change_feed_rows(batch_df, fuente, dict_fuente), dict_fuente, batch_id, retencion_dias)
+    batch_df.unpersist()
+
+    try:
+        create_dimension_snapshots()
+
+        # Sales whose payment lines changed are touched as well: they may have become eligible
+        refresh_eligible_payment_lines(eligible_payment_lines_table_name, payment_lines_table_name, regla_pago_yuno, condicion_pago_yuno, lista_mercados, run_id)
+        run_delta_write(estado_ventas, lambda: spark.sql(f"""
+
+        MERGE INTO {estado_ventas} AS t
+        USING (
+          SELECT DISTINCT sales_transaction_id, country_id
+          FROM {eligible_payment_lines_table_name}
+          WHERE rule_id = '{regla_pago_yuno}' AND country_id IN {mercados_sql(lista_mercados)} AND pipeline_run_id = '{run_id}'
+        ) AS s
+        ON
+          t.COUNTRY_ID IN {mercados_sql(lista_mercados)}
+          AND t.SALES_TRANSACTION_ID = s.sales_transaction_id
+          AND t.COUNTRY_ID = s.country_id
+        WHEN MATCHED THEN UPDATE SET t.streaming_batch_id = {batch_id}
+
+        """
+        ))
+
+        actualizar_concat_keys(batch_id)
+
+        tocadas = previas + [
+            (row["special_sale_order"], row["concat_key"])
+            for state_table_name in (estado_ventas, estado_pagos)
+            for row in collect_sql(f"SELECT DISTINCT special_sale_order, concat_key FROM {state_table_name} WHERE streaming_batch_id = {batch_id}")
+        ]
+        if not tocadas:
+            print(f"Micro-batch {batch_id}: no changed orders.")
+            return
+
+        # Every row sharing an order key or a concat key with a touched row, closed over the state
+        claves, concats = expand_streaming_scope(
+            [estado_ventas, estado_pagos],
+            [clave for clave, _ in tocadas],
+            [concat for _, concat in tocadas],
+        )
+
+        create_yuno_tld_facts_view(estado_ventas, streaming_scope_sql(claves, concats, "st"), lista_mercados, eligible_payment_lines_table_name)
+        create_yuno_tld_view()
+        materialize_view("tr_deteccion_fraudes_yuno_TLD_YUNO", storage_level="MEMORY_AND_DISK")
+        create_yuno_payments_view(estado_pagos, streaming_scope_sql(claves, concats, "p"))
+        create_yuno_last_payment_view()
+
+        build_reconciliation(dict_proveedor_yuno)
+        assert_reconciliation_checkpoints(run_metrics_table_name, "TR_DETECCION_FRAUDES_YUNO_STREAMING", run_id, lista_mercados)
+        create_yuno_status_view()
+
+        run_view_sql(f"""
+        CREATE OR REPLACE TEMP VIEW tr_deteccion_fraudes_yuno_streaming_TEMP AS
+        SELECT
+          concat(nvl(cast(sales_business_dt as string), '0'),'-',nvl(SPECIAL_SALE_ORDER,0),'-',nvl(SALEKEY,0)) AS id,
+          sales_business_dt,
+          COUNTRY_NAME_DESC AS country_name_desc,
+          SPECIAL_SALE_ORDER AS special_sale_order,
+          SALES_TRANSACTION_ID AS sales_transaction_id,
+          payment_id,
+          tipo_integracion AS integration_type,
+          clave_concatenada AS concat_key,
+          Error_o_Fraude AS error_o_fraude,
+          Estado_Transacccion AS transaction_status,
+          Estado_NC AS nc_status,
+          '{run_id}' AS adls_audit_run_id,
+          FROM_UTC_TIMESTAMP(CURRENT_TIMESTAMP(), 'UTC-3') AS adls_audit_date
+        FROM
+          cte_temp2
+        """
+        )
+
+        # The scope is closed, so it holds every row written before for its order keys. Rows without a valid order
+        # key are replaced by their own ids.
+        ventas_sin_clave = [row[0] for row in collect_sql(f"SELECT SALES_TRANSACTION_ID FROM tr_deteccion_fraudes_yuno_TLD_YUNO WHERE NOT {valid_key_sql('SPECIAL_SALE_ORDER')}")]
+        pagos_sin_clave = [row[0] for row in collect_sql(f"SELECT payment_id FROM cte_yuno_ultimo_pago WHERE NOT {valid_key_sql('SPECIAL_SALES_ORDER')}")]
+        sql_clause = f"""country_name_desc IN {mercados_sql([row["COUNTRY_NAME_DESC"] for row in paises])}
+          AND (
+            {literal_in_sql("special_sale_order", claves)}
+            OR {literal_in_sql("sales_transaction_id", ventas_sin_clave)}
+            OR {literal_in_sql("payment_id", pagos_sin_clave)}
+          )"""
+
+        load_table_merge(flags_table_name, "tr_deteccion_fraudes_yuno_streaming_TEMP", dict_table_metadata["primary_key"], sql_clause, run_id=run_id)
+        print(f"Micro-batch {batch_id}: {len(claves)} order keys and {len(concats)} concat keys matched.")
+    finally:
+        release_materialized_views()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # 5. Start the streaming query
+# MAGIC
+
+# COMMAND ----------
+
+writer = (
+    change_feed_stream(fuentes_streaming, starting_timestamp)
+    .writeStream
+    .foreachBatch(procesar_lote)
+    .option("checkpointLocation", checkpoint_location)
+    .queryName("tr_deteccion_fraudes_yuno_streaming")
+)
+
+if trigger_intervalo == 'availableNow':
+    writer = writer.trigger(availableNow=True)
+else:
+    writer = writer.trigger(processingTime=trigger_intervalo)
+
+query = writer.start()
+query.awaitTermination()
@@ -0,0 +1,93 @@
+"""Parity check of the DuckDB single-node backend against Spark on the benchmark data.
+
+Runs each notebook twice on the data written by generate_data.py, once with sql_backend SPARK and once with
+DUCKDB, starting from an empty benchmark schema each time. Both outputs are compared with EXCEPT ALL in each
+direction, so duplicated rows count. The row_hash of the MERGE is part of the comparison. adls_audit_date
+(the run timestamp) is left out. The check fails on the first pipeline whose outputs differ and prints the
+differing rows.
+
+Requires pyspark, delta-spark, duckdb and sqlglot.
+
+Usage:
+    python benchmarks/check_backend_parity.py --data /tmp/fraudes_bench --pipeline all
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from run_benchmark import (  # noqa: E402
+    BENCHMARK_SCHEMA,
+    NOTEBOOKS,
+    StageMetrics,
+    create_session,
+    pipeline_widgets,
+    run_pipeline,
+    target_table_name,
+)
+
+BACKENDS = ["SPARK", "DUCKDB"]
+IGNORED_COLUMNS = {"adls_audit_date"}
+
+
+def run_backend(spark, manifest, pipeline, backend, metrics):
+    """Run the pipeline on an empty benchmark schema and keep its output as benchmark_parity.<pipeline>_<backend>."""
+    spark.sql(f"DROP DATABASE IF EXISTS {BENCHMARK_SCHEMA} CASCADE")
+    spark.sql(f"CREATE DATABASE {BENCHMARK_SCHEMA}")
+    results = []
+    run_pipeline(spark, pipeline, pipeline_widgets(manifest, pipeline, backend), metrics, results)
+
+    output = spark.table(target_table_name(pipeline))
+    output = output.select([c for c in output.columns if c.lower() not in IGNORED_COLUMNS])
+    output.write.mode("overwrite").saveAsTable(f"benchmark_parity.{pipeline}_{backend.lower()}")
+    print(f"  [{pipeline}] {backend}: {output.count()} rows in {results[-1]['wall_time_s']}s")
+
+
+def compare(spark, pipeline, limit):
+    spark_output = spark.table(f"benchmark_parity.{pipeline}_spark")
+    duckdb_output = spark.table(f"benchmark_parity.{pipeline}_duckdb")
+    if spark_output.schema.simpleString() != duckdb_output.schema.simpleString():
+        print(f"  [{pipeline}] schemas differ:\n    SPARK  {spark_output.schema.simpleString()}\n    DUCKDB {duckdb_output.schema.simpleString()}")
+        return False
+
+    solo_spark = spark_output.exceptAll(duckdb_output)
+    solo_duckdb = duckdb_output.exceptAll(spark_output)
+    filas_spark, filas_duckdb = solo_spark.count(), solo_duckdb.count()
+    if filas_spark or filas_duckdb:
+        print(f"  [{pipeline}] {filas_spark} rows only in SPARK, {filas_duckdb} rows only in DUCKDB")
+        solo_spark.show(limit, truncate=False)
+        solo_duckdb.show(limit, truncate=False)
+        return False
+    print(f"  [{pipeline}] outputs are identical")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--data", required=True, help="Directory written by generate_data.py")
+    parser.add_argument("--pipeline", default="all", choices=["ifood", "yuno", "all"])
+    parser.add_argument("--work-dir", default="/tmp/fraudes_parity_work", help="Warehouse of the target tables, wiped on start")
+    parser.add_argument("--show", type=int, default=10, help="Differing rows printed per backend")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.data, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    spark = create_session(args.data, manifest, args.work_dir)
+    spark.sql("CREATE DATABASE IF NOT EXISTS benchmark_parity")
+    metrics = StageMetrics(spark)
+
+    pipelines = list(NOTEBOOKS) if args.pipeline == "all" else [args.pipeline]
+    for pipeline in pipelines:
+        print(f"Comparing backends on {pipeline} at scale {manifest['scale']}x")
+        for backend in BACKENDS:
+            run_backend(spark, manifest, pipeline, backend, metrics)
+        if not compare(spark, pipeline, args.show):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Plan-shape check of every temp view built by the notebooks on the benchmark data.
+
+Runs each notebook on local Spark over the data written by generate_data.py. It captures the EXPLAIN FORMATTED
+plan of every view right after run_view_sql creates it, with the caches of the run in place. Each plan is then
+checked against three rules:
+
+  shuffles       Exchange nodes outside cached relations, at most the budget of the view in plan_budgets.json
+  no cartesian   no CartesianProduct or BroadcastNestedLoopJoin anywhere in the plan
+  broadcast      every scan of a dimension snapshot that passed the size guard reaches its join through a
+                 BroadcastExchange
+
+A view with no budget fails the check, unless --allow-missing is given (e.g. for a new view, until its budget is
+recorded). After a reviewed plan change, run with --record to write the current shuffle counts as the new budgets
+and commit plan_budgets.json with the change.
+
+Requires pyspark and delta-spark.
+
+Usage:
+    python benchmarks/check_plan_budgets.py --data /tmp/fraudes_bench --pipeline all
+    python benchmarks/check_plan_budgets.py --data /tmp/fraudes_bench --pipeline ifood --record
+    python benchmarks/check_plan_budgets.py --data /tmp/fraudes_bench --pipeline yuno --allow-missing
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from run_benchmark import NOTEBOOKS, StageMetrics, create_session, pipeline_widgets, run_pipeline  # noqa: E402
+
+BUDGETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_budgets.json")
+
+FORBIDDEN_NODES = ("CartesianProduct", "BroadcastNestedLoopJoin")
+
+# Source table of each dimension snapshot, as it appears in the Scan nodes
+DIMENSION_SOURCES = {
+    "dim_location_actual": "common.dim_location",
+    "dim_country_actual": "common.dim_country",
+    "lk_sale_channel_actual": "common.lk_sale_channel",
+    "lk_sale_subchannel_actual": "common.lk_sale_subchannel",
+}
+
+PLAN_NODE_PATTERN = re.compile(r"^([ :+\-]*)(?:\* )?(\w.*) \((\d+)\)$")
+
+
+def plan_nodes(plan):
+    """(name, ancestor names) of every node of the operator trees of an EXPLAIN FORMATTED plan, subqueries included."""
+    nodes = []
+    stack = []
+    for line in plan.splitlines():
+        match = PLAN_NODE_PATTERN.match(line)
+        # Node details start with "(id) Name" and are not part of the trees
+        if not match or line.startswith("("):
+            continue
+        depth, name = len(match.group(1)), match.group(2)
+        while stack and stack[-1][0] >= depth:
+            stack.pop()
+        nodes.append((name, [ancestor for _, ancestor in reversed(stack)]))
+        stack.append((depth, name))
+    return nodes
+
+
+def check_plan(plan, dimension_tables):
+    """Shuffle count and rule violations of one view plan."""
+    nodes = plan_nodes(plan)
+    shuffles = sum(
+        1 for name, ancestors in nodes
+        if name.startswith("Exchange") and not any(a.startswith("InMemoryRelation") for a in ancestors)
+    )
+
+    violations = [f"{name} in the plan" for name, _ in nodes if name.startswith(FORBIDDEN_NODES)]
+    for name, ancestors in nodes:
+        table = next((t for t in dimension_tables if name.startswith("Scan") and name.endswith(t)), None)
+        if table is None:
+            continue
+        for ancestor in ancestors:
+            if ancestor.startswith("BroadcastExchange"):
+                break
+            if "Join" in ancestor:
+                violations.append(f"{table} reaches {ancestor} without a broadcast")
+                break
+    return shuffles, violations
+
+
+def capture_view_plans(spark, plans):
+    """on_include callback: wrap run_view_sql so the plan of every view is kept when it is created."""
+
+    def on_include(namespace):
+        run_view_sql = namespace["run_view_sql"]
+        pattern = namespace["TEMP_VIEW_NAME_PATTERN"]
+
+        def run_view_sql_with_plan(sql_text, *args, **kwargs):
+            result = run_view_sql(sql_text, *args, **kwargs)
+            view_match = pattern.search(sql_text)
+            if view_match:
+                view_name = view_match.group(1)
+                plans[view_name] = spark.sql(f"EXPLAIN FORMATTED SELECT * FROM {view_name}").collect()[0][0]
+            return result
+
+        namespace["run_view_sql"] = run_view_sql_with_plan
+        plans["__namespace__"] = namespace
+
+    return on_include
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--data", required=True, help="Directory written by generate_data.py")
+    parser.add_argument("--pipeline", default="all", choices=["ifood", "yuno", "all"])
+    parser.add_argument("--work-dir", default="/tmp/fraudes_plan_work", help="Warehouse of the target tables, wiped on start")
+    parser.add_argument("--budgets", default=BUDGETS_PATH)
+    parser.add_argument("--record", action="store_true", help="Write the current shuffle counts as the budgets")
+    parser.add_argument("--allow-missing", action="store_true", help="Report views without a budget instead of failing")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.data, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    budgets = {}
+    if os.path.exists(args.budgets):
+        with open(args.budgets) as f:
+            budgets = json.load(f)
+
+    spark = create_session(args.data, manifest, args.work_dir)
+    metrics = StageMetrics(spark)
+
+    failures = []
+    pipelines = list(NOTEBOOKS) if args.pipeline == "all" else [args.pipeline]
+    for pipeline in pipelines:
+        print(f"Checking the view plans of {pipeline}")
+        plans = {}
+        run_pipeline(spark, pipeline, pipeline_widgets(manifest, pipeline), metrics, [], on_include=capture_view_plans(spark, plans))
+
+        broadcast_dimensions = plans.pop("__namespace__")["broadcast_dimensions"]
+        dimension_tables = [table for view, table in DIMENSION_SOURCES.items() if broadcast_dimensions.get(view)]
+
+        pipeline_budgets = budgets.setdefault(pipeline, {})
+        for view_name, plan in plans.items():
+            shuffles, violations = check_plan(plan, dimension_tables)
+            if args.record:
+                pipeline_budgets[view_name] = shuffles
+            budget = pipeline_budgets.get(view_name)
+            if budget is None:
+                if args.allow_missing:
+                    print(f"  [{pipeline}] {view_name}: no shuffle budget, run with --record to set one")
+                else:
+                    violations.append("no shuffle budget, run with --record")
+            elif shuffles > budget:
+                violations.append(f"{shuffles} shuffles over a budget of {budget}")
+
+            print(f"  [{pipeline}] {view_name}: {shuffles} shuffles (budget {budget}){'' if violations else ', ok'}")
+            for violation in violations:
+                print(f"    {violation}")
+            failures.extend(f"{pipeline}.{view_name}: {violation}" for violation in violations)
+
+    if args.record:
+        with open(args.budgets, "w") as f:
+            json.dump(budgets, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Budgets written to {args.budgets}")
+
+    if failures:
+        print(f"{len(failures)} plan checks failed.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Check of the reconciliation conservation rules on hand-built views, with sales_type_id typed as INT and as STRING.
+
+check_reconciliation groups the TLD sales by sales_type_id and compares the sales group with the TLD conciliation
+branches. The target schema declares the column STRING while the benchmark generator writes ints, so the benchmark
+runs alone cannot show that the rule holds on string sources. This script builds the four views the rule reads for
+both types and runs check_reconciliation on local Spark:
+
+  conserved    every sale is in exactly one TLD branch: both CHECK stages must pass
+  lost sale    one sale is missing from the TLD branches: the TLD rule must fail
+
+Requires pyspark.
+
+Usage:
+    python benchmarks/check_reconciliation_checkpoints.py
+"""
+
+import os
+import sys
+
+from pyspark.sql import SparkSession
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from run_benchmark import REPO_DIR, read_cells  # noqa: E402
+
+DICT_PROVEEDOR = {
+    "vista_tld": "tld_prueba",
+    "vista_proveedor": "proveedor_prueba",
+    "tld_monto": "VENTA_BRUT_LC",
+    "proveedor_monto": "amount_value",
+    "proveedor_id": "payment_id",
+}
+
+# (sales_transaction_id, sales_type_id, VENTA_BRUT_LC): two sales and one credit note
+VENTAS = [(1, 1, 100.0), (2, 1, 50.5), (3, 2, -100.0)]
+PAGOS = [("pay-1", 100.0), ("pay-2", 50.5)]
+
+
+def load_include(spark):
+    """Execute the include notebook with the local session and return its namespace."""
+    namespace = {"spark": spark, "dbutils": None}
+    for _, source in read_cells(os.path.join(REPO_DIR, "TR_DETECCION_FRAUDES_INCLUDE.py")):
+        exec("\n".join(line for line in source.splitlines() if not line.startswith("# MAGIC")), namespace)
+    return namespace
+
+
+def create_views(spark, sales_type, lost_sale):
+    spark.createDataFrame(
+        [(venta, str(tipo) if sales_type == "STRING" else tipo, monto) for venta, tipo, monto in VENTAS],
+        f"sales_transaction_id BIGINT, sales_type_id {sales_type}, VENTA_BRUT_LC DOUBLE",
+    ).createOrReplaceTempView("tld_prueba")
+    spark.sql(f"""
+    CREATE OR REPLACE TEMP VIEW cte_tld_conciliacion AS
+    SELECT IF(sales_transaction_id = 1, 'integradas', 'manuales') AS rama_conciliacion, VENTA_BRUT_LC
+    FROM tld_prueba
+    WHERE sales_type_id = 1 {"AND sales_transaction_id <> 2" if lost_sale else ""}
+    """)
+
+    spark.createDataFrame(PAGOS, "payment_id STRING, amount_value DOUBLE").createOrReplaceTempView("proveedor_prueba")
+    spark.sql("""
+    CREATE OR REPLACE TEMP VIEW cte_proveedor_conciliacion AS
+    SELECT IF(payment_id = 'pay-1', 'integradas', 'manuales') AS rama_conciliacion, payment_id, amount_value
+    FROM proveedor_prueba
+    """)
+
+
+def run_case(spark, include, sales_type, lost_sale):
+    """Run check_reconciliation on one case and return {rule: passed}."""
+    create_views(spark, sales_type, lost_sale)
+    include["run_metrics"].clear()
+    try:
+        include["check_reconciliation"](DICT_PROVEEDOR)
+    finally:
+        include["release_materialized_views"]()
+    return {record["stage_name"]: record["check_passed"] for record in include["run_metrics"] if record["stage_type"] == "CHECK"}
+
+
+def main():
+    spark = SparkSession.builder.appName("fraudes-reconciliation-checkpoints").master("local[2]").getOrCreate()
+    include = load_include(spark)
+    regla_tld = f"{DICT_PROVEEDOR['vista_tld']} ventas = cte_tld_conciliacion"
+
+    failures = []
+    for sales_type in ("INT", "STRING"):
+        for lost_sale in (False, True):
+            checks = run_case(spark, include, sales_type, lost_sale)
+            expected = {regla_tld: not lost_sale, f"{DICT_PROVEEDOR['vista_proveedor']} = cte_proveedor_conciliacion": True}
+            case = f"sales_type_id {sales_type}, {'lost sale' if lost_sale else 'conserved'}"
+            if checks != expected:
+                failures.append(case)
+                print(f"FAIL {case}: {checks}, expected {expected}")
+            else:
+                print(f"ok   {case}")
+
+    spark.stop()
+    if failures:
+        sys.exit(1)
+    print("The conservation rules hold for INT and STRING sales_type_id.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""Property-based parity check of the reconciliation rule tables against the SQL they replaced.
+
+The status CASEs of cte_temp2 and the per-branch CASEs of cte_temp are now generated from rule tables. This script
+draws random rows over the value domains the rules test, NULLs included. It evaluates the generated SQL and the
+former hand-written SQL side by side on local Spark and fails on the first rows where they disagree:
+
+  estado_transacccion (iFood and Yuno)   rule tables of the notebooks vs the former CASE
+  estado_nc                              ESTADO_NC_REGLAS vs the former CASE
+  branch selection                       CASE on rama_salida vs the former join predicates, for every branch
+
+The amount rule tables (reglas_montos_3po, reglas_montos_yuno) are checked without Spark: every amount column they
+expand to must have, in every branch, the expression of the reconciliation_column it replaced.
+
+Requires pyspark.
+
+Usage:
+    python benchmarks/check_rule_parity.py --rows 20000 --seed 7
+"""
+
+import argparse
+import ast
+import os
+import random
+import sys
+
+from pyspark.sql import SparkSession
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from run_benchmark import REPO_DIR, read_cells  # noqa: E402
+
+# The CASE expressions as they were written in cte_temp2 before the rule tables
+ESTADO_TRANSACCION_YUNO_SQL = """case
+    when yuno_status = 'REFUNDED' and SALES_TRANSACTION_ID is not null then 'Compensada'
+    when yuno_status = 'REFUNDED' and SALES_TRANSACTION_ID is null then 'Cancelada'
+    when yuno_sub_status = 'PARTIALLY_REFUNDED' and SALES_TRANSACTION_ID is not null then 'Compensada parcialmente'
+    when yuno_sub_status = 'PARTIALLY_REFUNDED' and SALES_TRANSACTION_ID is null then 'Cancelada parcialmente'
+    when yuno_status = 'SUCCEEDED' and SALES_TRANSACTION_ID is not null then 'Cobrada'
+    when yuno_status = 'SUCCEEDED' and SALES_TRANSACTION_ID is null then 'No encontrada'
+    when yuno_status is null then 'No encontrada' end"""
+
+ESTADO_TRANSACCION_3PO_SQL = """CASE
+    WHEN 3po_status = 'Ressarcimento/Indenização' AND `3po_captured` < `3po_amount_value` AND sales_transaction_id IS NOT null THEN 'Compensada parcialmente'
+    WHEN 3po_status = 'Ressarcimento/Indenização' AND `3po_captured` >= `3po_amount_value` AND sales_transaction_id IS NOT null THEN 'Compensada'
+    WHEN 3po_status = 'Cancelamento Parcial' AND sales_transaction_id IS NOT null THEN 'Cancelada parcialmente'
+    WHEN 3po_status = 'Cancelamento Total' AND sales_transaction_id IS NOT null THEN 'Cancelada'
+    WHEN 3po_status = 'Venda' AND sales_transaction_id IS NOT null THEN 'Cobrada'
+    WHEN 3po_status = 'Ocorrencia Venda' AND sales_transaction_id IS NOT null THEN 'Cobrada por tercero'
+    WHEN sales_transaction_id IS null OR 3po_status IS null THEN 'No encontrada'
+  END"""
+
+ESTADO_NC_SQL = """CASE WHEN nc_duplicada = 1 THEN 'Nota de crédito duplicada'
+    WHEN sales_transaction_id_nc IS null THEN 'No aplica NC'
+    WHEN sales_transaction_id_nc IS NOT null THEN 'Nota de crédito aplicada'
+  END"""
+
+# Join predicates of each branch as the engine wrote them before rama_salida, kept here so that a change to
+# RECONCILIATION_BRANCH_CONDITIONS is caught as well
+FORMER_BRANCH_CONDITIONS = {
+    "integradas": "a.rama_conciliacion = 'integradas'",
+    "manuales_asociadas": "a.rama_conciliacion = 'manuales' AND y.rama_conciliacion IS NOT NULL",
+    "tld_manuales_sin_match": "a.rama_conciliacion = 'manuales' AND y.rama_conciliacion IS NULL",
+    "tld_manuales_duplicadas": "a.rama_conciliacion = 'tld_manuales_duplicadas'",
+    "tld_integradas_sin_proveedor": "a.rama_conciliacion = 'tld_integradas_sin_proveedor'",
+    "proveedor_duplicadas": "y.rama_conciliacion = 'proveedor_duplicadas'",
+    "proveedor_sin_match": "a.rama_conciliacion IS NULL AND y.rama_conciliacion = 'manuales'",
+}
+
+# The amount columns as they were declared before the rule tables: (column, {branch or group: expression name}),
+# every other branch 0
+FORMER_AMOUNT_COLUMNS = {
+    ("TR_DETECCION_FRAUDES_IFOOD.py", "reglas_montos_3po"): [
+        ("3po_cobro_integrado", {"integradas": "cobro_3po"}),
+        ("3po_diferencia_cobro_integrada", {"integradas": "diferencia_cobro_3po"}),
+        ("3po_cancelacion_integrada", {"integradas": "cancelacion_3po"}),
+        ("3po_diferencia_cancelacion_integrada", {"integradas": "diferencia_cancelacion_3po"}),
+        ("3po_cancelacion_parcial_integrada", {}),
+        ("3po_diferencia_cancelacion_parcial_integrada", {"integradas": "diferencia_cancelacion_parcial_3po"}),
+        ("3po_compensacion_integrada", {"integradas": "compensacion_3po"}),
+        ("3po_diferencia_compensacion_integrada", {}),
+        ("3po_compensacion_parcial_integrada", {}),
+        ("3po_diferencia_compensacion_parcial_integrada", {"integradas": "diferencia_compensacion_parcial_3po"}),
+        (
+            "3po_cobro_manual",
+            {"manuales_asociadas": "cobro_3po_decimal", "proveedor_duplicadas": "cobro_3po_decimal", "proveedor_sin_match": "cobro_3po"},
+        ),
+        ("3po_diferencia_cobro_manual", {"manuales_asociadas": "diferencia_cobro_3po"}),
+        ("3po_cancelacion_manual", {"manuales_asociadas": "cancelacion_3po", "solo_proveedor": "cancelacion_3po"}),
+        ("3po_diferencia_cancelacion_manual", {"manuales_asociadas": "diferencia_cancelacion_3po"}),
+        ("3po_cancelacion_parcial_manual", {}),
+        ("3po_diferencia_cancelacion_parcial_manual", {"manuales_asociadas": "diferencia_cancelacion_parcial_3po"}),
+        ("3po_compensacion_manual", {"manuales_asociadas": "compensacion_3po", "solo_proveedor": "compensacion_3po"}),
+        ("3po_diferencia_compensacion_manual", {}),
+        ("3po_compensacion_parcial_manual", {}),
+        ("3po_diferencia_compensacion_parcial_manual", {"manuales_asociadas": "diferencia_compensacion_parcial_3po"}),
+    ],
+    ("TR_DETECCION_FRAUDES_YUNO_INCLUDE.py", "reglas_montos_yuno"): [
+        ("yuno_cobro_integrado", {"integradas": "cobro_yuno"}),
+        ("yuno_diferencia_cobro_integrado", {"integradas": "diferencia_cobro_yuno"}),
+        ("yuno_cancelacion_integrada", {}),
+        ("yuno_diferencia_cancelacion_integrada", {}),
+        ("yuno_compensacion_integrada", {"integradas": "compensacion_yuno"}),
+        ("yuno_diferencia_compensacion_integrada", {"integradas": "diferencia_compensacion_yuno"}),
+        ("yuno_compensacion_parcial_integrada", {"integradas": "compensacion_parcial_yuno"}),
+        ("yuno_cobro_manual", {"manuales_asociadas": "cobro_yuno", "solo_proveedor": "cobro_yuno"}),
+        ("yuno_diferencia_cobro_manual", {"manuales_asociadas": "diferencia_cobro_yuno"}),
+        ("yuno_cancelacion_manual", {"solo_proveedor": "cancelacion_yuno"}),
+        ("yuno_diferencia_cancelacion_manual", {}),
+        ("yuno_compensacion_manual", {"manuales_asociadas": "compensacion_yuno"}),
+        ("yuno_diferencia_compensacion_manual", {"manuales_asociadas": "diferencia_compensacion_yuno"}),
+        ("yuno_compensacion_parcial_manual", {"manuales_asociadas": "compensacion_parcial_yuno"}),
+    ],
+}
+
+DOMINIOS = {
+    "yuno_status": ["SUCCEEDED", "REFUNDED", "DECLINED", None],
+    "yuno_sub_status": ["PARTIALLY_REFUNDED", "APPROVED", None],
+    "3po_status": ["Ressarcimento/Indenização", "Cancelamento Parcial", "Cancelamento Total", "Venda", "Ocorrencia Venda", "Outros", None],
+    "3po_captured": [0.0, 10.0, 25.5, 100.0, None],
+    "3po_amount_value": [0.0, 10.0, 25.5, 100.0, None],
+    "sales_transaction_id": [1, 2, None],
+    "sales_transaction_id_nc": [11, None],
+    "nc_duplicada": [0, 1, None],
+    "a_rama": ["integradas", "manuales", "tld_manuales_duplicadas", "tld_integradas_sin_proveedor", None],
+    "y_rama": ["integradas", "manuales", "proveedor_duplicadas", None],
+}
+
+ESQUEMA = (
+    "yuno_status STRING, yuno_sub_status STRING, 3po_status STRING, 3po_captured DOUBLE, 3po_amount_value DOUBLE, "
+    "sales_transaction_id BIGINT, sales_transaction_id_nc BIGINT, nc_duplicada INT, a_rama STRING, y_rama STRING"
+)
+
+
+def load_include():
+    """Execute the include notebook and return its namespace (its functions only need spark when called)."""
+    namespace = {"spark": None, "dbutils": None}
+    for _, source in read_cells(os.path.join(REPO_DIR, "TR_DETECCION_FRAUDES_INCLUDE.py")):
+        exec("\n".join(line for line in source.splitlines() if not line.startswith("# MAGIC")), namespace)
+    return namespace
+
+
+def notebook_assignment(notebook, name):
+    """Evaluate the literal assignment of `name` in a notebook without running the notebook."""
+    with open(os.path.join(REPO_DIR, notebook), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == name for target in node.targets):
+            return ast.literal_eval(node.value)
+
+    raise KeyError(f"{name} is not assigned in {notebook}")
+
+
+def notebook_assignments(notebook):
+    """Evaluate the top-level assignments of a notebook built only from literals and earlier assignments.
+
+    Assignments that need anything else (spark, functions of the include) are skipped.
+    """
+    with open(os.path.join(REPO_DIR, notebook), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+
+    namespace = {}
+    for node in tree.body:
+        if not (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)):
+            continue
+        try:
+            namespace[node.targets[0].id] = eval(compile(ast.Expression(node.value), notebook, "eval"), {"__builtins__": {}}, dict(namespace))
+        except Exception:
+            continue
+    return namespace
+
+
+def check_amount_columns(include, notebook, rule_table):
+    """Compare, branch by branch, the amount columns of a rule table with the reconciliation_columns they replaced."""
+    assignments = notebook_assignments(notebook)
+    generated = include["reconciliation_amount_columns"](assignments[rule_table])
+    former = [
+        include["reconciliation_column"](name, "0", **{branch: assignments[expression] for branch, expression in expressions.items()})
+        for name, expressions in FORMER_AMOUNT_COLUMNS[(notebook, rule_table)]
+    ]
+
+    mismatches = []
+    if [name for name, _ in generated] != [name for name, _ in former]:
+        mismatches.append(f"columns {[name for name, _ in generated]} instead of {[name for name, _ in former]}")
+    for (name, generated_branches), (_, former_branches) in zip(generated, former):
+        mismatches += [
+            f"{name} in {branch}: {generated_branches[branch]!r} instead of {former_branches[branch]!r}"
+            for branch in include["RECONCILIATION_BRANCHES"]
+            if generated_branches[branch] != former_branches[branch]
+        ]
+
+    if mismatches:
+        print(f"FAIL {rule_table}:")
+        for mismatch in mismatches[:5]:
+            print(f"  {mismatch}")
+        return False
+
+    print(f"ok   {rule_table} ({len(generated)} columns)")
+    return True
+
+
+def former_branch_case(expressions, branches):
+    """The per-branch CASE as the engine wrote it before rama_salida: one predicate per branch on the join tags."""
+    grouped = {}
+    for branch in branches:
+        grouped.setdefault(expressions[branch], []).append(branch)
+
+    default = max(grouped, key=lambda expression: len(grouped[expression]))
+    whens = [
+        "WHEN " + " OR ".join(f"({FORMER_BRANCH_CONDITIONS[branch]})" for branch in grouped_branches) + f" THEN {expression}"
+        for expression, grouped_branches in grouped.items()
+        if expression != default
+    ]
+    return "CASE " + " ".join(whens) + f" ELSE {default} END"
+
+
+def random_rows(rows, seed):
+    rng = random.Random(seed)
+    return [tuple(rng.choice(values) for values in DOMINIOS.values()) for _ in range(rows)]
+
+
+def check(spark, name, generated_sql, former_sql, table="filas"):
+    mismatches = spark.sql(f"""
+    SELECT *, {generated_sql} AS generado, {former_sql} AS anterior
+    FROM {table}
+    WHERE NOT ({generated_sql}) <=> ({former_sql})
+    """).limit(5).collect()
+
+    if mismatches:
+        print(f"FAIL {name}:")
+        for row in mismatches:
+            print(f"  {row.asDict()}")
+        return False
+
+    print(f"ok   {name}")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    include = load_include()
+    spark = SparkSession.builder.appName("fraudes-rule-parity").master("local[2]").getOrCreate()
+    spark.createDataFrame(random_rows(args.rows, args.seed), ESQUEMA).createOrReplaceTempView("filas")
+
+    checks = [
+        (
+            "estado_transacccion yuno",
+            include["status_case_sql"](notebook_assignment("TR_DETECCION_FRAUDES_YUNO_INCLUDE.py", "reglas_estado_transaccion_yuno")),
+            ESTADO_TRANSACCION_YUNO_SQL,
+        ),
+        (
+            "estado_transacccion 3po",
+            include["status_case_sql"](notebook_assignment("TR_DETECCION_FRAUDES_IFOOD.py", "reglas_estado_transaccion_3po")),
+            ESTADO_TRANSACCION_3PO_SQL,
+        ),
+        ("estado_nc", include["status_case_sql"](include["ESTADO_NC_REGLAS"]), ESTADO_NC_SQL),
+    ]
+
+    # Branch selection: every branch gets a distinct marker, alone and grouped with each other branch
+    spark.sql("""
+    CREATE OR REPLACE TEMP VIEW filas_conciliacion AS
+    SELECT STRUCT(a_rama AS rama_conciliacion) AS a, STRUCT(y_rama AS rama_conciliacion) AS y
+    FROM filas
+    WHERE a_rama IS NOT NULL OR y_rama <> 'integradas'
+    """)
+    branch_checks = []
+    for modo in ("SIN_CLAVE", "NO_INTEGRADAS"):
+        branches = [
+            branch for branch in include["RECONCILIATION_BRANCHES"]
+            if branch != "tld_integradas_sin_proveedor" or modo == "SIN_CLAVE"
+        ]
+        rama_salida = include["reconciliation_branch_sql"](branches)
+        for marcada in branches:
+            for companera in branches:
+                expressions = {branch: "'otra'" for branch in branches}
+                expressions[marcada] = expressions[companera] = "'marcada'"
+                branch_checks.append((
+                    f"branch {modo} {marcada}+{companera}",
+                    include["reconciliation_case_sql"](expressions, branches).replace("rama_salida", f"({rama_salida})"),
+                    former_branch_case(expressions, branches),
+                ))
+
+    results = [check_amount_columns(include, *rule_table) for rule_table in FORMER_AMOUNT_COLUMNS]
+    results += [check(spark, *item) for item in checks]
+    results += [check(spark, *item, table="filas_conciliacion") for item in branch_checks]
+
+    spark.stop()
+    if not all(results):
+        sys.exit(1)
+    print(f"All {len(results)} rule tables match the former SQL on {args.rows} random rows.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Check of the Yuno streaming variant against the daily notebook on the benchmark data.
+
+Replays the Yuno sales and payments written by generate_data.py --format delta into change-feed enabled tables, in
+two steps, and runs TR_DETECCION_FRAUDES_YUNO_STREAMING with the availableNow trigger after each one:
+
+  step 1   two thirds of the sales and half of the payments
+  step 2   the rest of the rows, then one in ten succeeded payments refunded in full a day later
+
+The second run starts from the checkpoint and the keyed state of the first, so orders split across the steps, and
+payments updated after their order was flagged, are matched again from the state. The daily notebook then runs
+over every business date of the data, and both outputs are compared with EXCEPT ALL in each direction on the
+columns of the streaming flags.
+
+Requires pyspark and delta-spark, and data generated with --format delta.
+
+Usage:
+    python benchmarks/check_streaming.py --data /tmp/fraudes_bench_delta
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from run_benchmark import StageMetrics, create_session, pipeline_widgets, run_pipeline, target_table_name  # noqa: E402
+
+STREAMING_NOTEBOOK = "TR_DETECCION_FRAUDES_YUNO_STREAMING.py"
+
+STREAMED_SOURCES = {
+    "adw.sales_transaction_sin_brasil": ("pmod(sales_transaction_id, 3) <> 0", "pmod(sales_transaction_id, 3) = 0"),
+    "app_yuno.tr_payments": ("pmod(xxhash64(payment_id), 2) = 0", "pmod(xxhash64(payment_id), 2) <> 0"),
+}
+
+# Columns of the streaming flags and the batch target columns they come from
+COMPARED_COLUMNS = {
+    "id": "ID",
+    "sales_business_dt": "sales_business_dt",
+    "country_name_desc": "COUNTRY_NAME_DESC",
+    "special_sale_order": "SPECIAL_SALE_ORDER",
+    "sales_transaction_id": "SALES_TRANSACTION_ID",
+    "payment_id": "external_order_payment_id",
+    "integration_type": "Integration_type",
+    "concat_key": "concat_key",
+    "transaction_status": "transaction_status",
+    "nc_status": "NC_status",
+}
+
+
+def create_change_feed_sources(spark):
+    """Move the streamed sources aside and recreate them empty, with the change data feed enabled."""
+    spark.sql("CREATE DATABASE IF NOT EXISTS benchmark_streaming_source")
+    for table in STREAMED_SOURCES:
+        copy = f"benchmark_streaming_source.{table.replace('.', '_')}"
+        spark.sql(f"DROP TABLE IF EXISTS {copy}")
+        spark.sql(f"CREATE TABLE {copy} USING DELTA AS SELECT * FROM {table}")
+        # The generated table is external: dropping it leaves its files in place
+        spark.sql(f"DROP TABLE {table}")
+        spark.sql(f"""
+        CREATE TABLE {table} USING DELTA TBLPROPERTIES (delta.enableChangeDataFeed = true)
+        AS SELECT * FROM {copy} WHERE FALSE
+        """)
+
+
+def load_step(spark, step):
+    """Insert the rows of one step of every streamed source; step 2 also refunds some payments."""
+    for table, conditions in STREAMED_SOURCES.items():
+        spark.sql(f"INSERT INTO {table} SELECT * FROM benchmark_streaming_source.{table.replace('.', '_')} WHERE {conditions[step - 1]}")
+
+    if step == 2:
+        spark.sql("""
+        UPDATE app_yuno.tr_payments
+        SET status = 'REFUNDED', refunded = amount_value, updated_at = updated_at + INTERVAL 1 DAY
+        WHERE status = 'SUCCEEDED' AND pmod(xxhash64(payment_id, 'reembolso'), 10) = 0
+        """)
+
+
+def run_streaming(spark, manifest, work_dir, starting_timestamp, metrics):
+    widgets = {
+        "mercados": str(tuple(manifest["yuno_mercados"])),
+        "target_table": target_table_name("yuno"),
+        "checkpoint_location": os.path.join(work_dir, "streaming_checkpoint"),
+        "starting_timestamp": starting_timestamp,
+        "trigger_intervalo": "availableNow",
+        # Everything generated stays in the state, as it stays in the window of the daily run
+        "retencion_dias": "3650",
+    }
+    results = []
+    run_pipeline(spark, "yuno", widgets, metrics, results, notebook=STREAMING_NOTEBOOK)
+    print(f"  [streaming] {spark.table(target_table_name('yuno') + '_streaming_flags').count()} flags in {results[-1]['wall_time_s']}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--data", required=True, help="Directory written by generate_data.py --format delta")
+    parser.add_argument("--work-dir", default="/tmp/fraudes_streaming_work", help="Warehouse and checkpoint, wiped on start")
+    parser.add_argument("--show", type=int, default=10, help="Differing rows printed per side")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.data, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest["format"] != "delta":
+        sys.exit("The streaming check reads change data feeds: generate the data with --format delta.")
+
+    spark = create_session(args.data, manifest, args.work_dir)
+    metrics = StageMetrics(spark)
+
+    create_change_feed_sources(spark)
+    starting_timestamp = spark.sql("SELECT CAST(CURRENT_TIMESTAMP() AS STRING)").collect()[0][0]
+
+    for step in (1, 2):
+        print(f"Streaming step {step}")
+        load_step(spark, step)
+        run_streaming(spark, manifest, args.work_dir, starting_timestamp, metrics)
+
+    # The daily run over every business date of the data, with a day of margin for the payments
+    fecha_inicio = spark.sql("SELECT MIN(SALES_BUSINESS_DT) FROM adw.sales_transaction_sin_brasil").collect()[0][0]
+    fecha_fin = date.fromisoformat(manifest["fecha_fin"])
+    widgets = {
+        **pipeline_widgets(manifest, "yuno"),
+        "fecha_desde": (fecha_inicio - timedelta(days=1)).isoformat(),
+        "fecha_ayer": (fecha_fin + timedelta(days=2)).isoformat(),
+    }
+    print("Daily run over the same data")
+    run_pipeline(spark, "yuno", widgets, metrics, [])
+
+    batch = spark.table(target_table_name("yuno")).selectExpr(*(f"`{column}` AS {name}" for name, column in COMPARED_COLUMNS.items()))
+    streaming = spark.table(target_table_name("yuno") + "_streaming_flags").select(*COMPARED_COLUMNS)
+
+    solo_batch = batch.exceptAll(streaming)
+    solo_streaming = streaming.exceptAll(batch)
+    filas_batch, filas_streaming = solo_batch.count(), solo_streaming.count()
+    if filas_batch or filas_streaming:
+        print(f"  {filas_batch} rows only in the daily run, {filas_streaming} rows only in the streaming flags")
+        solo_batch.show(args.show, truncate=False)
+        solo_streaming.show(args.show, truncate=False)
+        sys.exit(1)
+    print(f"  streaming flags and daily run are identical ({batch.count()} rows)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+"""Synthetic source data for the fraud detection notebooks.
+
+Writes fake versions of every table read by TR_DETECCION_FRAUDES_IFOOD and TR_DETECCION_FRAUDES_YUNO as local
+Parquet or Delta, laid out as <output>/<schema>/<table>, plus a manifest.json consumed by run_benchmark.py.
+
+Every order is drawn once and then written to the TLD side, the provider side or both depending on its category:
+
+  ruido            TLD sale in a channel the notebooks filter out (scan cost only)
+  integrada        TLD sale and provider record sharing the order key
+  solo_tld         TLD sale with its key, no provider record
+  solo_proveedor   provider record with no TLD sale
+  manual           TLD sale without key and provider record with the same date, location and amount
+  manual_duplicada manual order forced onto a shared date + location + amount, so its concat key is duplicated
+
+Integrated sales get a credit note at --credit-note-rate, and a fifth of those a second (duplicated) credit note.
+
+Usage:
+    python benchmarks/generate_data.py --output /tmp/fraudes_bench --scale 10
+"""
+
+import argparse
+import json
+import os
+from datetime import date, datetime, timedelta
+
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+
+BASE_ORDERS = {"ifood": 20000, "yuno": 40000}
+
+LOCATIONS_PER_COUNTRY = 150
+
+DIAS_ACTIVIDAD = 28
+
+# country_id, country_name_desc, country_short_abbreviation_cd, country_timezone, currency_cd, Yuno weight
+COUNTRIES = [
+    ("086", "Brasil", "BR", "America/Sao_Paulo", "BRL", 0.0),
+    ("170", "Colombia", "CO", "America/Bogota", "COP", 0.5),
+    ("152", "Chile", "CL", "America/Santiago", "CLP", 0.25),
+    ("131", "Costa Rica", "CR", "America/Costa_Rica", "CRC", 0.15),
+    ("080", "Uruguay", "UY", "America/Montevideo", "UYU", 0.1),
+]
+
+SALE_CHANNELS = [(10, "Delivery"), (20, "Digital")]
+
+SALE_SUBCHANNELS = [
+    (1001, 20, "App"),
+    (1002, 20, "Web"),
+    (1003, 20, "Kiosko"),
+    (1004, 20, "Pick up"),
+    (2001, 10, "iFood"),
+    (2002, 10, "Partner"),
+]
+
+END_DT_ACTUAL = "9999-12-31 00:00:00"
+
+
+def acronym(index):
+    """Three-letter location acronym, unique per country for the first 26**3 locations."""
+    return chr(65 + index // 676 % 26) + chr(65 + index // 26 % 26) + chr(65 + index % 26)
+
+
+def write_table(df, output, schema, table, file_format):
+    path = os.path.join(output, schema, table)
+    df.write.mode("overwrite").format(file_format).save(path)
+    print(f"  {schema}.{table}: {df.count()} rows")
+    return f"{schema}.{table}"
+
+
+def build_dimensions(spark, fecha_fin):
+    country_rows = []
+    location_rows = []
+
+    for country_index, (country_id, name, abbreviation, timezone, currency, _) in enumerate(COUNTRIES):
+        country_rows.append((country_id, name, abbreviation, timezone, currency, END_DT_ACTUAL))
+        # A closed historic version, which the *_actual snapshots must filter out
+        country_rows.append((country_id, f"{name} (historico)", abbreviation, timezone, currency, "2020-01-01 00:00:00"))
+
+        for i in range(LOCATIONS_PER_COUNTRY):
+            location_id = (country_index + 1) * 100000 + i
+            ownerships = "Propio" if i % 4 else "Franquicia"
+            location_rows.append((
+                location_id,
+                location_id,
+                f"{acronym(i)} - Local {i}",
+                acronym(i),
+                f"OAK{location_id}",
+                ownerships,
+                f"ArcopCo {ownerships}" if i % 10 else "Tercero",
+                country_id,
+                END_DT_ACTUAL,
+            ))
+
+    dim_country = spark.createDataFrame(
+        country_rows,
+        "country_id STRING, country_name_desc STRING, country_short_abbreviation_cd STRING, country_timezone STRING, "
+        "currency_cd STRING, country_end_dt STRING",
+    ).withColumn("country_end_dt", F.to_timestamp("country_end_dt"))
+
+    dim_location = spark.createDataFrame(
+        location_rows,
+        "location_id BIGINT, location_base_id BIGINT, location_name STRING, location_acronym_cd STRING, "
+        "loc_store_oak_id STRING, ownerships STRING, ownerships_desc_reporting STRING, country_id STRING, location_end_dt STRING",
+    ).withColumn("location_end_dt", F.to_timestamp("location_end_dt"))
+
+    lk_sale_channel = spark.createDataFrame(SALE_CHANNELS, "sale_channel_id INT, sale_channel_desc STRING")
+    lk_sale_subchannel = spark.createDataFrame(SALE_SUBCHANNELS, "sale_subchannel_id INT, sale_channel_id INT, sale_subchannel_desc STRING")
+
+    lk_country = dim_country.where(F.col("country_end_dt") == F.to_timestamp(F.lit(END_DT_ACTUAL))).select("country_name_desc", "currency_cd")
+
+    meses = sorted({(fecha_fin - timedelta(days=d)).replace(day=1) for d in range(0, 95, 15)})
+    currency_rows = []
+    for country_index, (_, _, _, _, currency, _) in enumerate(COUNTRIES):
+        for mes in meses:
+            for currency_type_id in (1, 4):
+                currency_rows.append((
+                    currency,
+                    mes,
+                    round(1.0 / (5 + country_index * 900 + mes.month), 10),
+                    currency_type_id,
+                    date(2000, 1, 1),
+                    date(9999, 12, 31),
+                ))
+    hist_currency_translation_rate = spark.createDataFrame(
+        currency_rows,
+        "source_currency_cd STRING, curr_trans_calendar_dt DATE, source_to_target_currency_rate DOUBLE, currency_type_id INT, "
+        "curr_translation_rate_start_dt DATE, curr_translation_rate_end_dt DATE",
+    ).withColumn("source_to_target_currency_rate", F.col("source_to_target_currency_rate").cast("DECIMAL(38, 18)"))
+
+    brasil = dim_location.where(F.col("country_id") == "086")
+    dim_lk_location_base = brasil.select("country_id", "location_acronym_cd", "ownerships")
+    ifood_merchants = brasil.select(
+        F.concat(F.lit("MER"), F.col("location_id").cast("STRING")).alias("id"),
+        F.concat(F.lit("McDonald's "), F.col("location_name")).alias("name"),
+        F.lit("Arcos Dourados Comercio de Alimentos Ltda").alias("corporatename"),
+        F.col("location_acronym_cd").alias("LOCAL"),
+    )
+
+    return {
+        ("common", "dim_country"): dim_country,
+        ("common", "dim_location"): dim_location,
+        ("common", "lk_sale_channel"): lk_sale_channel,
+        ("common", "lk_sale_subchannel"): lk_sale_subchannel,
+        ("common", "hist_currency_translation_rate"): hist_currency_translation_rate,
+        ("adw", "lk_country"): lk_country,
+        ("adw", "dim_lk_location_base"): dim_lk_location_base,
+        ("landing", "ifood_merchants"): ifood_merchants,
+    }
+
+
+def build_orders(spark, pipeline, n_orders, fecha_fin, rates, seed, dim_location):
+    """Draw the orders of a pipeline with their category, country, location, local timestamps and amount."""
+    if pipeline == "ifood":
+        country_case = "'086'"
+    else:
+        branches = []
+        acumulado = 0.0
+        for country_id, _, _, _, _, weight in COUNTRIES:
+            if weight:
+                acumulado += weight
+                branches.append(f"WHEN u_country < {acumulado} THEN '{country_id}'")
+        country_case = f"CASE {' '.join(branches)} ELSE '{COUNTRIES[1][0]}' END"
+
+    noise = rates["noise_rate"]
+    unmatched = rates["unmatched_rate"]
+    manual = rates["manual_rate"]
+
+    orders = (
+        spark.range(n_orders)
+        .select(
+            "id",
+            *[F.rand(seed + offset).alias(name) for offset, name in enumerate(
+                ["u_cat", "u_dup", "u_nc", "u_nc_dup", "u_day", "u_time", "u_loc", "u_amt", "u_country", "u_status", "u_retry"]
+            )],
+        )
+        .withColumn("v_cat", (F.col("u_cat") - noise) / (1 - noise))
+        .withColumn("categoria", F.expr(f"""
+            CASE
+              WHEN u_cat < {noise} THEN 'ruido'
+              WHEN u_dup < {rates["duplicate_rate"]} THEN 'manual_duplicada'
+              WHEN v_cat < {unmatched / 2} THEN 'solo_tld'
+              WHEN v_cat < {unmatched} THEN 'solo_proveedor'
+              WHEN v_cat < {unmatched + manual} THEN 'manual'
+              ELSE 'integrada'
+            END"""))
+        .withColumn("country_id", F.expr(country_case))
+        .withColumn("dia", F.floor(F.col("u_day") * DIAS_ACTIVIDAD).cast("INT"))
+        .withColumn("location_index", F.floor(F.col("u_loc") * LOCATIONS_PER_COUNTRY).cast("INT"))
+        .withColumn("monto", F.round(F.lit(5) + F.col("u_amt") * 95, 2).cast("DECIMAL(18, 2)"))
+        # Duplicated manual orders collapse onto a handful of date + location + amount keys
+        .withColumn("dia", F.expr("CASE WHEN categoria = 'manual_duplicada' THEN dia % 3 ELSE dia END"))
+        .withColumn("location_index", F.expr("CASE WHEN categoria = 'manual_duplicada' THEN 0 ELSE location_index END"))
+        .withColumn("monto", F.expr("CASE WHEN categoria = 'manual_duplicada' THEN CAST(9.90 AS DECIMAL(18, 2)) ELSE monto END"))
+        .withColumn("fecha", F.date_sub(F.lit(fecha_fin), F.col("dia")))
+        # Business hours only, so the local date of a sale and of its provider record always agree
+        .withColumn("inicio_local", F.expr("TIMESTAMPADD(SECOND, 28800 + CAST(u_time * 50400 AS INT), CAST(fecha AS TIMESTAMP))"))
+        .withColumn("fin_local", F.expr("TIMESTAMPADD(SECOND, 60 + CAST(u_amt * 540 AS INT), inicio_local)"))
+        .withColumn("order_key", F.format_string("%09d", F.col("id") + 100000000))
+    )
+
+    locations = dim_location.select(
+        "country_id",
+        "location_id",
+        "location_acronym_cd",
+        (F.col("location_id") % 100000).cast("INT").alias("location_index"),
+    )
+    countries = spark.createDataFrame(
+        [(c[0], c[2], c[3]) for c in COUNTRIES], "country_id STRING, country_abbreviation STRING, country_timezone STRING"
+    )
+
+    return orders.join(F.broadcast(locations), ["country_id", "location_index"]).join(F.broadcast(countries), "country_id")
+
+
+def build_tld(orders, pipeline, rates):
+    """TLD sales (sales_type_id 1) and credit notes (sales_type_id 2), with their payment lines."""
+    ventas = orders.where(F.col("categoria") != "solo_proveedor").withColumn("tipo", F.lit(1))
+    notas = (
+        orders.where((F.col("categoria") == "integrada") & (F.col("u_nc") < rates["credit_note_rate"]))
+        .withColumn("tipo", F.lit(2))
+    )
+    notas_duplicadas = notas.where(F.col("u_nc_dup") < 0.2).withColumn("tipo", F.lit(3))
+
+    filas = ventas.unionByName(notas).unionByName(notas_duplicadas)
+
+    if pipeline == "ifood":
+        subcanal = "CASE WHEN categoria = 'ruido' THEN 1001 ELSE 2001 END"
+        clave = "CASE WHEN categoria IN ('manual', 'manual_duplicada') THEN NULL ELSE CONCAT(order_key, ' IFOOD') END"
+        tipo_pago = "CASE WHEN categoria = 'ruido' THEN '1_086' ELSE '28_086' END"
+    else:
+        subcanal = "CASE WHEN categoria = 'ruido' THEN 2001 ELSE ELEMENT_AT(ARRAY(1001, 1002, 1003, 1004, 2002), CAST(u_status * 5 AS INT) + 1) END"
+        clave = "CASE WHEN categoria IN ('manual', 'manual_duplicada') THEN NULL ELSE order_key END"
+        tipo_pago = "CASE WHEN u_retry < 0.03 THEN '1_102' ELSE CONCAT('12_', country_id) END"
+
+    sales_transaction = filas.select(
+        (F.col("id") * 4 + F.col("tipo")).alias("sales_transaction_id"),
+        F.expr(clave).alias("specialsaleorderld"),
+        F.lit("IFOOD" if pipeline == "ifood" else "APP").alias("specialsaletype"),
+        F.concat(F.col("location_acronym_cd"), F.lit("-"), F.col("order_key"), F.lit("-"), F.col("tipo")).alias("salekey"),
+        F.expr("CASE WHEN categoria IN ('manual', 'manual_duplicada') THEN 0.0 ELSE 1.0 END").cast("FLOAT").alias("integrated"),
+        F.expr("CASE WHEN tipo = 1 THEN 1 ELSE 2 END").alias("sales_type_id"),
+        F.format_string("R%02d_%s", (F.col("id") % 8).cast("INT"), F.col("location_acronym_cd")).alias("pos_register_id"),
+        "country_id",
+        "location_id",
+        F.expr(subcanal).alias("sale_subchannel_id"),
+        F.expr("CASE WHEN u_status > 0.98 THEN 99 ELSE 20 END").alias("channel_id"),
+        F.expr("CASE WHEN u_status * 5 >= 4 THEN 'MCD APP' ELSE 'MCD' END").alias("partner_desc"),
+        F.format_string("MC%010d", F.col("id")).alias("loyalty_mcid"),
+        F.col("fecha").cast("TIMESTAMP").alias("sales_date"),
+        F.col("fecha").alias("sales_business_dt"),
+        F.expr("CASE WHEN tipo = 1 THEN inicio_local ELSE TIMESTAMPADD(MINUTE, 30 * tipo, inicio_local) END").alias("sales_start_dttm"),
+        F.expr("CASE WHEN tipo = 1 THEN fin_local ELSE TIMESTAMPADD(MINUTE, 30 * tipo, fin_local) END").alias("sales_end_dttm"),
+        F.expr("CASE WHEN tipo = 1 THEN monto ELSE -monto END").alias("sales_gross_amt"),
+        (F.col("id") % 50).alias("manager_associate_id"),
+        (F.col("id") % 400).alias("sales_associate_id"),
+        F.expr("ELEMENT_AT(ARRAY('SALON', 'DELIVERY', 'AUTOMAC'), CAST(u_loc * 3 AS INT) + 1)").alias("special_sale_storearea"),
+        F.expr("TIMESTAMPADD(HOUR, 27, CAST(fecha AS TIMESTAMP))").alias("adls_audit_date"),
+    )
+
+    payment_line = filas.select(
+        (F.col("id") * 4 + F.col("tipo")).alias("sales_transaction_id"),
+        "country_id",
+        "location_id",
+        F.expr(tipo_pago).alias("payment_subtype_id"),
+        F.expr("CASE WHEN tipo = 1 THEN monto ELSE -monto END").alias("payment_amt"),
+        F.expr("TIMESTAMPADD(HOUR, 27, CAST(fecha AS TIMESTAMP))").alias("adls_audit_date"),
+    )
+
+    return sales_transaction, payment_line
+
+
+def build_ifood_provider(orders):
+    proveedor = orders.where(F.col("categoria").isin("integrada", "solo_proveedor", "manual", "manual_duplicada"))
+
+    fato = """CASE
+        WHEN u_status < 0.80 THEN 'Venda'
+        WHEN u_status < 0.86 THEN 'Cancelamento Total'
+        WHEN u_status < 0.90 THEN 'Cancelamento Parcial'
+        WHEN u_status < 0.95 THEN 'Ressarcimento/Indenização'
+        ELSE 'Ocorrencia Venda'
+      END"""
+
+    return (
+        proveedor
+        .withColumn("fato_gerador", F.expr(fato))
+        .withColumn("creado_utc", F.expr("TO_UTC_TIMESTAMP(TIMESTAMPADD(SECOND, -60, inicio_local), country_timezone)"))
+        .select(
+            F.concat(F.lit("MER"), F.col("location_id").cast("STRING")).alias("loja_id"),
+            F.col("order_key").alias("pedido_associado_ifood"),
+            F.substring("order_key", -4, 4).alias("pedido_associado_ifood_curto"),
+            F.col("creado_utc").alias("data_criacao_pedido_associado"),
+            F.expr("TIMESTAMPADD(HOUR, 24, creado_utc)").alias("data_faturamento"),
+            F.col("fecha").alias("data_fato_gerador"),
+            "fato_gerador",
+            F.lit("Pedido").alias("tipo_lancamento"),
+            F.col("monto").alias("monto_cobrado"),
+            F.expr("CASE WHEN fato_gerador = 'Cancelamento Total' THEN monto WHEN fato_gerador = 'Cancelamento Parcial' THEN monto / 2 ELSE 0 END")
+            .cast("DECIMAL(18, 2)").alias("valor_cancelado"),
+            F.expr("CASE WHEN fato_gerador = 'Ressarcimento/Indenização' THEN monto * 0.8 ELSE 0 END").cast("DECIMAL(18, 2)").alias("valor_compensado"),
+            F.expr("CASE WHEN fato_gerador = 'Ressarcimento/Indenização' THEN monto * 0.8 ELSE 0 END").cast("DECIMAL(18, 2)").alias("ressarcimento"),
+            F.lit(0).cast("DECIMAL(18, 2)").alias("outros_agg"),
+            F.expr("CASE WHEN fato_gerador = 'Cancelamento Total' THEN -monto ELSE 0 END").cast("DECIMAL(18, 2)").alias("cancelamento_total"),
+            F.expr("CASE WHEN fato_gerador = 'Cancelamento Parcial' THEN -monto / 2 ELSE 0 END").cast("DECIMAL(18, 2)").alias("cancelamento_parcial"),
+            F.lit(0).cast("DECIMAL(18, 2)").alias("cancelamento_total_sem_impacto"),
+            F.lit(0).cast("DECIMAL(18, 2)").alias("cancelamento_parcial_sem_impacto"),
+            F.col("monto").alias("venda_bruta"),
+            F.lit(0).cast("DECIMAL(18, 2)").alias("venda_bruta_sem_impacto"),
+            F.expr("CASE WHEN fato_gerador LIKE 'Cancelamento%' THEN 'Pedido cancelado pelo cliente' END").alias("motivo_cancelamento"),
+            F.expr("CASE WHEN fato_gerador = 'Ressarcimento/Indenização' THEN 'IFOOD' ELSE 'LOJA' END").alias("responsavel_transacao"),
+            F.expr("TIMESTAMPADD(HOUR, 30, CAST(fecha AS TIMESTAMP))").alias("adls_audit_date"),
+        )
+    )
+
+
+def build_yuno_provider(orders):
+    proveedor = orders.where(F.col("categoria").isin("integrada", "solo_proveedor", "manual", "manual_duplicada"))
+
+    # A share of orders has an earlier payment attempt that the notebook must discard by updated_at
+    intentos = proveedor.withColumn("intento", F.lit(1)).unionByName(
+        proveedor.where(F.col("u_retry") < 0.05).withColumn("intento", F.lit(0))
+    )
+
+    pagos = (
+        intentos
+        .withColumn("creado_utc", F.expr("TO_UTC_TIMESTAMP(TIMESTAMPADD(SECOND, -60 - 120 * (1 - intento), inicio_local), country_timezone)"))
+        .withColumn("status", F.expr("""CASE
+            WHEN intento = 0 THEN 'SUCCEEDED'
+            WHEN u_status < 0.90 THEN 'SUCCEEDED'
+            WHEN u_status < 0.97 THEN 'REFUNDED'
+            ELSE 'DECLINED'
+          END"""))
+        .withColumn("sub_status", F.expr("CASE WHEN status = 'SUCCEEDED' AND u_status > 0.88 THEN 'PARTIALLY_REFUNDED' ELSE status END"))
+    )
+
+    tr_payments = pagos.select(
+        F.format_string("pay-%012d-%d", F.col("id"), F.col("intento")).alias("payment_id"),
+        F.concat(F.col("location_acronym_cd"), F.lit("-"), F.col("order_key")).alias("merchant_order_id"),
+        F.col("creado_utc").alias("created_at"),
+        F.expr("TIMESTAMPADD(SECOND, 20, creado_utc)").alias("updated_at"),
+        "status",
+        "sub_status",
+        F.col("monto").cast("DOUBLE").alias("amount_value"),
+        F.col("monto").cast("DOUBLE").alias("captured"),
+        F.expr("CASE WHEN status = 'REFUNDED' THEN monto WHEN sub_status = 'PARTIALLY_REFUNDED' THEN monto / 2 ELSE 0 END").cast("DOUBLE").alias("refunded"),
+        F.concat(F.lit("Pedido "), F.col("order_key")).alias("description"),
+        F.col("country_abbreviation").alias("country"),
+    )
+
+    tr_transactions = pagos.select(
+        F.format_string("trx-%012d-%d", F.col("id"), F.col("intento")).alias("transaction_id"),
+        F.format_string("pay-%012d-%d", F.col("id"), F.col("intento")).alias("payment_id"),
+        F.concat(F.col("location_acronym_cd"), F.lit("-"), F.col("order_key")).alias("merchant_order_id"),
+        F.col("creado_utc").alias("created_at"),
+        F.expr("CASE WHEN status = 'DECLINED' THEN 'DECLINED' ELSE 'SUCCEEDED' END").alias("status"),
+        F.col("country_abbreviation").alias("country"),
+        F.expr("ELEMENT_AT(ARRAY('ADYEN', 'MERCADOPAGO', 'PAYU'), CAST(u_amt * 3 AS INT) + 1)").alias("provider_id"),
+    )
+
+    return tr_payments, tr_transactions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", required=True, help="Root directory of the generated tables")
+    parser.add_argument("--scale", type=int, default=1, help="Multiplier of the base order count (1, 10, 100)")
+    parser.add_argument("--format", default="parquet", choices=["parquet", "delta"])
+    parser.add_argument("--fecha-fin", default=(date.today() - timedelta(days=2)).isoformat(), help="Last business date with sales")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--noise-rate", type=float, default=0.3, help="Share of TLD sales outside the reconciled channels")
+    parser.add_argument("--unmatched-rate", type=float, default=0.04, help="Share of orders present on only one side")
+    parser.add_argument("--manual-rate", type=float, default=0.10, help="Share of orders matched by date + location + amount")
+    parser.add_argument("--duplicate-rate", type=float, default=0.02, help="Share of orders with a duplicated concat key")
+    parser.add_argument("--credit-note-rate", type=float, default=0.05, help="Share of integrated sales with a credit note")
+    args = parser.parse_args()
+
+    fecha_fin = date.fromisoformat(args.fecha_fin)
+    rates = {
+        "noise_rate": args.noise_rate,
+        "unmatched_rate": args.unmatched_rate,
+        "manual_rate": args.manual_rate,
+        "duplicate_rate": args.duplicate_rate,
+        "credit_note_rate": args.credit_note_rate,
+    }
+
+    builder = SparkSession.builder.appName("fraudes-generate-data").master("local[*]").config("spark.sql.session.timeZone", "UTC")
+    if args.format == "delta":
+        from delta import configure_spark_with_delta_pip
+
+        builder = configure_spark_with_delta_pip(
+            builder.config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension")
+            .config("spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog")
+        )
+    spark = builder.getOrCreate()
+
+    print(f"Generating scale {args.scale}x into {args.output} ({args.format})")
+    tables = []
+
+    dimensions = build_dimensions(spark, fecha_fin)
+    for (schema, table), df in dimensions.items():
+        tables.append(write_table(df, args.output, schema, table, args.format))
+
+    dim_location = dimensions[("common", "dim_location")]
+
+    orders_ifood = build_orders(spark, "ifood", BASE_ORDERS["ifood"] * args.scale, fecha_fin, rates, args.seed, dim_location)
+    sales_transaction, payment_line_brasil = build_tld(orders_ifood, "ifood", rates)
+    tables.append(write_table(sales_transaction, args.output, "adw", "sales_transaction", args.format))
+    tables.append(write_table(payment_line_brasil, args.output, "adw", "payment_line_brasil", args.format))
+    tables.append(write_table(build_ifood_provider(orders_ifood), args.output, "cancelaciones", "tr_ifood_reconciliation", args.format))
+
+    orders_yuno = build_orders(spark, "yuno", BASE_ORDERS["yuno"] * args.scale, fecha_fin, rates, args.seed + 100, dim_location)
+    sales_transaction_sin_brasil, payment_line_sin_brasil = build_tld(orders_yuno, "yuno", rates)
+    tr_payments, tr_transactions = build_yuno_provider(orders_yuno)
+    tables.append(write_table(sales_transaction_sin_brasil, args.output, "adw", "sales_transaction_sin_brasil", args.format))
+    tables.append(write_table(payment_line_sin_brasil, args.output, "adw", "payment_line_sin_brasil", args.format))
+    tables.append(write_table(tr_payments, args.output, "app_yuno", "tr_payments", args.format))
+    tables.append(write_table(tr_transactions, args.output, "app_yuno", "tr_transactions", args.format))
+
+    manifest = {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "scale": args.scale,
+        "format": args.format,
+        "seed": args.seed,
+        "fecha_fin": fecha_fin.isoformat(),
+        "rates": rates,
+        "yuno_mercados": [c[0] for c in COUNTRIES if c[5]],
+        "tables": tables,
+    }
+    with open(os.path.join(args.output, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"Manifest written to {os.path.join(args.output, 'manifest.json')}")
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""Run the fraud detection notebooks on local PySpark and record per-stage metrics.
+
+The notebooks are executed cell by cell, exactly as exported from Databricks, against the tables written by
+generate_data.py. The workspace-only pieces are replaced by local stand-ins:
+
+  dbutils                    widgets and notebook.exit
+  00.01_init_variables       catalog names, all pointing at spark_catalog
+  00.02_load_table_include   get_table_full_name, create_or_alter_table and load_table_replace
+  TR_DETECCION_FRAUDES_*       the includes of this repo, run as is
+
+Each notebook cell is a stage. For every stage the harness records the wall time, the shuffle bytes read and
+written by the Spark stages it launched, their peak execution memory and the driver JVM heap peak so far. Temp
+views are lazy, so the cost of a view shows up in the cell that first materializes it (CACHE TABLE, MERGE).
+
+--backend selects the SQL backend of the view chain (sql_backend widget, SPARK by default as in the notebooks);
+DUCKDB replays a run on one process, AUTO lets the notebooks pick it from their row estimate.
+
+Requires pyspark and delta-spark (the notebooks write with MERGE), plus duckdb and sqlglot for the DUCKDB backend.
+
+Usage:
+    python benchmarks/run_benchmark.py --data /tmp/fraudes_bench --pipeline all --output results.json
+    python benchmarks/run_benchmark.py --data /tmp/fraudes_bench --pipeline yuno --backend DUCKDB
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import time
+import urllib.request
+from datetime import date, timedelta
+
+from pyspark.sql import SparkSession
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NOTEBOOKS = {
+    "ifood": "TR_DETECCION_FRAUDES_IFOOD.py",
+    "yuno": "TR_DETECCION_FRAUDES_YUNO.py",
+}
+
+CATALOG_VARIABLES = {
+    "l1_raw_catalog_name": "spark_catalog",
+    "l1_raw_catalog_name_prod": "spark_catalog",
+    "l2_foundation_catalog_name": "spark_catalog",
+    "l3_foundation_catalog_name": "spark_catalog",
+}
+
+BENCHMARK_SCHEMA = "benchmark"
+
+
+class NotebookExit(Exception):
+    """Raised by the dbutils stand-in when a notebook calls dbutils.notebook.exit."""
+
+
+class LocalWidgets:
+    def __init__(self, values):
+        self._values = dict(values)
+
+    def text(self, name, default_value="", label=None):
+        self._values.setdefault(name, default_value)
+
+    def dropdown(self, name, default_value, choices, label=None):
+        self._values.setdefault(name, default_value)
+
+    def get(self, name):
+        return self._values[name]
+
+
+class LocalNotebook:
+    def exit(self, value):
+        raise NotebookExit(value)
+
+    def run(self, path, timeout_seconds, arguments=None):
+        raise NotImplementedError("dbutils.notebook.run is not available in the local benchmark.")
+
+
+class LocalDbutils:
+    def __init__(self, widget_values):
+        self.widgets = LocalWidgets(widget_values)
+        self.notebook = LocalNotebook()
+
+
+def workspace_stand_ins(spark, table_full_name):
+    """Functions normally provided by the 00.02_load_table_include notebook."""
+
+    def get_table_full_name():
+        catalog_name, schema_name, table_name = table_full_name.split(".")
+        return catalog_name, schema_name, table_name, table_full_name
+
+    def create_or_alter_table(table_name, dict_table_metadata):
+        columns = ", ".join(f"`{column['name']}` {column['type']}" for column in dict_table_metadata["columns"])
+        spark.sql(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns}) USING DELTA")
+
+    def load_table_replace(table_name, temp_view_name, sql_clause, *args, **kwargs):
+        columns = ", ".join(f"`{column}`" for column in spark.table(table_name).columns)
+        spark.sql(f"DELETE FROM {table_name} WHERE {sql_clause}")
+        spark.sql(f"INSERT INTO {table_name} SELECT {columns} FROM {temp_view_name}")
+
+    return {
+        "get_table_full_name": get_table_full_name,
+        "create_or_alter_table": create_or_alter_table,
+        "load_table_replace": load_table_replace,
+    }
+
+
+def read_cells(notebook_path):
+    """Split an exported Databricks notebook into (title, source) cells."""
+    with open(notebook_path, encoding="utf-8") as f:
+        source = f.read()
+
+    cells = []
+    for index, cell in enumerate(source.split("# COMMAND ----------")):
+        lines = cell.strip("\n").splitlines()
+        title_lines = [line for line in lines if line.startswith("# DBTITLE")]
+        title = title_lines[0].split(",", 1)[1].strip() if title_lines else f"cell {index}"
+        cells.append((title, "\n".join(line for line in lines if not line.startswith("# Databricks notebook source"))))
+
+    return cells
+
+
+class StageMetrics:
+    """Reads stage and executor metrics from the Spark UI REST API of the local session."""
+
+    def __init__(self, spark):
+        self.spark = spark
+        self.ui_url = spark.sparkContext.uiWebUrl
+        self.app_id = spark.sparkContext.applicationId
+        self.seen_stages = set(self._stages())
+
+    def _get(self, endpoint):
+        if not self.ui_url:
+            return []
+        with urllib.request.urlopen(f"{self.ui_url}/api/v1/applications/{self.app_id}/{endpoint}") as response:
+            return json.loads(response.read())
+
+    def _wait_for_listener(self):
+        try:
+            self.spark.sparkContext._jsc.sc().listenerBus().waitUntilEmpty(10000)
+        except Exception:
+            time.sleep(0.5)
+
+    def _stages(self):
+        return {(stage["stageId"], stage["attemptId"]): stage for stage in self._get("stages")}
+
+    def collect(self):
+        """Metrics of the Spark stages completed since the previous call."""
+        self._wait_for_listener()
+        stages = self._stages()
+        new_stages = [stage for key, stage in stages.items() if key not in self.seen_stages]
+        self.seen_stages.update(stages)
+
+        heap_peak = None
+        for executor in self._get("executors"):
+            peak = (executor.get("peakMemoryMetrics") or {}).get("JVMHeapMemory")
+            if peak is not None:
+                heap_peak = max(heap_peak or 0, peak)
+
+        return {
+            "spark_stages": len(new_stages),
+            "shuffle_read_bytes": sum(stage.get("shuffleReadBytes", 0) for stage in new_stages),
+            "shuffle_write_bytes": sum(stage.get("shuffleWriteBytes", 0) for stage in new_stages),
+            "input_bytes": sum(stage.get("inputBytes", 0) for stage in new_stages),
+            "peak_execution_memory_bytes": max([stage.get("peakExecutionMemory", 0) for stage in new_stages], default=0),
+            "jvm_heap_peak_bytes": heap_peak,
+        }
+
+
+def run_notebook(spark, notebook_path, namespace, metrics, results, pipeline, prefix="", on_include=None):
+    """Run the cells of a notebook in namespace; on_include(namespace) is called once the include has been run."""
+    for title, source in read_cells(notebook_path):
+        run_match = re.search(r'^# MAGIC %run "([^"]+)"', source, re.MULTILINE)
+        if run_match:
+            included = os.path.basename(run_match.group(1))
+            # The notebooks of this repo are run as is, every other %run is a workspace notebook replaced by the stand-ins
+            if os.path.exists(os.path.join(REPO_DIR, f"{included}.py")):
+                prefix_include = "include: " if included == "TR_DETECCION_FRAUDES_INCLUDE" else f"{included.lower()}: "
+                run_notebook(spark, os.path.join(REPO_DIR, f"{included}.py"), namespace, metrics, results, pipeline, prefix_include)
+                if on_include and included == "TR_DETECCION_FRAUDES_INCLUDE":
+                    on_include(namespace)
+            continue
+
+        code_lines = [line for line in source.splitlines() if not line.startswith("# MAGIC") and not line.startswith("# DBTITLE")]
+        if not "\n".join(code_lines).strip():
+            continue
+
+        start_time = time.perf_counter()
+        try:
+            exec(compile("\n".join(code_lines), f"{os.path.basename(notebook_path)}:{title}", "exec"), namespace)
+        finally:
+            wall_time = time.perf_counter() - start_time
+            # The notebooks redefine some catalog names (e.g. l1_raw_catalog_name_prod); keep them local
+            namespace.update(CATALOG_VARIABLES)
+            stage = {"pipeline": pipeline, "stage": prefix + title, "wall_time_s": round(wall_time, 3), **metrics.collect()}
+            results.append(stage)
+            print(f"  [{pipeline}] {stage['stage']}: {stage['wall_time_s']}s, shuffle {stage['shuffle_read_bytes'] + stage['shuffle_write_bytes']} bytes")
+
+
+def register_sources(spark, data_dir, manifest):
+    for table in manifest["tables"]:
+        schema, _ = table.split(".")
+        spark.sql(f"CREATE DATABASE IF NOT EXISTS {schema}")
+        spark.sql(f"DROP TABLE IF EXISTS {table}")
+        spark.sql(f"CREATE TABLE {table} USING {manifest['format']} LOCATION '{os.path.join(data_dir, *table.split('.'))}'")
+
+
+def create_session(data_dir, manifest, work_dir, driver_memory="4g", shuffle_partitions=None):
+    """Local Spark session with Delta, the generated sources registered and an empty benchmark schema."""
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    from delta import configure_spark_with_delta_pip
+
+    builder = (
+        SparkSession.builder.appName("fraudes-benchmark")
+        .master("local[*]")
+        .config("spark.driver.memory", driver_memory)
+        .config("spark.sql.session.timeZone", "UTC")
+        .config("spark.sql.warehouse.dir", os.path.join(work_dir, "warehouse"))
+        .config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension")
+        .config("spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog")
+        .config("spark.executor.metrics.pollingInterval", "1s")
+    )
+    if shuffle_partitions:
+        builder = builder.config("spark.sql.shuffle.partitions", shuffle_partitions)
+    spark = configure_spark_with_delta_pip(builder).getOrCreate()
+
+    register_sources(spark, os.path.abspath(data_dir), manifest)
+    spark.sql(f"CREATE DATABASE IF NOT EXISTS {BENCHMARK_SCHEMA}")
+    return spark
+
+
+def pipeline_widgets(manifest, pipeline, sql_backend="SPARK"):
+    fecha_fin = date.fromisoformat(manifest["fecha_fin"])
+    widget_values = {
+        # iFood processes up to the day before fecha_ayer in CURRENT_MONTH mode
+        "ifood": {"fecha_ayer": (fecha_fin + timedelta(days=1)).isoformat(), "execution_mode": "CURRENT_MONTH", "pipeline_run_id": "benchmark"},
+        "yuno": {"fecha_ayer": fecha_fin.isoformat(), "mercados": str(tuple(manifest["yuno_mercados"])), "pipeline_run_id": "benchmark"},
+    }
+    return {**widget_values[pipeline], "sql_backend": sql_backend}
+
+
+def target_table_name(pipeline):
+    return f"spark_catalog.{BENCHMARK_SCHEMA}.tr_deteccion_fraudes_{pipeline}"
+
+
+def run_pipeline(spark, pipeline, widget_values, metrics, results, on_include=None, notebook=None):
+    """Run one notebook with the workspace stand-ins and append its stages and TOTAL to results.
+
+    notebook defaults to the notebook of the pipeline in NOTEBOOKS.
+    """
+    spark.catalog.clearCache()
+    namespace = {
+        "spark": spark,
+        "dbutils": LocalDbutils(widget_values),
+        **CATALOG_VARIABLES,
+        **workspace_stand_ins(spark, target_table_name(pipeline)),
+    }
+
+    start_time = time.perf_counter()
+    try:
+        run_notebook(spark, os.path.join(REPO_DIR, notebook or NOTEBOOKS[pipeline]), namespace, metrics, results, pipeline, on_include=on_include)
+    except NotebookExit as e:
+        print(f"  [{pipeline}] notebook exited: {e}")
+    results.append({"pipeline": pipeline, "stage": "TOTAL", "wall_time_s": round(time.perf_counter() - start_time, 3)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--data", required=True, help="Directory written by generate_data.py")
+    parser.add_argument("--pipeline", default="all", choices=["ifood", "yuno", "all"])
+    parser.add_argument("--backend", default="SPARK", choices=["SPARK", "DUCKDB", "AUTO"], help="SQL backend of the view chain")
+    parser.add_argument("--work-dir", default="/tmp/fraudes_bench_work", help="Warehouse of the target tables, wiped on start")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--shuffle-partitions", type=int, default=None)
+    parser.add_argument("--driver-memory", default="4g")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.data, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    spark = create_session(args.data, manifest, args.work_dir, args.driver_memory, args.shuffle_partitions)
+
+    results = []
+    metrics = StageMetrics(spark)
+    pipelines = list(NOTEBOOKS) if args.pipeline == "all" else [args.pipeline]
+
+    for pipeline in pipelines:
+        print(f"Running {pipeline} on scale {manifest['scale']}x ({args.backend})")
+        run_pipeline(spark, pipeline, pipeline_widgets(manifest, pipeline, args.backend), metrics, results)
+
+    report = {"manifest": manifest, "spark_version": spark.version, "backend": args.backend, "stages": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+
+    print(f"Results written to {args.output}")
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()